@@ -0,0 +1,257 @@
+import asyncio
+import csv
+import hashlib
+import io
+import json
+import logging
+import posixpath
+import secrets
+import time
+import zipfile
+
+from .config import MAX_FILE_SIZE_MB, MAX_IMPORT_ARCHIVE_MB, MAX_QUEUE_SIZE_PER_USER, MEDIA_GC_GRACE
+from .database import touch_media_blobs
+from .media_storage import (
+    UPLOAD_CHUNK_SIZE,
+    UploadTooLargeError,
+    build_temp_path,
+    commit_uploaded_blob,
+    guess_uploaded_file_type,
+    release_blob,
+    spool_uploaded_part,
+)
+from .panel_posts import PANEL_MAX_TEXT_BYTES, build_panel_message_key, build_panel_post
+from .queue import add_storage_item, get_media_quota_remaining, get_user_queue_size
+from .scheduler import schedule_user_publish
+from .write_behind import bump_queue_version, flush_pending_writes
+
+IMPORT_MANIFEST_NAMES = ("manifest.csv", "manifest.json")
+IMPORT_MANIFEST_MAX_BYTES = 10 * 1024 * 1024
+IMPORT_JOB_TTL = 24 * 60 * 60
+# Сборщик мусора не трогает блобы, чей updated_at моложе MEDIA_GC_GRACE
+IMPORT_BLOB_TOUCH_INTERVAL = MEDIA_GC_GRACE / 4
+
+
+class ImportValidationError(ValueError):
+    pass
+
+
+def get_user_import_jobs(state, user_id):
+    return [job for job in state.import_jobs.values() if job["user_id"] == user_id]
+
+
+def get_active_import_job(state, user_id):
+    return next((job for job in get_user_import_jobs(state, user_id) if job["status"] == "running"), None)
+
+
+def prune_import_jobs(state):
+    expired_before = time.time() - IMPORT_JOB_TTL
+    for job_id, job in list(state.import_jobs.items()):
+        if job["finished_at"] and job["finished_at"] < expired_before:
+            del state.import_jobs[job_id]
+
+
+def create_import_job(state, user_id, file_name):
+    prune_import_jobs(state)
+    job = {
+        "id": secrets.token_hex(8),
+        "user_id": user_id,
+        "file_name": file_name,
+        "status": "running",
+        "total": 0,
+        "processed": 0,
+        "created": 0,
+        "error": None,
+        "started_at": time.time(),
+        "finished_at": None,
+    }
+    state.import_jobs[job["id"]] = job
+    return job
+
+
+def update_import_job(state, job, **fields):
+    job.update(fields)
+    # Прогресс импорта виден на главной странице панели, поэтому ее ETag должен смениться
+    bump_queue_version(state, job["user_id"])
+
+
+def find_import_manifest(archive):
+    candidates = [
+        info for info in archive.infolist()
+        if not info.is_dir() and posixpath.basename(info.filename).lower() in IMPORT_MANIFEST_NAMES
+    ]
+    if not candidates:
+        raise ImportValidationError("В архиве нет manifest.csv или manifest.json")
+    # Архив может быть упакован вместе с папкой: берем манифест, ближайший к корню
+    return min(candidates, key=lambda info: (info.filename.count("/"), info.filename))
+
+
+def parse_import_manifest(archive, manifest_info):
+    if manifest_info.file_size > IMPORT_MANIFEST_MAX_BYTES:
+        raise ImportValidationError("Манифест слишком большой")
+    with archive.open(manifest_info) as manifest_file:
+        if manifest_info.filename.lower().endswith(".json"):
+            try:
+                payload = json.load(io.TextIOWrapper(manifest_file, encoding="utf-8-sig"))
+            except ValueError as exc:
+                raise ImportValidationError(f"Некорректный manifest.json: {exc}") from exc
+            rows = payload.get("posts") if isinstance(payload, dict) else payload
+            if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+                raise ImportValidationError("manifest.json должен содержать список постов")
+        else:
+            try:
+                rows = list(csv.DictReader(io.TextIOWrapper(manifest_file, encoding="utf-8-sig", newline="")))
+            except (csv.Error, UnicodeDecodeError) as exc:
+                raise ImportValidationError(f"Некорректный manifest.csv: {exc}") from exc
+    return [{"file": str(row.get("file") or "").strip(), "text": str(row.get("text") or "").strip()} for row in rows]
+
+
+def load_import_plan(archive_path, queue_slots, quota_remaining):
+    # Архив проверяется целиком до того, как в хранилище попадет первый файл
+    max_file_size = MAX_FILE_SIZE_MB * 1024 * 1024
+    with zipfile.ZipFile(archive_path) as archive:
+        manifest_info = find_import_manifest(archive)
+        base_dir = posixpath.dirname(manifest_info.filename)
+        entries = {info.filename: info for info in archive.infolist() if not info.is_dir()}
+        rows = parse_import_manifest(archive, manifest_info)
+
+    if not rows:
+        raise ImportValidationError("Манифест пуст")
+    if len(rows) > queue_slots:
+        raise ImportValidationError(f"В очереди осталось мест: {max(queue_slots, 0)}, в манифесте постов: {len(rows)}")
+
+    plan = []
+    total_size = 0
+    for line_number, row in enumerate(rows, start=1):
+        if len(row["text"].encode("utf-8")) > PANEL_MAX_TEXT_BYTES:
+            raise ImportValidationError(f"Пост {line_number}: текст слишком длинный")
+        info = None
+        if row["file"]:
+            info = entries.get(posixpath.normpath(posixpath.join(base_dir, row["file"])))
+            if info is None:
+                raise ImportValidationError(f"Пост {line_number}: файла {row['file']} нет в архиве")
+            if info.file_size > max_file_size:
+                raise ImportValidationError(f"Пост {line_number}: файл {row['file']} больше {MAX_FILE_SIZE_MB} МБ")
+            total_size += info.file_size
+        elif not row["text"]:
+            raise ImportValidationError(f"Пост {line_number}: нет ни текста, ни файла")
+        plan.append((row["text"], info))
+
+    if quota_remaining is not None and total_size > quota_remaining:
+        raise ImportValidationError("Файлы архива превышают квоту на медиафайлы")
+    return plan
+
+
+def copy_archive_entry(archive_path, info, destination_path, max_size_bytes):
+    # Файл читается из архива порциями: в память не попадает ни архив, ни файл целиком
+    digest = hashlib.sha256()
+    file_size = 0
+    with zipfile.ZipFile(archive_path) as archive, archive.open(info) as source, open(destination_path, "wb") as destination:
+        while chunk := source.read(UPLOAD_CHUNK_SIZE):
+            file_size += len(chunk)
+            if file_size > max_size_bytes:
+                raise UploadTooLargeError(f"File size exceeds {max_size_bytes} bytes limit")
+            digest.update(chunk)
+            destination.write(chunk)
+    return digest.hexdigest()
+
+
+async def store_archive_entry(state, archive_path, info):
+    temp_path = build_temp_path()
+    try:
+        content_hash = await asyncio.to_thread(copy_archive_entry, archive_path, info, temp_path, MAX_FILE_SIZE_MB * 1024 * 1024)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    original_file_name = posixpath.basename(info.filename)
+    file_type = guess_uploaded_file_type(original_file_name)
+    blob_path, original_file_name, content_hash, file_size = await commit_uploaded_blob(
+        state, temp_path, content_hash, file_type, original_file_name
+    )
+    return str(blob_path), original_file_name, file_type, content_hash, file_size
+
+
+def insert_imported_posts(state, user_id, posts):
+    if get_user_queue_size(state, user_id) + len(posts) > MAX_QUEUE_SIZE_PER_USER:
+        raise ImportValidationError("Очередь заполнилась, пока шел импорт")
+    quota_remaining = get_media_quota_remaining(state, user_id)
+    if quota_remaining is not None and sum(upload[4] for _, upload in posts if upload) > quota_remaining:
+        raise ImportValidationError("Файлы архива превышают квоту на медиафайлы")
+
+    # Порядок манифеста сохраняется через created_at, а все строки уходят в базу одной транзакцией
+    started_at = time.time()
+    for position, (text, upload) in enumerate(posts):
+        add_storage_item(state, build_panel_message_key(user_id), build_panel_post(user_id, text, upload, started_at + position * 0.001))
+
+
+async def run_import_job(state, job, archive_path):
+    user_id = job["user_id"]
+    posts = []
+    try:
+        plan = await asyncio.to_thread(
+            load_import_plan,
+            archive_path,
+            MAX_QUEUE_SIZE_PER_USER - get_user_queue_size(state, user_id),
+            get_media_quota_remaining(state, user_id),
+        )
+        update_import_job(state, job, total=len(plan))
+        touched_at = time.monotonic()
+        for text, info in plan:
+            upload = await store_archive_entry(state, archive_path, info) if info else None
+            posts.append((text, upload))
+            update_import_job(state, job, processed=len(posts))
+            if time.monotonic() - touched_at > IMPORT_BLOB_TOUCH_INTERVAL:
+                # Посты попадут в storage только в конце импорта, а до тех пор ссылки на блобы видит лишь этот процесс
+                await touch_media_blobs(state, {upload[3] for _, upload in posts if upload})
+                touched_at = time.monotonic()
+
+        insert_imported_posts(state, user_id, posts)
+        posts = []
+        await flush_pending_writes(state)
+        schedule_user_publish(state, user_id)
+        update_import_job(state, job, status="done", created=job["total"], finished_at=time.time())
+        logging.info(f"Импорт {job['id']} пользователя {user_id}: добавлено постов {job['total']}")
+    except Exception as exc:
+        if isinstance(exc, (ImportValidationError, zipfile.BadZipFile, UploadTooLargeError)):
+            error = str(exc) if isinstance(exc, ImportValidationError) else "Некорректный архив или слишком большой файл"
+        else:
+            error = "Не удалось импортировать архив"
+            logging.error(f"Ошибка импорта {job['id']} пользователя {user_id}: {exc}")
+        update_import_job(state, job, status="failed", error=error, finished_at=time.time())
+    finally:
+        # Файлы, сохраненные до ошибки или отмены, не должны занимать хранилище
+        for _, upload in posts:
+            if upload:
+                await release_blob(state, upload[0])
+        archive_path.unlink(missing_ok=True)
+
+
+def start_import_job(state, user_id, archive_path, file_name):
+    job = create_import_job(state, user_id, file_name)
+    task = asyncio.create_task(run_import_job(state, job, archive_path))
+    state.import_tasks.add(task)
+    task.add_done_callback(state.import_tasks.discard)
+    return job
+
+
+async def receive_import_archive(state, request, user_id):
+    # Архив сначала целиком сохраняется на диск: zipfile нужен произвольный доступ к каталогу в конце файла
+    if get_active_import_job(state, user_id):
+        raise ImportValidationError("Предыдущий импорт еще не завершен")
+    if request.content_type != "multipart/form-data":
+        raise ImportValidationError("Загрузите ZIP-архив")
+    reader = await request.multipart()
+    async for part in reader:
+        if getattr(part, "name", None) == "archive" and part.filename:
+            archive_path, _, _ = await spool_uploaded_part(part, MAX_IMPORT_ARCHIVE_MB * 1024 * 1024)
+            if get_active_import_job(state, user_id):
+                archive_path.unlink(missing_ok=True)
+                raise ImportValidationError("Предыдущий импорт еще не завершен")
+            return start_import_job(state, user_id, archive_path, part.filename)
+    raise ImportValidationError("Загрузите ZIP-архив")
+
+
+async def stop_import_jobs(state):
+    for task in list(state.import_tasks):
+        task.cancel()
+    await asyncio.gather(*state.import_tasks, return_exceptions=True)
@@ -0,0 +1,81 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramNotFound
+
+from .config import CHAT_CACHE_MAX_SIZE, CHAT_CACHE_NEGATIVE_TTL, CHAT_CACHE_TTL
+
+# Ошибки, которые означают, что чата нет или он недоступен: их имеет смысл кэшировать
+NEGATIVE_CACHE_ERRORS = (TelegramBadRequest, TelegramForbiddenError, TelegramNotFound)
+
+
+class ChatCache:
+    def __init__(self, ttl=CHAT_CACHE_TTL, negative_ttl=CHAT_CACHE_NEGATIVE_TTL, max_size=CHAT_CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    async def get(self, bot, chat_id):
+        key = str(chat_id)
+        entry = self._entries.get(key)
+        if entry:
+            expires_at, chat, error = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                if error:
+                    self.negative_hits += 1
+                    raise error
+                self.hits += 1
+                return chat
+            del self._entries[key]
+
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._load(bot, key, chat_id))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _task: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    async def _load(self, bot, key, chat_id):
+        try:
+            chat = await bot.get_chat(chat_id)
+        except NEGATIVE_CACHE_ERRORS as exc:
+            self._store(key, (time.monotonic() + self.negative_ttl, None, exc))
+            raise
+        self._store(key, (time.monotonic() + self.ttl, chat, None))
+        return chat
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, *chat_ids):
+        for chat_id in chat_ids:
+            if chat_id is not None:
+                self._entries.pop(str(chat_id), None)
+
+    def get_stats(self):
+        lookups = self.hits + self.negative_hits + self.misses + self.coalesced
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_rate": (lookups - self.misses) / lookups if lookups else 0.0,
+        }
@@ -9,10 +9,14 @@ def get_translation(state, user_id, key):
     return TRANSLATIONS.get(lang, TRANSLATIONS["ru"]).get(key, key)
 
 
+async def get_cached_chat(state, chat_id):
+    return await state.chat_cache.get(state.bot, chat_id)
+
+
 async def get_channel_link(state, channel_id, user_id):
     user = state.users.get(str(user_id), {})
     invite_link = user.get("publish_channel_invite_link")
-    chat = await state.bot.get_chat(channel_id)
+    chat = await get_cached_chat(state, channel_id)
     if invite_link:
         return f"<a href='{invite_link}'>{chat.title}</a>"
     if chat.username:
@@ -1,5 +1,6 @@
 from pathlib import Path
 import os
+import socket
 
 ADMIN_IDS = set(map(int, filter(None, os.getenv("ADMIN_IDS", "").split(","))))
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "123456:CHANGE_ME")
@@ -11,9 +12,28 @@ PANEL_BASE_URL = os.getenv("PANEL_BASE_URL", "http://127.0.0.1:8080")
 PANEL_BASE_PATH = "/panel"
 PANEL_SESSION_COOKIE = "panel_session"
 PANEL_SESSION_TTL = 7 * 24 * 60 * 60
+PANEL_PAGE_SIZE = int(os.getenv("PANEL_PAGE_SIZE", "20"))
 
 ROOT_DIR = Path(__file__).resolve().parent.parent
 MEDIA_ROOT = ROOT_DIR / "media_storage"
+MEDIA_BLOB_ROOT = MEDIA_ROOT / "blobs"
+MEDIA_TMP_ROOT = MEDIA_ROOT / "tmp"
+
+# Хранилище медиа: local — диск MEDIA_ROOT, s3 — S3-совместимое хранилище, MEDIA_ROOT служит кэшем
+MEDIA_BACKEND = os.getenv("MEDIA_BACKEND", "local").lower()
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+S3_BUCKET = os.getenv("S3_BUCKET", "autoposter-media")
+S3_REGION = os.getenv("S3_REGION") or None
+S3_ACCESS_KEY_ID = os.getenv("S3_ACCESS_KEY_ID") or None
+S3_SECRET_ACCESS_KEY = os.getenv("S3_SECRET_ACCESS_KEY") or None
+MEDIA_CACHE_TTL = int(os.getenv("MEDIA_CACHE_TTL", "86400"))
+
+# Предобработка фото (нужен Pillow): уменьшение, удаление метаданных, перекодирование, миниатюры
+IMAGE_PREPROCESS = os.getenv("IMAGE_PREPROCESS", "false").lower() == "true"
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "2560"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_THUMBNAIL_SIZE = int(os.getenv("IMAGE_THUMBNAIL_SIZE", "320"))
+IMAGE_PROCESS_WORKERS = int(os.getenv("IMAGE_PROCESS_WORKERS", "2"))
 DEFAULT_EXTENSIONS = {
     "photo": ".jpg",
     "video": ".mp4",
@@ -24,8 +44,55 @@ DEFAULT_EXTENSIONS = {
 
 AUTO_PUBLISH_DELAY_MIN = int(os.getenv("AUTO_PUBLISH_DELAY_MIN", "1800"))
 AUTO_PUBLISH_DELAY_MAX = int(os.getenv("AUTO_PUBLISH_DELAY_MAX", "3600"))
+PUBLISH_WORKERS = int(os.getenv("PUBLISH_WORKERS", "8"))
+PUBLISH_WARMUP_WINDOW = int(os.getenv("PUBLISH_WARMUP_WINDOW", "600"))
+
+# embedded — публикует процесс бота, external — отдельные воркеры publisher.py
+PUBLISHER_MODE = os.getenv("PUBLISHER_MODE", "embedded")
+PUBLISHER_INSTANCE_ID = os.getenv("PUBLISHER_INSTANCE_ID") or f"{socket.gethostname()}:{os.getpid()}"
+PUBLISHER_LEASE_TTL = int(os.getenv("PUBLISHER_LEASE_TTL", "120"))
+PUBLISHER_HEARTBEAT_INTERVAL = int(os.getenv("PUBLISHER_HEARTBEAT_INTERVAL", "30"))
+PUBLISHER_POLL_INTERVAL = float(os.getenv("PUBLISHER_POLL_INTERVAL", "5"))
+# Сколько процессов publisher.py запущено: общий лимит TELEGRAM_GLOBAL_RATE делится между ними
+PUBLISHER_PROCESSES = max(1, int(os.getenv("PUBLISHER_PROCESSES", "1")))
+PUBLISH_MAX_ATTEMPTS = int(os.getenv("PUBLISH_MAX_ATTEMPTS", "5"))
+PUBLISH_RETRY_BASE_DELAY = int(os.getenv("PUBLISH_RETRY_BASE_DELAY", "30"))
+PUBLISH_RETRY_MAX_DELAY = int(os.getenv("PUBLISH_RETRY_MAX_DELAY", "3600"))
+PUBLISH_CHANNEL_RETRY_DELAY = int(os.getenv("PUBLISH_CHANNEL_RETRY_DELAY", "3600"))
+
+WRITE_BEHIND_INTERVAL_MS = int(os.getenv("WRITE_BEHIND_INTERVAL_MS", "200"))
+WRITE_BEHIND_MAX_OPS = int(os.getenv("WRITE_BEHIND_MAX_OPS", "500"))
+
+METRICS_LOG_INTERVAL = int(os.getenv("METRICS_LOG_INTERVAL", "300"))
+
+CHAT_CACHE_TTL = int(os.getenv("CHAT_CACHE_TTL", "600"))
+CHAT_CACHE_NEGATIVE_TTL = int(os.getenv("CHAT_CACHE_NEGATIVE_TTL", "60"))
+CHAT_CACHE_MAX_SIZE = int(os.getenv("CHAT_CACHE_MAX_SIZE", "10000"))
+
+# Лимиты Telegram Bot API
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_GROUP_RATE_PER_MINUTE = float(os.getenv("TELEGRAM_GROUP_RATE_PER_MINUTE", "20"))
+TELEGRAM_RETRY_AFTER_ATTEMPTS = int(os.getenv("TELEGRAM_RETRY_AFTER_ATTEMPTS", "3"))
+
+# Режим копирования: медиа не скачивается, пост публикуется через copy_message из исходного сообщения
+MEDIA_COPY_MODE = os.getenv("MEDIA_COPY_MODE", "false").lower() == "true"
+
+# Фоновая загрузка медиа из Telegram
+MEDIA_DOWNLOAD_WORKERS = int(os.getenv("MEDIA_DOWNLOAD_WORKERS", "4"))
+MEDIA_DOWNLOAD_MAX_ATTEMPTS = int(os.getenv("MEDIA_DOWNLOAD_MAX_ATTEMPTS", "3"))
+MEDIA_DOWNLOAD_RETRY_DELAY = int(os.getenv("MEDIA_DOWNLOAD_RETRY_DELAY", "10"))
+
+# Сборка мусора в MEDIA_ROOT: за один проход проверяется один шард каталога
+MEDIA_GC_INTERVAL = int(os.getenv("MEDIA_GC_INTERVAL", "60"))
+MEDIA_GC_GRACE = int(os.getenv("MEDIA_GC_GRACE", "3600"))
+MEDIA_MIGRATION_BATCH = int(os.getenv("MEDIA_MIGRATION_BATCH", "50"))
+MEDIA_MIGRATION_INTERVAL = float(os.getenv("MEDIA_MIGRATION_INTERVAL", "1"))
 
 # Ограничения
 MAX_QUEUE_SIZE_PER_USER = int(os.getenv("MAX_QUEUE_SIZE_PER_USER", "50"))
 MAX_FILE_SIZE_MB = int(os.getenv("MAX_FILE_SIZE_MB", "50"))
+MAX_MEDIA_MB_PER_USER = int(os.getenv("MAX_MEDIA_MB_PER_USER", "1024"))  # 0 — без квоты
+EXPORT_WORKERS = max(1, int(os.getenv("EXPORT_WORKERS", "2")))
+MAX_IMPORT_ARCHIVE_MB = int(os.getenv("MAX_IMPORT_ARCHIVE_MB", "2048"))
 ENABLE_PUBLISH_NOTIFICATION = os.getenv("ENABLE_PUBLISH_NOTIFICATION", "true").lower() == "true"
@@ -1,6 +1,59 @@
+import time
+
 import asyncpg
 
-from .config import DATABASE_URL
+from .config import AUTO_PUBLISH_DELAY_MIN, DATABASE_URL, PUBLISHER_MODE
+
+STORAGE_CHANGES_CHANNEL = "storage_changes"
+# Пост ушел в неудачные, а не опубликован: его файл по-прежнему занимает квоту пользователя
+DEAD_LETTER_NOTIFY_PREFIX = "dead_letter:"
+
+
+USER_COLUMNS = (
+    "publish_channel_id",
+    "temp_channel_id",
+    "auto_publish",
+    "publish_channel_invite_link",
+    "language",
+    "hyperlink_enabled",
+    "last_published_at",
+    "next_publish_at",
+    "panel_login",
+    "panel_password_hash",
+    "panel_password_salt",
+    "panel_api_token_hash",
+)
+
+STORAGE_COLUMNS = (
+    "user_id",
+    "text",
+    "file_id",
+    "file_path",
+    "original_file_name",
+    "file_type",
+    "temp_msg_id",
+    "created_at",
+    "attempts",
+    "next_attempt_at",
+    "last_error",
+    "content_hash",
+    "source_chat_id",
+    "source_message_id",
+    "media_status",
+    "media_attempts",
+    "media_error",
+    "file_size",
+)
+
+
+# Во внешнем режиме эти поля пишут воркеры publisher.py через release_post_lease
+WORKER_STORAGE_COLUMNS = ("attempts", "next_attempt_at", "last_error")
+
+
+def get_storage_column_value(data, column):
+    if column == "user_id":
+        return int(data["user_id"])
+    return data.get(column)
 
 
 async def init_db(state):
@@ -38,6 +91,44 @@ async def init_db(state):
             );
             """
         )
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS dead_letters (
+                message_key TEXT PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                text TEXT,
+                file_id TEXT,
+                file_path TEXT,
+                original_file_name TEXT,
+                file_type TEXT,
+                created_at DOUBLE PRECISION,
+                attempts INTEGER,
+                last_error TEXT,
+                failed_at DOUBLE PRECISION
+            );
+            """
+        )
+        await conn.execute("CREATE INDEX IF NOT EXISTS dead_letters_user_id_idx ON dead_letters (user_id, failed_at);")
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS media_file_ids (
+                content_hash TEXT NOT NULL,
+                file_type TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                PRIMARY KEY (content_hash, file_type)
+            );
+            """
+        )
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS media_blobs (
+                content_hash TEXT PRIMARY KEY,
+                size BIGINT NOT NULL,
+                refcount INTEGER NOT NULL DEFAULT 0,
+                created_at DOUBLE PRECISION
+            );
+            """
+        )
         await conn.execute(
             """
             CREATE TABLE IF NOT EXISTS referrals (
@@ -48,135 +139,557 @@ async def init_db(state):
             """
         )
         await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS last_published_at DOUBLE PRECISION;")
+        await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS next_publish_at DOUBLE PRECISION;")
         await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS panel_login TEXT;")
         await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS panel_password_hash TEXT;")
         await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS panel_password_salt TEXT;")
+        await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS panel_api_token_hash TEXT;")
         await conn.execute("ALTER TABLE storage ADD COLUMN IF NOT EXISTS file_path TEXT;")
         await conn.execute("ALTER TABLE storage ADD COLUMN IF NOT EXISTS original_file_name TEXT;")
         await conn.execute("ALTER TABLE storage ALTER COLUMN temp_msg_id DROP NOT NULL;")
         await conn.execute("ALTER TABLE storage ADD COLUMN IF NOT EXISTS created_at DOUBLE PRECISION;")
+        await conn.execute("ALTER TABLE storage ADD COLUMN IF NOT EXISTS attempts INTEGER DEFAULT 0;")
+        await conn.execute("ALTER TABLE storage ADD COLUMN IF NOT EXISTS next_attempt_at DOUBLE PRECISION;")
+        await conn.execute("ALTER TABLE storage ADD COLUMN IF NOT EXISTS last_error TEXT;")
+        await conn.execute("ALTER TABLE storage ADD COLUMN IF NOT EXISTS lease_owner TEXT;")
+        await conn.execute("ALTER TABLE storage ADD COLUMN IF NOT EXISTS content_hash TEXT;")
+        await conn.execute("ALTER TABLE storage ADD COLUMN IF NOT EXISTS source_chat_id BIGINT;")
+        await conn.execute("ALTER TABLE storage ADD COLUMN IF NOT EXISTS source_message_id BIGINT;")
+        await conn.execute("ALTER TABLE storage ADD COLUMN IF NOT EXISTS lease_expires_at DOUBLE PRECISION;")
+        await conn.execute("ALTER TABLE storage ADD COLUMN IF NOT EXISTS media_status TEXT;")
+        await conn.execute("ALTER TABLE storage ADD COLUMN IF NOT EXISTS media_attempts INTEGER DEFAULT 0;")
+        await conn.execute("ALTER TABLE storage ADD COLUMN IF NOT EXISTS media_error TEXT;")
+        await conn.execute("ALTER TABLE storage ADD COLUMN IF NOT EXISTS file_size BIGINT DEFAULT 0;")
+        await conn.execute("ALTER TABLE dead_letters ADD COLUMN IF NOT EXISTS file_size BIGINT DEFAULT 0;")
+        await conn.execute("ALTER TABLE dead_letters ADD COLUMN IF NOT EXISTS content_hash TEXT;")
+        await conn.execute("ALTER TABLE dead_letters ADD COLUMN IF NOT EXISTS source_chat_id BIGINT;")
+        await conn.execute("ALTER TABLE dead_letters ADD COLUMN IF NOT EXISTS source_message_id BIGINT;")
+        await conn.execute("ALTER TABLE media_blobs ADD COLUMN IF NOT EXISTS updated_at DOUBLE PRECISION;")
+        await conn.execute("CREATE INDEX IF NOT EXISTS storage_user_id_idx ON storage (user_id, created_at);")
+
+
+def user_row_to_dict(row):
+    return {
+        "publish_channel_id": row["publish_channel_id"],
+        "temp_channel_id": row["temp_channel_id"],
+        "auto_publish": row["auto_publish"],
+        "publish_channel_invite_link": row["publish_channel_invite_link"],
+        "language": row["language"],
+        "hyperlink_enabled": row["hyperlink_enabled"],
+        "last_published_at": row["last_published_at"] or 0,
+        "next_publish_at": row["next_publish_at"],
+        "panel_login": row["panel_login"],
+        "panel_password_hash": row["panel_password_hash"],
+        "panel_password_salt": row["panel_password_salt"],
+        "panel_api_token_hash": row["panel_api_token_hash"],
+    }
 
 
 async def load_users(state):
     async with state.pool.acquire() as conn:
         rows = await conn.fetch("SELECT * FROM users")
-    users = {}
+    return {str(row["user_id"]): user_row_to_dict(row) for row in rows}
+
+
+def storage_row_to_dict(row):
+    return {
+        "user_id": str(row["user_id"]),
+        "text": row["text"],
+        "file_id": row["file_id"],
+        "file_path": row["file_path"],
+        "original_file_name": row["original_file_name"],
+        "file_type": row["file_type"],
+        "temp_msg_id": row["temp_msg_id"],
+        "created_at": row["created_at"] or 0,
+        "attempts": row["attempts"] or 0,
+        "next_attempt_at": row["next_attempt_at"],
+        "last_error": row["last_error"],
+        "content_hash": row["content_hash"],
+        "source_chat_id": row["source_chat_id"],
+        "source_message_id": row["source_message_id"],
+        "media_status": row["media_status"],
+        "media_attempts": row["media_attempts"] or 0,
+        "media_error": row["media_error"],
+        "file_size": row["file_size"] or 0,
+    }
+
+
+async def load_storage(state):
+    async with state.pool.acquire() as conn:
+        rows = await conn.fetch("SELECT * FROM storage")
+    return {row["message_key"]: storage_row_to_dict(row) for row in rows}
+
+
+async def load_referrals(state):
+    async with state.pool.acquire() as conn:
+        rows = await conn.fetch("SELECT * FROM referrals")
+    referrals = {}
     for row in rows:
-        users[str(row["user_id"])] = {
-            "publish_channel_id": row["publish_channel_id"],
-            "temp_channel_id": row["temp_channel_id"],
-            "auto_publish": row["auto_publish"],
-            "publish_channel_invite_link": row["publish_channel_invite_link"],
-            "language": row["language"],
-            "hyperlink_enabled": row["hyperlink_enabled"],
-            "last_published_at": row["last_published_at"] or 0,
-            "panel_login": row["panel_login"],
-            "panel_password_hash": row["panel_password_hash"],
-            "panel_password_salt": row["panel_password_salt"],
-        }
-    return users
-
-
-async def save_users(state):
-    async with state.pool.acquire() as conn:
-        for user_id, data in state.users.items():
+        referrer_id = str(row["referrer_id"])
+        referred_id = str(row["referred_id"])
+        referrals.setdefault(referrer_id, []).append(referred_id)
+    return referrals
+
+
+async def load_media_file_ids(state):
+    async with state.pool.acquire() as conn:
+        rows = await conn.fetch("SELECT * FROM media_file_ids")
+    return {(row["content_hash"], row["file_type"]): row["file_id"] for row in rows}
+
+
+async def save_media_file_id(state, content_hash, file_type, file_id):
+    async with state.pool.acquire() as conn:
+        await conn.execute(
+            """
+            INSERT INTO media_file_ids (content_hash, file_type, file_id)
+            VALUES ($1, $2, $3)
+            ON CONFLICT (content_hash, file_type) DO UPDATE SET file_id = EXCLUDED.file_id
+            """,
+            content_hash,
+            file_type,
+            file_id,
+        )
+
+
+async def delete_media_file_id(state, content_hash, file_type):
+    async with state.pool.acquire() as conn:
+        await conn.execute("DELETE FROM media_file_ids WHERE content_hash = $1 AND file_type = $2", content_hash, file_type)
+
+
+async def acquire_media_blob(state, content_hash, size):
+    # Advisory lock по хэшу сериализует захват и освобождение одного блоба между процессами.
+    # Под блокировкой только счетчик ссылок: файл загружается в хранилище уже после коммита
+    async with state.pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext($1))", content_hash)
             await conn.execute(
                 """
-                INSERT INTO users (
-                    user_id, publish_channel_id, temp_channel_id, auto_publish,
-                    publish_channel_invite_link, language, hyperlink_enabled,
-                    last_published_at, panel_login, panel_password_hash, panel_password_salt
-                )
-                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
-                ON CONFLICT (user_id) DO UPDATE SET
-                    publish_channel_id = EXCLUDED.publish_channel_id,
-                    temp_channel_id = EXCLUDED.temp_channel_id,
-                    auto_publish = EXCLUDED.auto_publish,
-                    publish_channel_invite_link = EXCLUDED.publish_channel_invite_link,
-                    language = EXCLUDED.language,
-                    hyperlink_enabled = EXCLUDED.hyperlink_enabled,
-                    last_published_at = EXCLUDED.last_published_at,
-                    panel_login = EXCLUDED.panel_login,
-                    panel_password_hash = EXCLUDED.panel_password_hash,
-                    panel_password_salt = EXCLUDED.panel_password_salt
+                INSERT INTO media_blobs (content_hash, size, refcount, created_at, updated_at)
+                VALUES ($1, $2, 1, $3, $3)
+                ON CONFLICT (content_hash) DO UPDATE SET refcount = media_blobs.refcount + 1, updated_at = EXCLUDED.updated_at
                 """,
-                int(user_id),
-                data["publish_channel_id"],
-                data["temp_channel_id"],
-                data["auto_publish"],
-                data["publish_channel_invite_link"],
-                data["language"],
-                data["hyperlink_enabled"],
-                data.get("last_published_at"),
-                data.get("panel_login"),
-                data.get("panel_password_hash"),
-                data.get("panel_password_salt"),
+                content_hash,
+                size,
+                time.time(),
             )
 
 
-async def load_storage(state):
+async def release_media_blob(state, content_hash, on_released):
     async with state.pool.acquire() as conn:
-        rows = await conn.fetch("SELECT * FROM storage")
-    storage = {}
-    for row in rows:
-        storage[row["message_key"]] = {
-            "user_id": str(row["user_id"]),
-            "text": row["text"],
-            "file_id": row["file_id"],
-            "file_path": row["file_path"],
-            "original_file_name": row["original_file_name"],
-            "file_type": row["file_type"],
-            "temp_msg_id": row["temp_msg_id"],
-            "created_at": row["created_at"] or 0,
-        }
-    return storage
-
-
-async def save_storage(state):
-    async with state.pool.acquire() as conn:
-        await conn.execute("DELETE FROM storage")
-        for message_key, data in state.storage.items():
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext($1))", content_hash)
+            refcount = await conn.fetchval(
+                "UPDATE media_blobs SET refcount = refcount - 1, updated_at = $2 WHERE content_hash = $1 RETURNING refcount",
+                content_hash,
+                time.time(),
+            )
+            if refcount is not None and refcount <= 0:
+                await conn.execute("DELETE FROM media_blobs WHERE content_hash = $1", content_hash)
+                await on_released()
+
+
+async def touch_media_blobs(state, content_hashes):
+    async with state.pool.acquire() as conn:
+        await conn.execute(
+            "UPDATE media_blobs SET updated_at = $2 WHERE content_hash = ANY($1::text[])",
+            list(content_hashes),
+            time.time(),
+        )
+
+
+async def load_media_blob_shard(state, shard):
+    async with state.pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT content_hash, refcount, updated_at FROM media_blobs WHERE content_hash LIKE $1",
+            f"{shard}%",
+        )
+    return {row["content_hash"]: row for row in rows}
+
+
+async def count_media_references(state, path_prefix):
+    async with state.pool.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT file_path, COUNT(*) AS refs FROM (
+                SELECT file_path FROM storage WHERE LEFT(file_path, LENGTH($1)) = $1
+                UNION ALL
+                SELECT file_path FROM dead_letters WHERE LEFT(file_path, LENGTH($1)) = $1
+            ) AS refs
+            GROUP BY file_path
+            """,
+            path_prefix,
+        )
+    return {row["file_path"]: row["refs"] for row in rows}
+
+
+async def reconcile_media_blob(state, content_hash, size, refcount, stale_before, on_orphaned):
+    # Строку, которую недавно трогали acquire/release, не исправляем: ссылка могла еще не дойти до storage
+    async with state.pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext($1))", content_hash)
+            row = await conn.fetchrow("SELECT refcount, updated_at FROM media_blobs WHERE content_hash = $1", content_hash)
+            if row and (row["updated_at"] or 0) > stale_before:
+                return False
+            if refcount <= 0:
+                await conn.execute("DELETE FROM media_blobs WHERE content_hash = $1", content_hash)
+                await on_orphaned()
+            elif not row or row["refcount"] != refcount:
+                await conn.execute(
+                    """
+                    INSERT INTO media_blobs (content_hash, size, refcount, created_at, updated_at)
+                    VALUES ($1, $2, $3, $4, $4)
+                    ON CONFLICT (content_hash) DO UPDATE SET refcount = EXCLUDED.refcount, updated_at = EXCLUDED.updated_at
+                    """,
+                    content_hash,
+                    size,
+                    refcount,
+                    time.time(),
+                )
+            else:
+                return False
+    return True
+
+
+async def load_media_usage(state):
+    async with state.pool.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT user_id, SUM(file_size) AS bytes FROM (
+                SELECT user_id, file_size FROM storage
+                UNION ALL
+                SELECT user_id, file_size FROM dead_letters
+            ) AS usage
+            GROUP BY user_id
+            """
+        )
+    return {str(row["user_id"]): int(row["bytes"] or 0) for row in rows}
+
+
+async def upsert_users(conn, state, dirty_users):
+    # Группируем пользователей по набору измененных полей: один executemany на группу
+    groups = {}
+    for user_id, fields in dirty_users.items():
+        if user_id not in state.users:
+            continue
+        changed_columns = tuple(column for column in USER_COLUMNS if column in fields)
+        groups.setdefault(changed_columns, []).append(user_id)
+
+    columns = ", ".join(USER_COLUMNS)
+    placeholders = ", ".join(f"${index}" for index in range(2, len(USER_COLUMNS) + 2))
+    for changed_columns, user_ids in groups.items():
+        updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in changed_columns)
+        await conn.executemany(
+            f"""
+            INSERT INTO users (user_id, {columns})
+            VALUES ($1, {placeholders})
+            ON CONFLICT (user_id) DO UPDATE SET {updates}
+            """,
+            [(int(user_id), *(state.users[user_id].get(column) for column in USER_COLUMNS)) for user_id in user_ids],
+        )
+
+
+async def sync_storage_items(conn, state, message_keys):
+    present_keys = [message_key for message_key in message_keys if message_key in state.storage]
+    removed_keys = [message_key for message_key in message_keys if message_key not in state.storage]
+    # Вставляются только посты, созданные ботом: строку, удаленную воркером после публикации, нельзя вернуть
+    new_keys = [message_key for message_key in present_keys if message_key in state.new_storage_keys]
+    existing_keys = [message_key for message_key in present_keys if message_key not in state.new_storage_keys]
+    if new_keys:
+        columns = ", ".join(STORAGE_COLUMNS)
+        placeholders = ", ".join(f"${index}" for index in range(2, len(STORAGE_COLUMNS) + 2))
+        updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in STORAGE_COLUMNS)
+        await conn.executemany(
+            f"""
+            INSERT INTO storage (message_key, {columns})
+            VALUES ($1, {placeholders})
+            ON CONFLICT (message_key) DO UPDATE SET {updates}
+            """,
+            [
+                (message_key, *(get_storage_column_value(state.storage[message_key], column) for column in STORAGE_COLUMNS))
+                for message_key in new_keys
+            ],
+        )
+    if existing_keys:
+        owned_columns = STORAGE_COLUMNS
+        if PUBLISHER_MODE != "embedded":
+            owned_columns = tuple(column for column in STORAGE_COLUMNS if column not in WORKER_STORAGE_COLUMNS)
+        updates = ", ".join(f"{column} = ${index}" for index, column in enumerate(owned_columns, start=2))
+        await conn.executemany(
+            f"UPDATE storage SET {updates} WHERE message_key = $1",
+            [
+                (message_key, *(get_storage_column_value(state.storage[message_key], column) for column in owned_columns))
+                for message_key in existing_keys
+            ],
+        )
+    if removed_keys:
+        await conn.execute("DELETE FROM storage WHERE message_key = ANY($1::text[])", removed_keys)
+
+
+async def sync_referrals(conn, state, referral_pairs):
+    present_pairs = []
+    removed_pairs = []
+    for referrer_id, referred_id in referral_pairs:
+        target = present_pairs if referred_id in state.referrals.get(referrer_id, []) else removed_pairs
+        target.append((int(referrer_id), int(referred_id)))
+    if present_pairs:
+        await conn.executemany(
+            """
+            INSERT INTO referrals (referrer_id, referred_id)
+            VALUES ($1, $2)
+            ON CONFLICT DO NOTHING
+            """,
+            present_pairs,
+        )
+    if removed_pairs:
+        await conn.executemany("DELETE FROM referrals WHERE referrer_id = $1 AND referred_id = $2", removed_pairs)
+
+
+async def write_changes(state, dirty_users, dirty_storage, dirty_referrals):
+    async with state.pool.acquire() as conn:
+        async with conn.transaction():
+            await upsert_users(conn, state, dirty_users)
+            await sync_storage_items(conn, state, dirty_storage)
+            await sync_referrals(conn, state, dirty_referrals)
+
+
+async def move_to_dead_letters(state, message_key, data):
+    async with state.pool.acquire() as conn:
+        async with conn.transaction():
             await conn.execute(
                 """
-                INSERT INTO storage (
+                INSERT INTO dead_letters (
                     message_key, user_id, text, file_id, file_path, original_file_name,
-                    file_type, temp_msg_id, created_at
+                    file_type, created_at, attempts, last_error, failed_at, file_size,
+                    content_hash, source_chat_id, source_message_id
                 )
-                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15)
+                ON CONFLICT (message_key) DO UPDATE SET
+                    attempts = EXCLUDED.attempts,
+                    last_error = EXCLUDED.last_error,
+                    failed_at = EXCLUDED.failed_at
                 """,
                 message_key,
                 int(data["user_id"]),
-                data["text"],
+                data.get("text"),
                 data.get("file_id"),
                 data.get("file_path"),
                 data.get("original_file_name"),
                 data.get("file_type"),
-                data.get("temp_msg_id"),
                 data.get("created_at"),
+                data.get("attempts") or 0,
+                data.get("last_error"),
+                time.time(),
+                data.get("file_size") or 0,
+                data.get("content_hash"),
+                data.get("source_chat_id"),
+                data.get("source_message_id"),
             )
+            await conn.execute("DELETE FROM storage WHERE message_key = $1", message_key)
+            await conn.execute("SELECT pg_notify($1, $2)", STORAGE_CHANGES_CHANNEL, f"{DEAD_LETTER_NOTIFY_PREFIX}{message_key}")
 
 
-async def load_referrals(state):
+async def load_user_dead_letters(state, user_id, limit=50):
     async with state.pool.acquire() as conn:
-        rows = await conn.fetch("SELECT * FROM referrals")
-    referrals = {}
-    for row in rows:
-        referrer_id = str(row["referrer_id"])
-        referred_id = str(row["referred_id"])
-        referrals.setdefault(referrer_id, []).append(referred_id)
-    return referrals
+        rows = await conn.fetch(
+            "SELECT * FROM dead_letters WHERE user_id = $1 ORDER BY failed_at DESC LIMIT $2",
+            int(user_id),
+            limit,
+        )
+    return [(row["message_key"], {**dict(row), "user_id": str(row["user_id"])}) for row in rows]
 
 
-async def save_referrals(state):
+async def load_legacy_dead_letters(state, blob_prefix, excluded_paths, limit):
     async with state.pool.acquire() as conn:
-        await conn.execute("DELETE FROM referrals")
-        for referrer_id, referred_ids in state.referrals.items():
-            for referred_id in referred_ids:
-                await conn.execute(
-                    """
-                    INSERT INTO referrals (referrer_id, referred_id)
-                    VALUES ($1, $2)
-                    """,
-                    int(referrer_id),
-                    int(referred_id),
-                )
+        rows = await conn.fetch(
+            """
+            SELECT message_key, file_path FROM dead_letters
+            WHERE file_path IS NOT NULL
+              AND LEFT(file_path, LENGTH($1)) <> $1
+              AND NOT (file_path = ANY($2::text[]))
+            LIMIT $3
+            """,
+            blob_prefix,
+            list(excluded_paths),
+            limit,
+        )
+    return [(row["message_key"], row["file_path"]) for row in rows]
+
+
+async def update_dead_letter_files(state, updates):
+    # updates: (message_key, старый путь, новый путь, размер); возвращает ключи, которые удалось обновить
+    updated = set()
+    async with state.pool.acquire() as conn:
+        async with conn.transaction():
+            for message_key, old_path, new_path, file_size in updates:
+                if await conn.fetchval(
+                    "UPDATE dead_letters SET file_path = $3, file_size = $4 WHERE message_key = $1 AND file_path = $2 RETURNING message_key",
+                    message_key,
+                    old_path,
+                    new_path,
+                    file_size,
+                ):
+                    updated.add(message_key)
+    return updated
+
+
+async def pop_dead_letter(state, user_id, message_key):
+    async with state.pool.acquire() as conn:
+        row = await conn.fetchrow(
+            "DELETE FROM dead_letters WHERE message_key = $1 AND user_id = $2 RETURNING *",
+            message_key,
+            int(user_id),
+        )
+    if not row:
+        return None
+    return {**dict(row), "user_id": str(row["user_id"])}
+
+
+async def delay_next_publish(state, user_id, due_at):
+    # Воркеры сами пишут next_publish_at, поэтому бот только отодвигает его, но не переносит назад
+    async with state.pool.acquire() as conn:
+        await conn.execute(
+            "UPDATE users SET next_publish_at = GREATEST(COALESCE(next_publish_at, 0), $2) WHERE user_id = $1",
+            int(user_id),
+            due_at,
+        )
+
+
+async def lease_due_posts(state, owner, limit, lease_ttl):
+    now = time.time()
+    async with state.pool.acquire() as conn:
+        async with conn.transaction():
+            # Берем только голову очереди каждого пользователя и только если у него нет поста в работе
+            rows = await conn.fetch(
+                """
+                UPDATE storage AS leased
+                SET lease_owner = $1, lease_expires_at = $2::double precision + $3::double precision
+                FROM (
+                    SELECT s.message_key
+                    FROM storage s
+                    JOIN users u ON u.user_id = s.user_id
+                    WHERE COALESCE(u.auto_publish, TRUE)
+                      AND u.publish_channel_id IS NOT NULL
+                      AND COALESCE(u.next_publish_at, COALESCE(u.last_published_at, 0) + $5::double precision) <= $2
+                      AND COALESCE(s.next_attempt_at, 0) <= $2
+                      AND COALESCE(s.media_status, 'ready') = 'ready'
+                      AND (s.lease_expires_at IS NULL OR s.lease_expires_at <= $2)
+                      AND NOT EXISTS (
+                          SELECT 1 FROM storage o
+                          WHERE o.user_id = s.user_id AND o.lease_expires_at > $2
+                      )
+                      AND NOT EXISTS (
+                          SELECT 1 FROM storage o
+                          WHERE o.user_id = s.user_id
+                            AND COALESCE(o.next_attempt_at, 0) <= $2
+                            AND COALESCE(o.media_status, 'ready') = 'ready'
+                            AND (COALESCE(o.created_at, 0), o.message_key) < (COALESCE(s.created_at, 0), s.message_key)
+                      )
+                    ORDER BY COALESCE(u.next_publish_at, 0)
+                    LIMIT $4
+                    FOR UPDATE OF s, u SKIP LOCKED
+                ) AS due
+                WHERE leased.message_key = due.message_key
+                RETURNING leased.*
+                """,
+                owner,
+                now,
+                lease_ttl,
+                limit,
+                AUTO_PUBLISH_DELAY_MIN,
+            )
+            user_rows = await conn.fetch(
+                "SELECT * FROM users WHERE user_id = ANY($1::bigint[])",
+                list({row["user_id"] for row in rows}),
+            )
+    users = {str(row["user_id"]): user_row_to_dict(row) for row in user_rows}
+    return [(row["message_key"], storage_row_to_dict(row)) for row in rows], users
+
+
+async def claim_post_lease(state, owner, message_key, lease_ttl):
+    now = time.time()
+    async with state.pool.acquire() as conn:
+        claimed = await conn.fetchval(
+            """
+            UPDATE storage SET lease_owner = $2, lease_expires_at = $3
+            WHERE message_key = $1 AND (lease_expires_at IS NULL OR lease_expires_at <= $4 OR lease_owner = $2)
+            RETURNING message_key
+            """,
+            message_key,
+            owner,
+            now + lease_ttl,
+            now,
+        )
+    return claimed is not None
+
+
+async def extend_post_leases(state, owner, message_keys, lease_ttl):
+    if not message_keys:
+        return
+    async with state.pool.acquire() as conn:
+        await conn.execute(
+            "UPDATE storage SET lease_expires_at = $3 WHERE lease_owner = $1 AND message_key = ANY($2::text[])",
+            owner,
+            list(message_keys),
+            time.time() + lease_ttl,
+        )
+
+
+async def release_post_lease(state, owner, message_key, data=None):
+    async with state.pool.acquire() as conn:
+        if data is None:
+            await conn.execute(
+                "UPDATE storage SET lease_owner = NULL, lease_expires_at = NULL WHERE message_key = $1 AND lease_owner = $2",
+                message_key,
+                owner,
+            )
+            return
+        await conn.execute(
+            """
+            UPDATE storage
+            SET lease_owner = NULL, lease_expires_at = NULL, attempts = $3, next_attempt_at = $4, last_error = $5
+            WHERE message_key = $1 AND lease_owner = $2
+            """,
+            message_key,
+            owner,
+            data.get("attempts") or 0,
+            data.get("next_attempt_at"),
+            data.get("last_error"),
+        )
+
+
+async def acknowledge_post(state, owner, message_key, user_id, published_at, next_publish_at):
+    async with state.pool.acquire() as conn:
+        async with conn.transaction():
+            deleted = await conn.fetchval(
+                "DELETE FROM storage WHERE message_key = $1 AND lease_owner = $2 RETURNING message_key",
+                message_key,
+                owner,
+            )
+            if deleted is None:
+                return False
+            await conn.execute(
+                "UPDATE users SET last_published_at = $2, next_publish_at = $3 WHERE user_id = $1",
+                int(user_id),
+                published_at,
+                next_publish_at,
+            )
+            await conn.execute("SELECT pg_notify($1, $2)", STORAGE_CHANGES_CHANNEL, message_key)
+    return True
+
+
+async def load_existing_storage_keys(state, message_keys):
+    async with state.pool.acquire() as conn:
+        rows = await conn.fetch("SELECT message_key FROM storage WHERE message_key = ANY($1::text[])", list(message_keys))
+    return {row["message_key"] for row in rows}
+
+
+async def load_dead_letter_keys(state, message_keys):
+    async with state.pool.acquire() as conn:
+        rows = await conn.fetch("SELECT message_key FROM dead_letters WHERE message_key = ANY($1::text[])", list(message_keys))
+    return {row["message_key"] for row in rows}
+
+
+async def listen_storage_changes(state, callback):
+    conn = await asyncpg.connect(dsn=DATABASE_URL)
+    await conn.add_listener(STORAGE_CHANGES_CHANNEL, lambda _conn, _pid, _channel, payload: callback(payload))
+    return conn
@@ -1,4 +1,3 @@
-import asyncio
 import logging
 
 from aiogram import F, Router
@@ -85,7 +84,6 @@ def create_admin_router(state):
                         "[Пустое сообщение]" if state.users[target_user_id].get("language", "ru") == "ru" else "[Empty message]" if state.users[target_user_id].get("language") == "en" else "[Bo'sh xabar]",
                     )
                 count += 1
-                await asyncio.sleep(0.04)
             except Exception:
                 errors += 1
 
@@ -131,7 +129,6 @@ def create_admin_router(state):
                 active += 1
             except Exception:
                 blocked += 1
-            await asyncio.sleep(0.04)
 
         text = get_translation(state, user_id, "admin_report").format(total, active, blocked, unknown)
         await call.message.answer(text)
@@ -6,11 +6,11 @@ from aiogram.types import CallbackQuery, ContentType, InlineKeyboardButton, Inli
 
 from translations import TRANSLATIONS
 
-from app.common import check_bot_is_admin, get_channel_link, get_translation, translation_value_exists, user_is_admin
-from app.database import save_referrals, save_users
+from app.common import check_bot_is_admin, get_cached_chat, get_translation, translation_value_exists, user_is_admin
 from app.keyboards import get_donate_menu, get_language_menu, get_main_menu, get_persistent_menu
 from app.panel_auth import ensure_panel_credentials, send_panel_access_message, update_panel_login, update_panel_password
-from app.queue import ensure_user_publish_task
+from app.scheduler import schedule_user_publish
+from app.write_behind import mark_referral_dirty, mark_user_dirty
 
 
 def create_general_router(state):
@@ -29,18 +29,20 @@ def create_general_router(state):
                 "language": None,
                 "hyperlink_enabled": True,
                 "last_published_at": 0,
+                "next_publish_at": None,
                 "panel_login": None,
                 "panel_password_hash": None,
                 "panel_password_salt": None,
+                "panel_api_token_hash": None,
             }
-            await save_users(state)
+            mark_user_dirty(state, user_id)
 
         parts = msg.text.strip().split()
         if len(parts) > 1 and is_new_user:
             referrer_id = parts[1]
-            if referrer_id != user_id and user_id not in state.referrals.get(referrer_id, []):
+            if referrer_id.isdigit() and referrer_id != user_id and user_id not in state.referrals.get(referrer_id, []):
                 state.referrals.setdefault(referrer_id, []).append(user_id)
-                await save_referrals(state)
+                mark_referral_dirty(state, referrer_id, user_id)
 
         _, generated_password = await ensure_panel_credentials(state, user_id)
         if generated_password:
@@ -59,7 +61,7 @@ def create_general_router(state):
         _, lang = call.data.split(":")
         if lang in TRANSLATIONS:
             state.users[user_id]["language"] = lang
-            await save_users(state)
+            mark_user_dirty(state, user_id, "language")
             await call.message.answer(
                 get_translation(state, user_id, "language_changed").format(TRANSLATIONS[lang]["select_language"].split(":")[0])
             )
@@ -128,7 +130,7 @@ def create_general_router(state):
         async def channel_title(channel_id):
             if not channel_id:
                 return get_translation(state, user_id, "channel_not_set")
-            chat = await state.bot.get_chat(channel_id)
+            chat = await get_cached_chat(state, channel_id)
             invite_link = user.get("publish_channel_invite_link")
             if invite_link:
                 link = invite_link
@@ -172,8 +174,8 @@ def create_general_router(state):
         user_id = str(call.from_user.id)
         user = state.users[user_id]
         user["auto_publish"] = not user.get("auto_publish", True)
-        await save_users(state)
-        ensure_user_publish_task(state, user_id)
+        mark_user_dirty(state, user_id, "auto_publish")
+        schedule_user_publish(state, user_id)
         await call.message.edit_reply_markup(reply_markup=get_main_menu(state, user_id))
         await call.answer(get_translation(state, user_id, "auto_publish_toggled"))
 
@@ -251,8 +253,11 @@ def create_general_router(state):
         user = state.users[user_id]
 
         try:
-            chat = await state.bot.get_chat(text)
+            # Канал могли переименовать или заново выдать права: берем свежие данные
+            state.chat_cache.invalidate(text)
+            chat = await get_cached_chat(state, text)
             channel_id = chat.id
+            state.chat_cache.invalidate(channel_id)
         except Exception:
             await msg.answer(get_translation(state, user_id, "channel_not_found"))
             return
@@ -278,22 +283,25 @@ def create_general_router(state):
             )
             state.users[user_id]["publish_channel_id"] = channel_id
             state.users[user_id]["publish_channel_invite_link"] = invite_link.invite_link
-            await save_users(state)
+            mark_user_dirty(state, user_id, "publish_channel_id", "publish_channel_invite_link")
+            schedule_user_publish(state, user_id)
             await msg.answer(get_translation(state, user_id, "publish_channel_added"), reply_markup=get_main_menu(state, user_id))
         except Exception as exc:
             logging.error(f"Failed to create invite link: {exc}")
             state.users[user_id]["publish_channel_id"] = channel_id
             state.users[user_id]["publish_channel_invite_link"] = None
-            await save_users(state)
+            mark_user_dirty(state, user_id, "publish_channel_id", "publish_channel_invite_link")
+            schedule_user_publish(state, user_id)
             await msg.answer(get_translation(state, user_id, "publish_channel_added_no_link"), reply_markup=get_main_menu(state, user_id))
 
     @router.callback_query(F.data == "confirm_reset_channels")
     async def perform_reset_channels(call: CallbackQuery):
         user_id = str(call.from_user.id)
+        state.chat_cache.invalidate(state.users[user_id].get("publish_channel_id"))
         state.users[user_id]["publish_channel_id"] = None
         state.users[user_id]["temp_channel_id"] = None
         state.users[user_id]["publish_channel_invite_link"] = None
-        await save_users(state)
+        mark_user_dirty(state, user_id, "publish_channel_id", "temp_channel_id", "publish_channel_invite_link")
         await call.message.edit_text(get_translation(state, user_id, "channels_reset"), reply_markup=get_main_menu(state, user_id))
         await call.answer(get_translation(state, user_id, "channels_reset"))
 
@@ -308,7 +316,7 @@ def create_general_router(state):
         user_id = str(call.from_user.id)
         user = state.users[user_id]
         user["hyperlink_enabled"] = not user.get("hyperlink_enabled", True)
-        await save_users(state)
+        mark_user_dirty(state, user_id, "hyperlink_enabled")
         await call.message.edit_reply_markup(reply_markup=get_main_menu(state, user_id))
         hyperlink_state = get_translation(state, user_id, "hyperlink_on") if user["hyperlink_enabled"] else get_translation(state, user_id, "hyperlink_off")
         await call.answer(get_translation(state, user_id, "hyperlink_toggled").format(hyperlink_state))
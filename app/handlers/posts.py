@@ -5,10 +5,18 @@ from aiogram import F, Router
 from aiogram.types import CallbackQuery, Message
 
 from app.common import get_translation, translation_value_exists
-from app.config import MAX_QUEUE_SIZE_PER_USER
-from app.database import save_storage
-from app.media_storage import get_message_media_payload, store_media_locally
-from app.queue import cleanup_stored_message, ensure_user_publish_task, send_to_channel, touch_last_published
+from app.config import MAX_MEDIA_MB_PER_USER, MAX_QUEUE_SIZE_PER_USER, MEDIA_COPY_MODE
+from app.media_downloads import enqueue_media_download
+from app.media_storage import get_message_media_payload
+from app.queue import (
+    add_storage_item,
+    claim_storage_items,
+    cleanup_stored_message,
+    get_media_quota_remaining,
+    get_user_queue_size,
+    remove_storage_item,
+)
+from app.scheduler import publish_post_now, schedule_user_publish
 
 
 def create_posts_router(state):
@@ -33,49 +41,49 @@ def create_posts_router(state):
             return
 
         # Проверка размера очереди
-        user_posts_count = sum(1 for key, data in state.storage.items() if data["user_id"] == user_id)
-        if user_posts_count >= MAX_QUEUE_SIZE_PER_USER:
+        if get_user_queue_size(state, user_id) >= MAX_QUEUE_SIZE_PER_USER:
             await msg.answer(get_translation(state, user_id, "queue_full").format(MAX_QUEUE_SIZE_PER_USER))
             return
 
         text = msg.caption if msg.caption else (msg.text or "")
-        file_id, file_type, original_file_name, mime_type = get_message_media_payload(msg)
+        file_id, file_type, original_file_name, _ = get_message_media_payload(msg)
         if not text and not file_id:
             await msg.answer(get_translation(state, user_id, "draft_error"))
             return
 
         message_key = f"{user_id}:{msg.message_id}"
-        file_path = None
-        if file_id and file_type:
-            try:
-                file_path, original_file_name = await store_media_locally(
-                    state,
-                    user_id,
-                    message_key,
-                    file_id,
-                    file_type,
-                    original_file_name,
-                    mime_type,
-                )
-            except Exception as exc:
-                logging.error(f"Ошибка локального сохранения медиа: {exc}")
-                await msg.answer(get_translation(state, user_id, "draft_error"))
-                return
+        # В режиме копирования исходное сообщение остается источником публикации и не скачивается
+        copy_mode = MEDIA_COPY_MODE and bool(file_id and file_type)
+        # Остальное медиа скачивается в фоне, до этого пост ждет в очереди со статусом pending
+        needs_download = bool(file_id and file_type) and not copy_mode
+        quota_remaining = get_media_quota_remaining(state, user_id)
+        if needs_download and quota_remaining is not None and quota_remaining <= 0:
+            await msg.answer(get_translation(state, user_id, "media_quota_full").format(MAX_MEDIA_MB_PER_USER))
+            return
 
-        state.storage[message_key] = {
+        add_storage_item(state, message_key, {
             "user_id": user_id,
             "text": text,
-            "file_id": None,
-            "file_path": file_path,
+            "file_id": file_id if file_type else None,
+            "file_path": None,
             "original_file_name": original_file_name,
             "file_type": file_type,
             "temp_msg_id": None,
             "created_at": time.time(),
-        }
-        await save_storage(state)
-        ensure_user_publish_task(state, user_id)
+            "content_hash": None,
+            "source_chat_id": msg.chat.id if copy_mode else None,
+            "source_message_id": msg.message_id if copy_mode else None,
+            "media_status": "pending" if needs_download else None,
+            "media_attempts": 0,
+            "media_error": None,
+        })
+        if needs_download:
+            enqueue_media_download(state, message_key)
+        schedule_user_publish(state, user_id)
         await msg.answer(get_translation(state, user_id, "post_scheduled"))
 
+        if copy_mode:
+            return
         try:
             await state.bot.delete_message(msg.chat.id, msg.message_id)
         except Exception as exc:
@@ -89,21 +97,8 @@ def create_posts_router(state):
             await call.answer(get_translation(state, user_id, "task_not_found"))
             return
 
-        data = state.storage[message_key]
         try:
-            await send_to_channel(
-                state,
-                target_user_id,
-                data["text"],
-                data.get("file_id"),
-                data.get("file_type"),
-                data.get("file_path"),
-                data.get("original_file_name"),
-            )
-            await cleanup_stored_message(state, data)
-            del state.storage[message_key]
-            await save_storage(state)
-            await touch_last_published(state, target_user_id)
+            await publish_post_now(state, message_key)
             await call.answer(get_translation(state, user_id, "publish_now"))
         except Exception as exc:
             logging.error(f"Ошибка ручной публикации: {exc}")
@@ -116,10 +111,12 @@ def create_posts_router(state):
         if message_key not in state.storage or state.storage[message_key]["user_id"] != target_user_id:
             await call.answer(get_translation(state, user_id, "task_already_removed"), show_alert=True)
             return
+        if not await claim_storage_items(state, [message_key]):
+            await call.answer(get_translation(state, user_id, "task_busy"), show_alert=True)
+            return
         try:
             await cleanup_stored_message(state, state.storage[message_key])
-            del state.storage[message_key]
-            await save_storage(state)
+            await remove_storage_item(state, message_key)
             await call.answer(get_translation(state, user_id, "task_removed"), show_alert=True)
         except Exception as exc:
             await call.answer(get_translation(state, user_id, "task_remove_error").format(exc), show_alert=True)
@@ -4,7 +4,7 @@ from aiogram import F, Router
 from aiogram.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Message
 from aiogram.utils.deep_linking import create_start_link
 
-from app.common import escape_user_name, get_translation
+from app.common import escape_user_name, get_cached_chat, get_translation
 
 
 def create_referrals_router(state):
@@ -40,7 +40,7 @@ def create_referrals_router(state):
         top_text = ""
         for position, (uid, count) in enumerate(leaderboard[:10], start=1):
             try:
-                user = await state.bot.get_chat(uid)
+                user = await get_cached_chat(state, uid)
                 name = escape_user_name(user.full_name)
             except Exception:
                 if state.users[user_id].get("language", "ru") == "ru":
@@ -0,0 +1,85 @@
+import asyncio
+import hashlib
+import importlib.util
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .config import IMAGE_JPEG_QUALITY, IMAGE_MAX_DIMENSION, IMAGE_PREPROCESS, IMAGE_PROCESS_WORKERS, IMAGE_THUMBNAIL_SIZE
+
+
+def is_image_processing_enabled():
+    # Pillow — необязательная зависимость: без него фото сохраняются как есть
+    return IMAGE_PREPROCESS and importlib.util.find_spec("PIL") is not None
+
+
+def optimize_image_file(source_path, optimized_path, thumbnail_path, max_dimension, quality, thumbnail_size):
+    # Выполняется в отдельном процессе, поэтому Pillow импортируется здесь
+    from PIL import Image, ImageOps
+
+    try:
+        with Image.open(source_path) as image:
+            if getattr(image, "is_animated", False):
+                return None, False
+            has_metadata = bool(image.info.get("exif") or image.info.get("xmp") or image.getexif())
+            # Поворот из EXIF применяется до того, как метаданные будут отброшены
+            image = ImageOps.exif_transpose(image)
+            if image.mode != "RGB":
+                background = Image.new("RGB", image.size, "white")
+                background.paste(image, mask=image.convert("RGBA").getchannel("A"))
+                image = background
+            resized = max(image.size) > max_dimension
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            image.save(optimized_path, "JPEG", quality=quality, optimize=True, progressive=True)
+
+            thumbnail = image.copy()
+            thumbnail.thumbnail((thumbnail_size, thumbnail_size), Image.LANCZOS)
+            thumbnail.save(thumbnail_path, "JPEG", quality=80, optimize=True)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None, False
+
+    with open(source_path, "rb") as source:
+        source_size = source.seek(0, 2)
+    with open(optimized_path, "rb") as optimized:
+        optimized_bytes = optimized.read()
+    # Уже сжатое фото без метаданных повторно не перекодируем, но миниатюру оставляем
+    if not resized and not has_metadata and len(optimized_bytes) >= source_size:
+        return None, True
+    return hashlib.sha256(optimized_bytes).hexdigest(), True
+
+
+def get_image_executor(state):
+    if state.image_executor is None:
+        state.image_executor = ProcessPoolExecutor(IMAGE_PROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return state.image_executor
+
+
+async def preprocess_image(state, source_path, optimized_path, thumbnail_path):
+    executor = get_image_executor(state)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            executor,
+            optimize_image_file,
+            str(source_path),
+            str(optimized_path),
+            str(thumbnail_path),
+            IMAGE_MAX_DIMENSION,
+            IMAGE_JPEG_QUALITY,
+            IMAGE_THUMBNAIL_SIZE,
+        )
+    except BrokenProcessPool as exc:
+        # Процесс пула упал (например, по нехватке памяти): следующий вызов создаст новый пул
+        logging.error(f"Пул обработки изображений сломан, он будет пересоздан: {exc}")
+        if state.image_executor is executor:
+            stop_image_executor(state)
+        return None, False
+    except Exception as exc:
+        logging.warning(f"Не удалось обработать изображение {source_path}: {exc}")
+        return None, False
+
+
+def stop_image_executor(state):
+    if state.image_executor is not None:
+        state.image_executor.shutdown(wait=False, cancel_futures=True)
+        state.image_executor = None
@@ -0,0 +1,199 @@
+import asyncio
+import os
+import shutil
+from contextlib import AsyncExitStack
+from pathlib import Path
+
+from .config import (
+    MEDIA_BACKEND,
+    MEDIA_ROOT,
+    S3_ACCESS_KEY_ID,
+    S3_BUCKET,
+    S3_ENDPOINT_URL,
+    S3_REGION,
+    S3_SECRET_ACCESS_KEY,
+)
+
+STREAM_CHUNK_SIZE = 256 * 1024
+
+
+def read_file_chunk(file, size):
+    return file.read(size)
+
+
+def list_local_objects(root, prefix):
+    directory = root / prefix
+    if not directory.exists():
+        return {}
+    objects = {}
+    for path in directory.rglob("*"):
+        if path.is_file():
+            stat = path.stat()
+            objects[path.relative_to(root).as_posix()] = (stat.st_mtime, stat.st_size)
+    return objects
+
+
+def move_file_if_missing(source_path, target_path):
+    if target_path.exists():
+        Path(source_path).unlink(missing_ok=True)
+        return
+    target_path.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(source_path, target_path)
+
+
+class LocalMediaBackend:
+    is_local = True
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def get_path(self, key):
+        return self.root / key
+
+    async def put(self, key, source_path):
+        # Объекты неизменяемы: если ключ уже есть, новый файл просто отбрасывается
+        await asyncio.to_thread(move_file_if_missing, source_path, self.get_path(key))
+
+    async def get(self, key, destination_path):
+        path = self.get_path(key)
+        if not path.exists():
+            raise FileNotFoundError(key)
+        await asyncio.to_thread(shutil.copyfile, path, destination_path)
+
+    async def stream(self, key, chunk_size=STREAM_CHUNK_SIZE):
+        path = self.get_path(key)
+        if not path.exists():
+            raise FileNotFoundError(key)
+        file = await asyncio.to_thread(open, path, "rb")
+        try:
+            while chunk := await asyncio.to_thread(read_file_chunk, file, chunk_size):
+                yield chunk
+        finally:
+            await asyncio.to_thread(file.close)
+
+    async def delete(self, key):
+        await asyncio.to_thread(self.get_path(key).unlink, missing_ok=True)
+
+    async def exists(self, key):
+        return self.get_path(key).exists()
+
+    async def list(self, prefix):
+        return await asyncio.to_thread(list_local_objects, self.root, prefix)
+
+    async def close(self):
+        pass
+
+
+class S3MediaBackend:
+    is_local = False
+
+    def __init__(self, bucket, endpoint_url=None, region_name=None, access_key_id=None, secret_access_key=None):
+        # aioboto3 — необязательная зависимость, нужна только при MEDIA_BACKEND=s3
+        try:
+            import aioboto3
+            from botocore.exceptions import ClientError
+        except ImportError as exc:
+            raise RuntimeError("Для MEDIA_BACKEND=s3 установите пакет aioboto3") from exc
+
+        self.bucket = bucket
+        self.client_error = ClientError
+        self.session = aioboto3.Session()
+        self.client_options = {
+            "endpoint_url": endpoint_url,
+            "region_name": region_name,
+            "aws_access_key_id": access_key_id,
+            "aws_secret_access_key": secret_access_key,
+        }
+        self.client = None
+        self.client_lock = asyncio.Lock()
+        self.exit_stack = None
+
+    async def get_client(self):
+        if self.client is None:
+            async with self.client_lock:
+                if self.client is None:
+                    self.exit_stack = AsyncExitStack()
+                    client = await self.exit_stack.enter_async_context(self.session.client("s3", **self.client_options))
+                    await self.ensure_bucket(client)
+                    self.client = client
+        return self.client
+
+    async def ensure_bucket(self, client):
+        try:
+            await client.head_bucket(Bucket=self.bucket)
+        except Exception as exc:
+            if not self.is_missing_error(exc):
+                raise
+            await client.create_bucket(Bucket=self.bucket)
+
+    def is_missing_error(self, exc):
+        return isinstance(exc, self.client_error) and exc.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+    async def put(self, key, source_path):
+        client = await self.get_client()
+        await client.upload_file(str(source_path), self.bucket, key)
+
+    async def get(self, key, destination_path):
+        client = await self.get_client()
+        try:
+            await client.download_file(self.bucket, key, str(destination_path))
+        except Exception as exc:
+            if self.is_missing_error(exc):
+                raise FileNotFoundError(key) from exc
+            raise
+
+    async def stream(self, key, chunk_size=STREAM_CHUNK_SIZE):
+        client = await self.get_client()
+        try:
+            response = await client.get_object(Bucket=self.bucket, Key=key)
+        except Exception as exc:
+            if self.is_missing_error(exc):
+                raise FileNotFoundError(key) from exc
+            raise
+        body = response["Body"]
+        try:
+            while chunk := await body.read(chunk_size):
+                yield chunk
+        finally:
+            body.close()
+
+    async def delete(self, key):
+        client = await self.get_client()
+        await client.delete_object(Bucket=self.bucket, Key=key)
+
+    async def exists(self, key):
+        client = await self.get_client()
+        try:
+            await client.head_object(Bucket=self.bucket, Key=key)
+        except Exception as exc:
+            if self.is_missing_error(exc):
+                return False
+            raise
+        return True
+
+    async def list(self, prefix):
+        client = await self.get_client()
+        objects = {}
+        paginator = client.get_paginator("list_objects_v2")
+        async for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get("Contents", ()):
+                objects[item["Key"]] = (item["LastModified"].timestamp(), item["Size"])
+        return objects
+
+    async def close(self):
+        if self.exit_stack:
+            await self.exit_stack.aclose()
+            self.exit_stack = None
+            self.client = None
+
+
+def create_media_backend():
+    if MEDIA_BACKEND == "s3":
+        return S3MediaBackend(
+            S3_BUCKET,
+            endpoint_url=S3_ENDPOINT_URL,
+            region_name=S3_REGION,
+            access_key_id=S3_ACCESS_KEY_ID,
+            secret_access_key=S3_SECRET_ACCESS_KEY,
+        )
+    return LocalMediaBackend(MEDIA_ROOT)
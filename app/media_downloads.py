@@ -0,0 +1,154 @@
+import asyncio
+import logging
+from collections import deque
+
+from aiogram.exceptions import TelegramBadRequest, TelegramEntityTooLarge, TelegramNotFound, TelegramRetryAfter
+
+from .config import MEDIA_DOWNLOAD_MAX_ATTEMPTS, MEDIA_DOWNLOAD_RETRY_DELAY, MEDIA_DOWNLOAD_WORKERS
+from .media_storage import release_blob, store_media_locally
+from .queue import change_media_usage, get_media_quota_remaining, get_user_storage_items
+from .scheduler import schedule_user_publish
+from .write_behind import bump_queue_version, mark_storage_dirty
+
+PERMANENT_DOWNLOAD_ERRORS = (TelegramBadRequest, TelegramNotFound, TelegramEntityTooLarge)
+
+
+def get_media_status(state, message_key):
+    data = state.storage.get(message_key) or {}
+    status = data.get("media_status") or "ready"
+    if status == "pending" and message_key in state.media_downloads_active:
+        return "downloading"
+    return status
+
+
+def enqueue_media_download(state, message_key):
+    data = state.storage.get(message_key)
+    if not data or data.get("media_status") != "pending":
+        return
+    user_id = data["user_id"]
+    user_queue = state.media_download_queues.get(user_id)
+    if user_queue is None:
+        user_queue = state.media_download_queues[user_id] = deque()
+        state.media_download_order.append(user_id)
+    user_queue.append(message_key)
+    state.media_download_event.set()
+
+
+def pop_next_download(state):
+    # Пользователи обслуживаются по кругу, чтобы пачка файлов одного пользователя не занимала все слоты
+    if not state.media_download_order:
+        return None
+    user_id = state.media_download_order.popleft()
+    user_queue = state.media_download_queues[user_id]
+    message_key = user_queue.popleft()
+    if user_queue:
+        state.media_download_order.append(user_id)
+    else:
+        del state.media_download_queues[user_id]
+    return message_key
+
+
+def handle_media_download_failure(state, message_key, data, exc):
+    data["media_attempts"] = (data.get("media_attempts") or 0) + 1
+    data["media_error"] = f"{type(exc).__name__}: {exc}"[:500]
+    if isinstance(exc, PERMANENT_DOWNLOAD_ERRORS) or data["media_attempts"] >= MEDIA_DOWNLOAD_MAX_ATTEMPTS:
+        data["media_status"] = "failed"
+        logging.error(f"Не удалось загрузить медиа для {message_key}: {data['media_error']}")
+    else:
+        if isinstance(exc, TelegramRetryAfter):
+            delay = exc.retry_after
+        else:
+            delay = MEDIA_DOWNLOAD_RETRY_DELAY * 2 ** (data["media_attempts"] - 1)
+        asyncio.get_running_loop().call_later(delay, enqueue_media_download, state, message_key)
+        logging.warning(f"Ошибка загрузки медиа {message_key}, повтор через {delay} сек: {data['media_error']}")
+    mark_storage_dirty(state, message_key)
+
+
+async def download_post_media(state, message_key):
+    data = state.storage.get(message_key)
+    if not data or data.get("media_status") != "pending":
+        return
+
+    state.media_downloads_active.add(message_key)
+    bump_queue_version(state, data["user_id"])
+    try:
+        file_path, original_file_name, content_hash, file_size = await store_media_locally(
+            state,
+            data["user_id"],
+            message_key,
+            data["file_id"],
+            data["file_type"],
+            data.get("original_file_name"),
+        )
+    except Exception as exc:
+        if state.storage.get(message_key) is data:
+            handle_media_download_failure(state, message_key, data, exc)
+        return
+    finally:
+        state.media_downloads_active.discard(message_key)
+
+    if state.storage.get(message_key) is not data:
+        # Пост удалили или уже опубликовали по file_id, пока шла загрузка
+        await release_blob(state, file_path)
+        return
+
+    quota_remaining = get_media_quota_remaining(state, data["user_id"])
+    if quota_remaining is not None and file_size > quota_remaining:
+        await release_blob(state, file_path)
+        data.update(media_status="failed", media_error="Превышена квота на медиафайлы")
+        mark_storage_dirty(state, message_key)
+        return
+
+    data.update(
+        file_id=None,
+        file_path=file_path,
+        original_file_name=original_file_name,
+        content_hash=content_hash,
+        file_size=file_size,
+        media_status="ready",
+        media_error=None,
+    )
+    change_media_usage(state, data["user_id"], file_size)
+    mark_storage_dirty(state, message_key)
+    schedule_user_publish(state, data["user_id"])
+
+
+def retry_media_download(state, message_key):
+    data = state.storage.get(message_key)
+    if not data or data.get("media_status") != "failed":
+        return False
+    data.update(media_status="pending", media_attempts=0, media_error=None)
+    mark_storage_dirty(state, message_key)
+    enqueue_media_download(state, message_key)
+    return True
+
+
+async def run_media_download_worker(state):
+    while True:
+        message_key = pop_next_download(state)
+        if message_key is None:
+            state.media_download_event.clear()
+            await state.media_download_event.wait()
+            continue
+        try:
+            await download_post_media(state, message_key)
+        except Exception as exc:
+            logging.error(f"Ошибка воркера загрузки медиа: {exc}")
+
+
+def start_media_downloads(state):
+    # Загрузки, прерванные перезапуском, продолжаются в исходном порядке очередей
+    for user_id in list(state.queue_index):
+        for message_key, data in get_user_storage_items(state, user_id):
+            if data.get("media_status") == "pending":
+                enqueue_media_download(state, message_key)
+    state.media_download_tasks = [
+        asyncio.create_task(run_media_download_worker(state)) for _ in range(MEDIA_DOWNLOAD_WORKERS)
+    ]
+
+
+async def stop_media_downloads(state):
+    for task in state.media_download_tasks:
+        task.cancel()
+    await asyncio.gather(*state.media_download_tasks, return_exceptions=True)
+    state.media_download_tasks = []
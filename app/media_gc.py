@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import time
+
+from .config import MEDIA_BLOB_ROOT, MEDIA_CACHE_TTL, MEDIA_GC_GRACE, MEDIA_GC_INTERVAL, MEDIA_ROOT, MEDIA_TMP_ROOT
+from .database import count_media_references, load_media_blob_shard, load_media_usage, reconcile_media_blob
+from .media_storage import delete_blob_object, get_blob_path
+from .write_behind import flush_pending_writes
+
+TMP_SHARD = "tmp"
+
+
+def list_gc_shards():
+    # Один шард — один подкаталог blobs/xx, каталог временных файлов или старая папка пользователя
+    shards = [TMP_SHARD]
+    shards.extend(f"blobs/{index:02x}" for index in range(256))
+    shards.extend(f"users/{path.name}" for path in sorted(MEDIA_ROOT.iterdir()) if path.is_dir() and path.name.isdigit())
+    return shards
+
+
+def list_shard_files(directory):
+    if not directory.exists():
+        return {}
+    return {path: path.stat().st_mtime for path in directory.rglob("*") if path.is_file()}
+
+
+def list_cached_files(directory):
+    # Время последнего чтения кэш хранит в atime
+    if not directory.exists():
+        return {}
+    files = {}
+    for path in directory.rglob("*"):
+        if path.is_file():
+            stat = path.stat()
+            files[path] = max(stat.st_atime, stat.st_mtime)
+    return files
+
+
+async def collect_tmp_shard(stale_before):
+    removed = 0
+    for path, mtime in (await asyncio.to_thread(list_shard_files, MEDIA_TMP_ROOT)).items():
+        if mtime < stale_before:
+            path.unlink(missing_ok=True)
+            removed += 1
+    return removed
+
+
+async def evict_cached_blobs(prefix):
+    # При внешнем хранилище локальные блобы — только кэш: давно не читанные файлы удаляются
+    evicted = 0
+    cached_before = time.time() - MEDIA_CACHE_TTL
+    for path, used_at in (await asyncio.to_thread(list_cached_files, MEDIA_BLOB_ROOT / prefix)).items():
+        if used_at < cached_before:
+            path.unlink(missing_ok=True)
+            evicted += 1
+    return evicted
+
+
+async def collect_blob_shard(state, prefix, stale_before):
+    objects = await state.media_backend.list(f"blobs/{prefix}/")
+    blob_objects = {key.rsplit("/", 1)[-1]: (mtime, size) for key, (mtime, size) in objects.items()}
+    blob_rows = await load_media_blob_shard(state, prefix)
+    references = await count_media_references(state, f"{MEDIA_BLOB_ROOT / prefix}/")
+
+    fixed = 0
+    for content_hash in set(blob_objects) | set(blob_rows):
+        stored = blob_objects.get(content_hash)
+        row = blob_rows.get(content_hash)
+        if stored and not row and stored[0] > stale_before:
+            continue
+        refcount = references.get(str(get_blob_path(content_hash)), 0)
+        if row and row["refcount"] == refcount and (stored or refcount):
+            continue
+        if stored is None and refcount:
+            logging.warning(f"Файл медиа {content_hash} отсутствует, но на него ссылаются {refcount} постов")
+            continue
+        if await reconcile_media_blob(
+            state,
+            content_hash,
+            stored[1] if stored else 0,
+            refcount,
+            stale_before,
+            lambda content_hash=content_hash: delete_blob_object(state, content_hash),
+        ):
+            fixed += 1
+
+    if not state.media_backend.is_local:
+        fixed += await evict_cached_blobs(prefix)
+    return fixed
+
+
+async def collect_user_shard(state, user_dir, stale_before):
+    # Файлы старой раскладки MEDIA_ROOT/<user_id>/, на которые не ссылается ни один пост
+    files = await asyncio.to_thread(list_shard_files, MEDIA_ROOT / user_dir)
+    references = await count_media_references(state, f"{MEDIA_ROOT / user_dir}/")
+    removed = 0
+    for path, mtime in files.items():
+        if mtime < stale_before and str(path) not in references:
+            await asyncio.to_thread(path.unlink, missing_ok=True)
+            removed += 1
+    return removed
+
+
+async def run_media_gc_step(state):
+    if not state.media_gc_shards:
+        # Полный круг по шардам завершен: заодно сверяем счетчики занятого места с базой
+        await flush_pending_writes(state)
+        state.media_usage = await load_media_usage(state)
+        state.media_gc_shards.extend(await asyncio.to_thread(list_gc_shards))
+        return
+
+    shard = state.media_gc_shards.popleft()
+    # Ссылки из памяти должны попасть в базу до сверки
+    await flush_pending_writes(state)
+    stale_before = time.time() - MEDIA_GC_GRACE
+    if shard == TMP_SHARD:
+        cleaned = await collect_tmp_shard(stale_before)
+    elif shard.startswith("blobs/"):
+        cleaned = await collect_blob_shard(state, shard.removeprefix("blobs/"), stale_before)
+    else:
+        cleaned = await collect_user_shard(state, shard.removeprefix("users/"), stale_before)
+    if cleaned:
+        logging.info(f"Сборка мусора медиа: шард {shard}, исправлено или удалено {cleaned}")
+
+
+async def run_media_gc(state):
+    while True:
+        await asyncio.sleep(MEDIA_GC_INTERVAL)
+        try:
+            await run_media_gc_step(state)
+        except Exception as exc:
+            logging.error(f"Ошибка сборки мусора медиа: {exc}")
+
+
+def start_media_gc(state):
+    state.media_gc_task = asyncio.create_task(run_media_gc(state))
+
+
+async def stop_media_gc(state):
+    if state.media_gc_task:
+        state.media_gc_task.cancel()
+        await asyncio.gather(state.media_gc_task, return_exceptions=True)
+        state.media_gc_task = None
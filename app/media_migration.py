@@ -0,0 +1,149 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import deque
+from pathlib import Path
+
+from .config import MEDIA_BLOB_ROOT, MEDIA_MIGRATION_BATCH, MEDIA_MIGRATION_INTERVAL, PUBLISHER_LEASE_TTL
+from .database import load_legacy_dead_letters, update_dead_letter_files
+from .media_storage import HASH_CHUNK_SIZE, build_temp_path, commit_blob, is_blob_path, release_blob
+from .queue import change_media_usage
+from .write_behind import flush_pending_writes, mark_storage_dirty
+
+
+def copy_file_with_hash(source_path, destination_path):
+    digest = hashlib.sha256()
+    with open(source_path, "rb") as source, open(destination_path, "wb") as destination:
+        while chunk := source.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+            destination.write(chunk)
+    return digest.hexdigest()
+
+
+def get_legacy_storage_keys(state):
+    return deque(
+        message_key
+        for message_key, data in state.storage.items()
+        if data.get("file_path") and not is_blob_path(data["file_path"])
+    )
+
+
+async def copy_into_blob_store(state, legacy_path):
+    temp_path = build_temp_path()
+    try:
+        content_hash = await asyncio.to_thread(copy_file_with_hash, legacy_path, temp_path)
+        blob_path, content_hash, file_size = await commit_blob(state, temp_path, content_hash)
+    finally:
+        temp_path.unlink(missing_ok=True)
+    return str(blob_path), content_hash, file_size
+
+
+def schedule_legacy_delete(state, legacy_path):
+    # Старый файл удаляется с задержкой: воркер публикации мог прочитать путь до переключения
+    state.media_migration_deletes.append((time.time() + PUBLISHER_LEASE_TTL, legacy_path))
+
+
+def delete_expired_legacy_files(state):
+    now = time.time()
+    while state.media_migration_deletes and state.media_migration_deletes[0][0] <= now:
+        _, legacy_path = state.media_migration_deletes.popleft()
+        Path(legacy_path).unlink(missing_ok=True)
+
+
+async def migrate_storage_item(state, message_key):
+    data = state.storage.get(message_key)
+    legacy_path = data.get("file_path") if data else None
+    if not legacy_path or is_blob_path(legacy_path):
+        return False
+    if not Path(legacy_path).exists():
+        state.media_migration_skipped.add(legacy_path)
+        return False
+
+    blob_path, content_hash, file_size = await copy_into_blob_store(state, legacy_path)
+    if state.storage.get(message_key) is not data or data.get("file_path") != legacy_path:
+        # Пост опубликовали или удалили, пока файл копировался
+        await release_blob(state, blob_path)
+        return False
+
+    change_media_usage(state, data["user_id"], file_size - (data.get("file_size") or 0))
+    data.update(file_path=blob_path, content_hash=data.get("content_hash") or content_hash, file_size=file_size)
+    mark_storage_dirty(state, message_key)
+    schedule_legacy_delete(state, legacy_path)
+    return True
+
+
+async def migrate_dead_letters(state, limit):
+    rows = await load_legacy_dead_letters(state, f"{MEDIA_BLOB_ROOT}/", state.media_migration_skipped, limit)
+    updates = []
+    for message_key, legacy_path in rows:
+        if not Path(legacy_path).exists():
+            state.media_migration_skipped.add(legacy_path)
+            continue
+        try:
+            blob_path, _, file_size = await copy_into_blob_store(state, legacy_path)
+        except Exception as exc:
+            logging.warning(f"Не удалось перенести файл {legacy_path}: {exc}")
+            state.media_migration_skipped.add(legacy_path)
+            continue
+        updates.append((message_key, legacy_path, blob_path, file_size))
+
+    updated = await update_dead_letter_files(state, updates) if updates else set()
+    for message_key, legacy_path, blob_path, _ in updates:
+        if message_key in updated:
+            schedule_legacy_delete(state, legacy_path)
+        else:
+            await release_blob(state, blob_path)
+    return len(rows)
+
+
+async def run_media_migration_batch(state, storage_keys):
+    migrated = 0
+    while storage_keys and migrated < MEDIA_MIGRATION_BATCH:
+        message_key = storage_keys.popleft()
+        try:
+            if await migrate_storage_item(state, message_key):
+                migrated += 1
+        except Exception as exc:
+            logging.warning(f"Не удалось перенести файл поста {message_key}: {exc}")
+    if migrated:
+        # Новые пути постов записываются в базу одной транзакцией на пачку
+        await flush_pending_writes(state)
+    dead_letter_rows = 0
+    if not storage_keys and migrated < MEDIA_MIGRATION_BATCH:
+        dead_letter_rows = await migrate_dead_letters(state, MEDIA_MIGRATION_BATCH - migrated)
+    return migrated + dead_letter_rows
+
+
+async def run_media_migration(state):
+    storage_keys = get_legacy_storage_keys(state)
+    if storage_keys:
+        logging.info(f"Перенос медиа в новую раскладку: {len(storage_keys)} постов в очереди")
+    while True:
+        delete_expired_legacy_files(state)
+        try:
+            processed = await run_media_migration_batch(state, storage_keys)
+        except Exception as exc:
+            logging.error(f"Ошибка переноса медиа: {exc}")
+            processed = 1
+        if not processed and not storage_keys:
+            break
+        await asyncio.sleep(MEDIA_MIGRATION_INTERVAL)
+
+    # Дожидаемся отложенного удаления старых файлов
+    while state.media_migration_deletes:
+        await asyncio.sleep(max(0, state.media_migration_deletes[0][0] - time.time()))
+        delete_expired_legacy_files(state)
+    if state.media_migration_skipped:
+        logging.warning(f"Перенос медиа завершен, пропущено файлов: {len(state.media_migration_skipped)}")
+
+
+def start_media_migration(state):
+    state.media_migration_task = asyncio.create_task(run_media_migration(state))
+
+
+async def stop_media_migration(state):
+    if state.media_migration_task:
+        state.media_migration_task.cancel()
+        await asyncio.gather(state.media_migration_task, return_exceptions=True)
+        state.media_migration_task = None
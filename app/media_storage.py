@@ -1,11 +1,26 @@
+import asyncio
+import hashlib
 import logging
 import mimetypes
+import os
 import re
+import secrets
+import time
 from pathlib import Path
 
-from aiogram.types import FSInputFile
+from aiogram.types import FSInputFile, InputFile
 
-from .config import DEFAULT_EXTENSIONS, MEDIA_ROOT, MAX_FILE_SIZE_MB
+from .config import DEFAULT_EXTENSIONS, MAX_FILE_SIZE_MB, MEDIA_BLOB_ROOT, MEDIA_ROOT, MEDIA_TMP_ROOT
+from .database import acquire_media_blob, delete_media_file_id, release_media_blob, save_media_file_id
+from .image_processing import is_image_processing_enabled, preprocess_image
+from .media_backends import move_file_if_missing
+
+HASH_CHUNK_SIZE = 1024 * 1024
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+
+class UploadTooLargeError(ValueError):
+    pass
 
 
 def sanitize_filename(file_name):
@@ -36,13 +51,176 @@ def get_message_media_payload(msg):
     return None, None, None, None
 
 
+def build_temp_path():
+    MEDIA_TMP_ROOT.mkdir(parents=True, exist_ok=True)
+    return MEDIA_TMP_ROOT / f"{secrets.token_hex(16)}.part"
+
+
+def get_blob_key(content_hash):
+    return f"blobs/{content_hash[:2]}/{content_hash[2:4]}/{content_hash}"
+
+
+def get_blob_path(content_hash):
+    # Для локального бэкенда это сам объект, для S3 — место в локальном кэше
+    return MEDIA_BLOB_ROOT / content_hash[:2] / content_hash[2:4] / content_hash
+
+
+def get_thumbnail_key(content_hash):
+    return f"thumbs/{content_hash[:2]}/{content_hash[2:4]}/{content_hash}.jpg"
+
+
+def get_thumbnail_path(content_hash):
+    return MEDIA_ROOT / get_thumbnail_key(content_hash)
+
+
+def is_blob_path(file_path):
+    path = Path(file_path)
+    return path.parent.parent.parent == MEDIA_BLOB_ROOT and path.name[:2] == path.parent.parent.name
+
+
+class BlobInputFile(InputFile):
+    def __init__(self, backend, key, cache_path, filename=None):
+        super().__init__(filename=filename or cache_path.name)
+        self.backend = backend
+        self.key = key
+        self.cache_path = cache_path
+
+    async def read(self, bot):
+        # Объект отдается в Telegram по мере чтения из хранилища и одновременно оседает в локальном кэше
+        temp_path = build_temp_path()
+        destination = await asyncio.to_thread(open, temp_path, "wb")
+        completed = False
+        try:
+            async for chunk in self.backend.stream(self.key, self.chunk_size):
+                await asyncio.to_thread(destination.write, chunk)
+                yield chunk
+            completed = True
+        finally:
+            await asyncio.to_thread(destination.close)
+            if completed:
+                await asyncio.to_thread(move_file_if_missing, temp_path, self.cache_path)
+            else:
+                temp_path.unlink(missing_ok=True)
+
+
+async def put_media_object(state, key, temp_path, cache_path):
+    backend = state.media_backend
+    if backend.is_local:
+        await backend.put(key, temp_path)
+        return
+    if not await backend.exists(key):
+        await backend.put(key, temp_path)
+    # Свежий файл остается в локальном кэше: скорее всего, его скоро опубликуют
+    await asyncio.to_thread(move_file_if_missing, temp_path, cache_path)
+
+
+async def put_blob_object(state, temp_path, content_hash, thumbnail_path=None):
+    await put_media_object(state, get_blob_key(content_hash), temp_path, get_blob_path(content_hash))
+    if thumbnail_path:
+        await put_media_object(state, get_thumbnail_key(content_hash), thumbnail_path, get_thumbnail_path(content_hash))
+
+
+async def delete_blob_object(state, content_hash):
+    await state.media_backend.delete(get_blob_key(content_hash))
+    await state.media_backend.delete(get_thumbnail_key(content_hash))
+    if not state.media_backend.is_local:
+        await asyncio.to_thread(get_blob_path(content_hash).unlink, missing_ok=True)
+        await asyncio.to_thread(get_thumbnail_path(content_hash).unlink, missing_ok=True)
+
+
+async def prepare_image_blob(state, temp_path, content_hash):
+    # Фото уменьшается и перекодируется в пуле процессов; в хранилище попадает оптимизированный вариант
+    optimized_path = build_temp_path()
+    thumbnail_path = build_temp_path()
+    optimized_hash, has_thumbnail = await preprocess_image(state, temp_path, optimized_path, thumbnail_path)
+    if not has_thumbnail:
+        thumbnail_path.unlink(missing_ok=True)
+        thumbnail_path = None
+    if not optimized_hash:
+        optimized_path.unlink(missing_ok=True)
+        return temp_path, content_hash, thumbnail_path
+    temp_path.unlink(missing_ok=True)
+    return optimized_path, optimized_hash, thumbnail_path
+
+
+async def commit_blob(state, temp_path, content_hash, thumbnail_path=None):
+    blob_path = get_blob_path(content_hash)
+    size = temp_path.stat().st_size
+    try:
+        # Ссылка берется до загрузки: пока она есть, объект не удалит release_blob другого владельца.
+        # Сама загрузка идет вне транзакции и не держит соединение из пула; повторная запись того же ключа безвредна
+        await acquire_media_blob(state, content_hash, size)
+        try:
+            await put_blob_object(state, temp_path, content_hash, thumbnail_path)
+        except BaseException:
+            await release_blob(state, str(blob_path))
+            raise
+    finally:
+        temp_path.unlink(missing_ok=True)
+        if thumbnail_path:
+            thumbnail_path.unlink(missing_ok=True)
+    return blob_path, content_hash, size
+
+
+async def commit_uploaded_blob(state, temp_path, content_hash, file_type, original_file_name):
+    # Предобработка только для загрузок из панели, API и импорта: фото из Telegram уже сжаты,
+    # повторное JPEG-сжатие их только портит
+    thumbnail_path = None
+    if file_type == "photo" and is_image_processing_enabled():
+        source_hash = content_hash
+        temp_path, content_hash, thumbnail_path = await prepare_image_blob(state, temp_path, content_hash)
+        if content_hash != source_hash:
+            # В хранилище лежит JPEG: имя файла должно соответствовать содержимому
+            original_file_name = f"{Path(original_file_name).stem}.jpg"
+    blob_path, content_hash, file_size = await commit_blob(state, temp_path, content_hash, thumbnail_path)
+    return blob_path, original_file_name, content_hash, file_size
+
+
+async def release_blob(state, file_path):
+    content_hash = Path(file_path).name
+    await release_media_blob(state, content_hash, lambda: delete_blob_object(state, content_hash))
+
+
 async def store_media_locally(state, user_id, message_key, file_id, file_type, original_file_name=None, mime_type=None):
-    user_dir = MEDIA_ROOT / user_id
-    user_dir.mkdir(parents=True, exist_ok=True)
     storage_file_name = build_storage_filename(message_key, file_type, original_file_name, mime_type)
-    file_path = user_dir / storage_file_name
-    await state.bot.download(file_id, destination=file_path)
-    return str(file_path), original_file_name or storage_file_name
+    temp_path = build_temp_path()
+    try:
+        await state.bot.download(file_id, destination=temp_path)
+        content_hash = await asyncio.to_thread(compute_file_hash, temp_path)
+        blob_path, content_hash, file_size = await commit_blob(state, temp_path, content_hash)
+    finally:
+        temp_path.unlink(missing_ok=True)
+    return str(blob_path), original_file_name or storage_file_name, content_hash, file_size
+
+
+def compute_file_hash(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as source:
+        while chunk := source.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_cached_file_id(state, content_hash, file_type):
+    if not content_hash:
+        return None
+    return state.media_file_ids.get((content_hash, file_type))
+
+
+async def remember_file_id(state, content_hash, file_type, file_id):
+    state.media_file_ids[(content_hash, file_type)] = file_id
+    try:
+        await save_media_file_id(state, content_hash, file_type, file_id)
+    except Exception as exc:
+        logging.warning(f"Не удалось сохранить file_id для {content_hash}: {exc}")
+
+
+async def forget_file_id(state, content_hash, file_type):
+    state.media_file_ids.pop((content_hash, file_type), None)
+    try:
+        await delete_media_file_id(state, content_hash, file_type)
+    except Exception as exc:
+        logging.warning(f"Не удалось удалить file_id для {content_hash}: {exc}")
 
 
 def build_local_input_file(file_path, original_file_name=None):
@@ -54,6 +232,56 @@ def build_local_input_file(file_path, original_file_name=None):
     return FSInputFile(path, filename=original_file_name or path.name)
 
 
+def touch_cached_file(state, path):
+    # Попадание в кэш продлевает жизнь горячего объекта; mtime не трогаем, от него зависит ETag
+    if not state.media_backend.is_local:
+        os.utime(path, (time.time(), path.stat().st_mtime))
+
+
+async def fetch_cached_object(state, key, cache_path):
+    if cache_path.exists():
+        touch_cached_file(state, cache_path)
+        return cache_path
+    if state.media_backend.is_local:
+        return None
+    temp_path = build_temp_path()
+    try:
+        await state.media_backend.get(key, temp_path)
+    except FileNotFoundError:
+        temp_path.unlink(missing_ok=True)
+        return None
+    await asyncio.to_thread(move_file_if_missing, temp_path, cache_path)
+    return cache_path
+
+
+async def get_local_media_path(state, file_path):
+    if not file_path:
+        return None
+    path = Path(file_path)
+    if is_blob_path(file_path):
+        return await fetch_cached_object(state, get_blob_key(path.name), path)
+    return path if path.exists() else None
+
+
+async def get_local_thumbnail_path(state, file_path):
+    if not file_path or not is_blob_path(file_path):
+        return None
+    content_hash = Path(file_path).name
+    return await fetch_cached_object(state, get_thumbnail_key(content_hash), get_thumbnail_path(content_hash))
+
+
+def build_media_input_file(state, file_path, original_file_name=None):
+    input_file = build_local_input_file(file_path, original_file_name)
+    if input_file:
+        if is_blob_path(file_path):
+            touch_cached_file(state, Path(file_path))
+        return input_file
+    if not file_path or state.media_backend.is_local or not is_blob_path(file_path):
+        return None
+    content_hash = Path(file_path).name
+    return BlobInputFile(state.media_backend, get_blob_key(content_hash), get_blob_path(content_hash), original_file_name)
+
+
 def delete_local_file(file_path):
     if not file_path:
         return
@@ -73,28 +301,41 @@ def guess_uploaded_file_type(file_name=None, mime_type=None):
     return "document"
 
 
-def store_uploaded_file_locally(user_id, message_key, uploaded_file):
-    original_file_name = uploaded_file.filename or "upload.bin"
-    
-    # Проверка размера файла
-    uploaded_file.file.seek(0, 2)  # Переместиться в конец
-    file_size = uploaded_file.file.tell()
-    uploaded_file.file.seek(0)  # Вернуться в начало
-    max_size_bytes = MAX_FILE_SIZE_MB * 1024 * 1024
-    if file_size > max_size_bytes:
-        raise ValueError(f"File size exceeds {MAX_FILE_SIZE_MB}MB limit")
-    
-    file_type = guess_uploaded_file_type(original_file_name, uploaded_file.content_type)
-    user_dir = MEDIA_ROOT / user_id
-    user_dir.mkdir(parents=True, exist_ok=True)
-    storage_file_name = build_storage_filename(message_key, file_type, original_file_name, uploaded_file.content_type)
-    file_path = user_dir / storage_file_name
-
-    with open(file_path, "wb") as destination:
+def write_upload_chunk(destination, digest, chunk):
+    digest.update(chunk)
+    destination.write(chunk)
+
+
+async def spool_uploaded_part(part, max_size_bytes):
+    temp_path = build_temp_path()
+    # Части multipart читаются порциями, запись и хэширование уходят в поток
+    digest = hashlib.sha256()
+    file_size = 0
+    destination = await asyncio.to_thread(open, temp_path, "wb")
+    try:
         while True:
-            chunk = uploaded_file.file.read(65536)
+            chunk = await part.read_chunk(UPLOAD_CHUNK_SIZE)
             if not chunk:
                 break
-            destination.write(chunk)
+            file_size += len(chunk)
+            if file_size > max_size_bytes:
+                raise UploadTooLargeError(f"File size exceeds {max_size_bytes} bytes limit")
+            await asyncio.to_thread(write_upload_chunk, destination, digest, chunk)
+    except BaseException:
+        await asyncio.to_thread(destination.close)
+        temp_path.unlink(missing_ok=True)
+        raise
+    await asyncio.to_thread(destination.close)
+    return temp_path, digest.hexdigest(), file_size
+
 
-    return str(file_path), original_file_name, file_type
+async def store_uploaded_part_locally(state, part, max_size_bytes=None):
+    original_file_name = part.filename or "upload.bin"
+    file_type = guess_uploaded_file_type(original_file_name, part.headers.get("Content-Type"))
+    if max_size_bytes is None:
+        max_size_bytes = MAX_FILE_SIZE_MB * 1024 * 1024
+    temp_path, content_hash, _ = await spool_uploaded_part(part, max_size_bytes)
+    blob_path, original_file_name, content_hash, file_size = await commit_uploaded_blob(
+        state, temp_path, content_hash, file_type, original_file_name
+    )
+    return str(blob_path), original_file_name, file_type, content_hash, file_size
@@ -0,0 +1,39 @@
+import asyncio
+import logging
+
+from .config import METRICS_LOG_INTERVAL
+from .write_behind import get_write_behind_metrics
+
+
+def format_metrics(metrics):
+    return ", ".join(f"{name}={value:.2f}" if isinstance(value, float) else f"{name}={value}" for name, value in metrics.items())
+
+
+def collect_metrics(state):
+    sections = {}
+    if state.write_behind_task:
+        sections["write_behind"] = get_write_behind_metrics(state)
+    if state.rate_limiter:
+        sections["rate_limit"] = state.rate_limiter.get_metrics()
+    sections["chat_cache"] = state.chat_cache.get_stats()
+    return sections
+
+
+async def run_metrics_reporter(state):
+    while True:
+        await asyncio.sleep(METRICS_LOG_INTERVAL)
+        for section, metrics in collect_metrics(state).items():
+            logging.info(f"Метрики {section}: {format_metrics(metrics)}")
+
+
+def start_metrics_reporter(state):
+    # METRICS_LOG_INTERVAL=0 отключает периодический вывод метрик в лог
+    if METRICS_LOG_INTERVAL > 0:
+        state.metrics_task = asyncio.create_task(run_metrics_reporter(state))
+
+
+async def stop_metrics_reporter(state):
+    if state.metrics_task:
+        state.metrics_task.cancel()
+        await asyncio.gather(state.metrics_task, return_exceptions=True)
+        state.metrics_task = None
@@ -0,0 +1,256 @@
+import json
+import logging
+
+from aiohttp import web
+
+from .bulk_import import ImportValidationError, receive_import_archive
+from .config import MAX_QUEUE_SIZE_PER_USER, PANEL_BASE_PATH
+from .media_downloads import get_media_status
+from .media_storage import UploadTooLargeError
+from .panel_auth import get_panel_api_token_user, get_panel_session_user
+from .panel_posts import PANEL_MAX_TEXT_BYTES, create_panel_post, get_panel_upload_limit, read_panel_post_form
+from .queue import (
+    claim_storage_items,
+    cleanup_stored_message,
+    get_user_queue_size,
+    get_user_storage_page,
+    move_storage_item,
+    remove_storage_item,
+    remove_storage_items,
+)
+from .queue_export import ExportBusyError, stream_queue_export
+from .queue_index import decode_queue_cursor, encode_queue_cursor
+from .scheduler import publish_post_now
+
+PANEL_API_PATH = f"{PANEL_BASE_PATH}/api/v1"
+API_DEFAULT_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 500
+API_MAX_BATCH_KEYS = 5000
+
+
+def api_error(exception_class, error_code, **details):
+    return exception_class(text=json.dumps({"error": error_code, **details}), content_type="application/json")
+
+
+def require_api_user(request):
+    # Скрипты передают токен в Authorization: Bearer, браузер — cookie сессии панели
+    state = request.app["state"]
+    user_id = get_panel_api_token_user(state, request) or get_panel_session_user(state, request)
+    if not user_id or user_id not in state.users:
+        raise api_error(web.HTTPUnauthorized, "unauthorized")
+    return user_id
+
+
+def get_api_user_post(state, request, user_id):
+    message_key = request.match_info["message_key"]
+    data = state.storage.get(message_key)
+    if not data or data["user_id"] != user_id:
+        raise api_error(web.HTTPNotFound, "missing")
+    return message_key, data
+
+
+async def read_api_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        raise api_error(web.HTTPBadRequest, "invalid_json")
+
+
+async def read_api_keys(request):
+    payload = await read_api_json(request)
+    message_keys = payload.get("keys") if isinstance(payload, dict) else None
+    if not isinstance(message_keys, list) or not all(isinstance(message_key, str) for message_key in message_keys):
+        raise api_error(web.HTTPBadRequest, "invalid_keys")
+    if len(message_keys) > API_MAX_BATCH_KEYS:
+        raise api_error(web.HTTPRequestEntityTooLarge, "too_many_keys", limit=API_MAX_BATCH_KEYS)
+    return message_keys
+
+
+def serialize_post(state, message_key, data):
+    return {
+        "key": message_key,
+        "text": data.get("text") or "",
+        "file_type": data.get("file_type"),
+        "file_name": data.get("original_file_name"),
+        "file_size": data.get("file_size") or 0,
+        "media_status": get_media_status(state, message_key),
+        "media_error": data.get("media_error"),
+        "created_at": data.get("created_at"),
+        "attempts": data.get("attempts") or 0,
+        "last_error": data.get("last_error"),
+    }
+
+
+def parse_page_size(value):
+    try:
+        return min(max(int(value), 1), API_MAX_PAGE_SIZE)
+    except (TypeError, ValueError):
+        return API_DEFAULT_PAGE_SIZE
+
+
+async def api_list_posts(request):
+    state = request.app["state"]
+    user_id = require_api_user(request)
+    posts, _, has_next = get_user_storage_page(
+        state,
+        user_id,
+        parse_page_size(request.query.get("limit")),
+        after=decode_queue_cursor(request.query.get("after")),
+    )
+    return web.json_response({
+        "posts": [serialize_post(state, message_key, data) for message_key, data in posts],
+        "next_cursor": encode_queue_cursor(*posts[-1]) if has_next else None,
+        "total": get_user_queue_size(state, user_id),
+    })
+
+
+async def api_get_post(request):
+    state = request.app["state"]
+    user_id = require_api_user(request)
+    message_key, data = get_api_user_post(state, request, user_id)
+    return web.json_response({"post": serialize_post(state, message_key, data)})
+
+
+async def read_api_post_body(state, request, user_id):
+    if request.content_type == "multipart/form-data":
+        # Файл пишется в хранилище по частям, не попадая в память целиком
+        max_size_bytes, quota_limited = get_panel_upload_limit(state, user_id)
+        try:
+            return await read_panel_post_form(state, request, max_size_bytes)
+        except UploadTooLargeError:
+            raise api_error(web.HTTPRequestEntityTooLarge, "quota" if quota_limited else "too_large")
+        except Exception as exc:
+            logging.error(f"Ошибка сохранения загруженного файла через API: {exc}")
+            raise api_error(web.HTTPInternalServerError, "upload")
+
+    payload = await read_api_json(request)
+    text = payload.get("text") if isinstance(payload, dict) else None
+    if not isinstance(text, str):
+        raise api_error(web.HTTPBadRequest, "invalid_text")
+    if len(text.encode("utf-8")) > PANEL_MAX_TEXT_BYTES:
+        raise api_error(web.HTTPRequestEntityTooLarge, "too_large")
+    return text.strip(), None
+
+
+async def api_add_post(request):
+    state = request.app["state"]
+    user_id = require_api_user(request)
+    if get_user_queue_size(state, user_id) >= MAX_QUEUE_SIZE_PER_USER:
+        raise api_error(web.HTTPConflict, "queue_full", limit=MAX_QUEUE_SIZE_PER_USER)
+
+    text, upload = await read_api_post_body(state, request, user_id)
+    if not text and not upload:
+        raise api_error(web.HTTPBadRequest, "empty")
+
+    message_key = create_panel_post(state, user_id, text, upload)
+    return web.json_response({"post": serialize_post(state, message_key, state.storage[message_key])}, status=201)
+
+
+async def api_delete_post(request):
+    state = request.app["state"]
+    user_id = require_api_user(request)
+    message_key, data = get_api_user_post(state, request, user_id)
+    if not await claim_storage_items(state, [message_key]):
+        raise api_error(web.HTTPConflict, "busy")
+    await cleanup_stored_message(state, data)
+    await remove_storage_item(state, message_key)
+    return web.json_response({"deleted": [message_key]})
+
+
+async def api_publish_post(request):
+    state = request.app["state"]
+    user_id = require_api_user(request)
+    message_key, _ = get_api_user_post(state, request, user_id)
+    try:
+        await publish_post_now(state, message_key)
+    except Exception as exc:
+        logging.error(f"Ошибка публикации через API: {exc}")
+        raise api_error(web.HTTPBadGateway, "publish")
+    return web.json_response({"published": message_key})
+
+
+async def api_reorder_posts(request):
+    state = request.app["state"]
+    user_id = require_api_user(request)
+    message_keys = await read_api_keys(request)
+    if len(set(message_keys)) != len(message_keys):
+        raise api_error(web.HTTPBadRequest, "duplicate_keys")
+    missing = [message_key for message_key in message_keys if (state.storage.get(message_key) or {}).get("user_id") != user_id]
+    if missing:
+        raise api_error(web.HTTPNotFound, "missing", keys=missing)
+
+    # Переданные посты занимают те же места в очереди, что и раньше, но в новом порядке
+    slots = sorted(state.storage[message_key].get("created_at") or 0 for message_key in message_keys)
+    for position in range(1, len(slots)):
+        slots[position] = max(slots[position], slots[position - 1] + 0.001)
+    for message_key, created_at in zip(message_keys, slots):
+        if state.storage[message_key].get("created_at") != created_at:
+            move_storage_item(state, message_key, created_at)
+    return web.json_response({"reordered": len(message_keys)})
+
+
+async def api_bulk_delete_posts(request):
+    state = request.app["state"]
+    user_id = require_api_user(request)
+    message_keys = list(dict.fromkeys(await read_api_keys(request)))
+    owned_keys = [message_key for message_key in message_keys if (state.storage.get(message_key) or {}).get("user_id") == user_id]
+    claimed_keys = set(await claim_storage_items(state, owned_keys))
+    # Сначала посты убираются из очереди одной записью в базу, затем чистятся файлы и черновики
+    removed = await remove_storage_items(state, [message_key for message_key in owned_keys if message_key in claimed_keys])
+    for _, data in removed:
+        await cleanup_stored_message(state, data)
+    deleted = {message_key for message_key, _ in removed}
+    busy = [message_key for message_key in owned_keys if message_key not in claimed_keys]
+    return web.json_response({
+        "deleted": [message_key for message_key, _ in removed],
+        "busy": busy,
+        "missing": [message_key for message_key in message_keys if message_key not in deleted and message_key not in busy],
+    })
+
+
+def serialize_import_job(job):
+    return {field: value for field, value in job.items() if field != "user_id"}
+
+
+async def api_start_import(request):
+    state = request.app["state"]
+    user_id = require_api_user(request)
+    try:
+        job = await receive_import_archive(state, request, user_id)
+    except UploadTooLargeError:
+        raise api_error(web.HTTPRequestEntityTooLarge, "too_large")
+    except ImportValidationError as exc:
+        raise api_error(web.HTTPConflict, "import_rejected", message=str(exc))
+    return web.json_response({"job": serialize_import_job(job)}, status=202)
+
+
+async def api_get_import(request):
+    state = request.app["state"]
+    user_id = require_api_user(request)
+    job = state.import_jobs.get(request.match_info["job_id"])
+    if not job or job["user_id"] != user_id:
+        raise api_error(web.HTTPNotFound, "missing")
+    return web.json_response({"job": serialize_import_job(job)})
+
+
+async def api_export_queue(request):
+    user_id = require_api_user(request)
+    try:
+        return await stream_queue_export(request.app["state"], request, user_id)
+    except ExportBusyError:
+        raise api_error(web.HTTPTooManyRequests, "export_busy")
+
+
+def build_panel_api_routes():
+    return [
+        web.get(f"{PANEL_API_PATH}/posts", api_list_posts),
+        web.post(f"{PANEL_API_PATH}/posts", api_add_post),
+        web.post(f"{PANEL_API_PATH}/posts/reorder", api_reorder_posts),
+        web.post(f"{PANEL_API_PATH}/posts/bulk-delete", api_bulk_delete_posts),
+        web.get(f"{PANEL_API_PATH}/posts/{{message_key}}", api_get_post),
+        web.delete(f"{PANEL_API_PATH}/posts/{{message_key}}", api_delete_post),
+        web.post(f"{PANEL_API_PATH}/posts/{{message_key}}/publish", api_publish_post),
+        web.get(f"{PANEL_API_PATH}/export", api_export_queue),
+        web.post(f"{PANEL_API_PATH}/imports", api_start_import),
+        web.get(f"{PANEL_API_PATH}/imports/{{job_id}}", api_get_import),
+    ]
@@ -0,0 +1,46 @@
+import hashlib
+import mimetypes
+from pathlib import Path
+from string import Formatter
+
+from .config import PANEL_BASE_PATH
+
+TEMPLATE_ROOT = Path(__file__).parent / "templates"
+STATIC_ROOT = Path(__file__).parent / "static"
+# Имя файла содержит хеш содержимого, поэтому после изменения стилей браузер запросит новый адрес
+STATIC_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def compile_template(text):
+    # Шаблон разбирается один раз при запуске: при рендере остается только склейка готовых кусков
+    return [(literal, field) for literal, field, _, _ in Formatter().parse(text)]
+
+
+def load_template(name):
+    return compile_template((TEMPLATE_ROOT / name).read_text(encoding="utf-8"))
+
+
+def render_template(template, **values):
+    parts = []
+    for literal, field in template:
+        parts.append(literal)
+        if field is not None:
+            parts.append(str(values[field]))
+    return "".join(parts)
+
+
+def load_static_assets():
+    assets = {}
+    urls = {}
+    for path in sorted(STATIC_ROOT.iterdir()):
+        if not path.is_file():
+            continue
+        body = path.read_bytes()
+        hashed_name = f"{path.stem}.{hashlib.sha256(body).hexdigest()[:12]}{path.suffix}"
+        content_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        assets[hashed_name] = (body, content_type)
+        urls[path.name] = f"{PANEL_BASE_PATH}/static/{hashed_name}"
+    return assets, urls
+
+
+STATIC_ASSETS, STATIC_URLS = load_static_assets()
@@ -8,7 +8,7 @@ from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
 from .common import get_translation
 from .config import PANEL_BASE_PATH, PANEL_BASE_URL, PANEL_SESSION_COOKIE, PANEL_SESSION_TTL
-from .database import save_users
+from .write_behind import flush_pending_writes, mark_user_dirty
 
 
 def build_panel_url(path=""):
@@ -78,6 +78,7 @@ async def ensure_panel_credentials(state, user_id, reset_password=False):
         while not is_panel_login_available(state, panel_login, exclude_user_id=user_id):
             panel_login = generate_panel_login(user_id)
         user["panel_login"] = panel_login
+        mark_user_dirty(state, user_id, "panel_login")
         credentials_changed = True
 
     plain_password = None
@@ -86,10 +87,11 @@ async def ensure_panel_credentials(state, user_id, reset_password=False):
         salt, password_hash = hash_panel_password(plain_password)
         user["panel_password_salt"] = salt
         user["panel_password_hash"] = password_hash
+        mark_user_dirty(state, user_id, "panel_password_salt", "panel_password_hash")
         credentials_changed = True
 
     if credentials_changed:
-        await save_users(state)
+        await flush_pending_writes(state)
 
     return user["panel_login"], plain_password
 
@@ -102,7 +104,8 @@ async def update_panel_login(state, user_id, new_login):
         raise ValueError("login_taken")
 
     state.users[user_id]["panel_login"] = normalized_login
-    await save_users(state)
+    mark_user_dirty(state, user_id, "panel_login")
+    await flush_pending_writes(state)
     return normalized_login
 
 
@@ -114,7 +117,8 @@ async def update_panel_password(state, user_id, new_password):
     salt, password_hash = hash_panel_password(normalized_password)
     state.users[user_id]["panel_password_salt"] = salt
     state.users[user_id]["panel_password_hash"] = password_hash
-    await save_users(state)
+    mark_user_dirty(state, user_id, "panel_password_salt", "panel_password_hash")
+    await flush_pending_writes(state)
     return normalized_password
 
 
@@ -150,6 +154,45 @@ def clear_panel_session(state, request):
         state.panel_sessions.pop(session_id, None)
 
 
+def hash_panel_api_token(token):
+    # Токен случайный и длинный, поэтому медленный хеш как у пароля не нужен
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def build_panel_api_token_index(users):
+    return {data["panel_api_token_hash"]: user_id for user_id, data in users.items() if data.get("panel_api_token_hash")}
+
+
+async def revoke_panel_api_token(state, user_id):
+    token_hash = state.users[user_id].get("panel_api_token_hash")
+    if not token_hash:
+        return False
+    state.panel_api_tokens.pop(token_hash, None)
+    state.users[user_id]["panel_api_token_hash"] = None
+    mark_user_dirty(state, user_id, "panel_api_token_hash")
+    await flush_pending_writes(state)
+    return True
+
+
+async def issue_panel_api_token(state, user_id):
+    # Новый токен заменяет старый
+    state.panel_api_tokens.pop(state.users[user_id].get("panel_api_token_hash"), None)
+    token = secrets.token_urlsafe(32)
+    token_hash = hash_panel_api_token(token)
+    state.users[user_id]["panel_api_token_hash"] = token_hash
+    state.panel_api_tokens[token_hash] = user_id
+    mark_user_dirty(state, user_id, "panel_api_token_hash")
+    await flush_pending_writes(state)
+    return token
+
+
+def get_panel_api_token_user(state, request):
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        return None
+    return state.panel_api_tokens.get(hash_panel_api_token(token.strip()))
+
+
 def build_panel_access_keyboard(state, user_id):
     return InlineKeyboardMarkup(
         inline_keyboard=[
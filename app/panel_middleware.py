@@ -0,0 +1,57 @@
+import gzip
+
+from aiohttp import hdrs, web
+
+# brotli — необязательная зависимость: без него ответы сжимаются только gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_SIZE = 1024
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "image/svg+xml")
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def get_accepted_encodings(request):
+    encodings = set()
+    for item in request.headers.get(hdrs.ACCEPT_ENCODING, "").lower().split(","):
+        coding, _, params = item.partition(";")
+        params = params.replace(" ", "")
+        try:
+            if params.startswith("q=") and float(params[2:]) == 0:
+                continue
+        except ValueError:
+            continue
+        if coding.strip():
+            encodings.add(coding.strip())
+    return encodings
+
+
+def compress_body(body, encodings):
+    if brotli is not None and "br" in encodings:
+        return "br", brotli.compress(body, quality=BROTLI_QUALITY)
+    if "gzip" in encodings:
+        return "gzip", gzip.compress(body, compresslevel=GZIP_LEVEL)
+    return None, body
+
+
+@web.middleware
+async def compression_middleware(request, handler):
+    response = await handler(request)
+    # Сжимаются только готовые текстовые ответы; файлы медиа отдаются через FileResponse как есть
+    if type(response) is not web.Response or response.status < 200 or response.status in (204, 304):
+        return response
+    body = response.body
+    if not isinstance(body, bytes) or len(body) < COMPRESS_MIN_SIZE or hdrs.CONTENT_ENCODING in response.headers:
+        return response
+    if not response.content_type.startswith(COMPRESSIBLE_TYPES):
+        return response
+
+    response.headers.add(hdrs.VARY, hdrs.ACCEPT_ENCODING)
+    encoding, compressed = compress_body(body, get_accepted_encodings(request))
+    if encoding and len(compressed) < len(body):
+        response.body = compressed
+        response.headers[hdrs.CONTENT_ENCODING] = encoding
+    return response
@@ -0,0 +1,77 @@
+import secrets
+import time
+
+from .config import MAX_FILE_SIZE_MB
+from .media_storage import UploadTooLargeError, release_blob, store_uploaded_part_locally
+from .queue import add_storage_item, get_media_quota_remaining
+from .scheduler import schedule_user_publish
+
+PANEL_MAX_TEXT_BYTES = 64 * 1024
+
+
+def get_panel_upload_limit(state, user_id):
+    max_size_bytes = MAX_FILE_SIZE_MB * 1024 * 1024
+    quota_remaining = get_media_quota_remaining(state, user_id)
+    quota_limited = quota_remaining is not None and quota_remaining < max_size_bytes
+    if quota_limited:
+        max_size_bytes = max(quota_remaining, 0)
+    return max_size_bytes, quota_limited
+
+
+async def read_text_part(part, limit=PANEL_MAX_TEXT_BYTES):
+    chunks = []
+    size = 0
+    while True:
+        chunk = await part.read_chunk()
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > limit:
+            raise UploadTooLargeError("Text field is too large")
+        chunks.append(chunk)
+    return b"".join(chunks).decode(part.get_charset("utf-8"), errors="replace")
+
+
+async def read_panel_post_form(state, request, max_size_bytes):
+    reader = await request.multipart()
+    text = ""
+    upload = None
+    try:
+        async for part in reader:
+            name = getattr(part, "name", None)
+            if name == "text":
+                text = (await read_text_part(part)).strip()
+            elif name == "media" and part.filename and upload is None:
+                upload = await store_uploaded_part_locally(state, part, max_size_bytes)
+    except BaseException:
+        if upload:
+            await release_blob(state, upload[0])
+        raise
+    return text, upload
+
+
+def build_panel_message_key(user_id):
+    return f"{user_id}:panel:{int(time.time() * 1000)}:{secrets.token_hex(4)}"
+
+
+def build_panel_post(user_id, text, upload, created_at=None):
+    file_path, original_file_name, file_type, content_hash, file_size = upload or (None, None, None, None, 0)
+    return {
+        "user_id": user_id,
+        "text": text,
+        "file_id": None,
+        "file_path": file_path,
+        "original_file_name": original_file_name,
+        "file_type": file_type,
+        "temp_msg_id": None,
+        "created_at": created_at or time.time(),
+        "content_hash": content_hash,
+        "file_size": file_size,
+    }
+
+
+def create_panel_post(state, user_id, text, upload):
+    message_key = build_panel_message_key(user_id)
+    add_storage_item(state, message_key, build_panel_post(user_id, text, upload))
+    schedule_user_publish(state, user_id)
+    return message_key
@@ -1,433 +1,288 @@
+import hashlib
 import html
 import logging
+import mimetypes
 import secrets
 import time
 from pathlib import Path
+from urllib.parse import quote
 
 from aiohttp import web
 
 from .common import format_storage_time
-from .config import PANEL_BASE_PATH, PANEL_HOST, PANEL_PORT, PANEL_SESSION_COOKIE, PANEL_SESSION_TTL
-from .database import save_storage
-from .media_storage import store_uploaded_file_locally
-from .panel_auth import build_panel_url, clear_panel_session, create_panel_session, get_panel_session_user, verify_panel_password
-from .queue import cleanup_stored_message, get_user_storage_items, send_to_channel, touch_last_published, ensure_user_publish_task
+from .bulk_import import ImportValidationError, get_active_import_job, get_user_import_jobs, receive_import_archive
+from .config import (
+    MAX_FILE_SIZE_MB,
+    MAX_IMPORT_ARCHIVE_MB,
+    MAX_MEDIA_MB_PER_USER,
+    PANEL_BASE_PATH,
+    PANEL_HOST,
+    PANEL_PAGE_SIZE,
+    PANEL_PORT,
+    PANEL_SESSION_COOKIE,
+    PANEL_SESSION_TTL,
+)
+from .database import load_user_dead_letters, pop_dead_letter
+from .media_downloads import get_media_status, retry_media_download
+from .media_storage import (
+    UploadTooLargeError,
+    get_local_media_path,
+    get_local_thumbnail_path,
+)
+from .panel_assets import STATIC_ASSETS, STATIC_CACHE_CONTROL, STATIC_URLS, load_template, render_template
+from .panel_api import build_panel_api_routes
+from .panel_auth import (
+    build_panel_url,
+    clear_panel_session,
+    create_panel_session,
+    get_panel_session_user,
+    issue_panel_api_token,
+    revoke_panel_api_token,
+    verify_panel_password,
+)
+from .panel_middleware import compression_middleware
+from .panel_posts import create_panel_post, get_panel_upload_limit, read_panel_post_form
+from .queue import (
+    add_storage_item,
+    claim_storage_items,
+    change_media_usage,
+    cleanup_stored_message,
+    get_user_queue_size,
+    get_user_storage_page,
+    remove_storage_item,
+)
+from .queue_export import ExportBusyError, stream_queue_export
+from .queue_index import decode_queue_cursor, encode_queue_cursor
+from .scheduler import publish_post_now, schedule_user_publish
+from .write_behind import bump_queue_version
+
+# Файл поста не меняется, пока пост существует, поэтому браузер может хранить его без перепроверки
+MEDIA_CACHE_CONTROL = "private, max-age=31536000, immutable"
+# Прямо в браузере показываются только растровые картинки, аудио и видео; остальное (HTML, SVG, PDF) скачивается
+INLINE_IMAGE_TYPES = {"image/jpeg", "image/png", "image/gif", "image/webp", "image/bmp", "image/avif"}
+# Страницу панели браузер хранит, но перед каждым показом сверяет ETag
+DASHBOARD_CACHE_CONTROL = "private, no-cache"
+# Счетчики версий очередей живут в памяти, поэтому ETag после перезапуска должен смениться
+DASHBOARD_ETAG_SEED = secrets.token_hex(4)
+MEDIA_STATUS_LABELS = {
+    "pending": "Файл ожидает загрузки",
+    "downloading": "Файл загружается",
+    "failed": "Не удалось загрузить файл",
+}
+
+
+LOGIN_TEMPLATE = load_template("login.html")
+DASHBOARD_TEMPLATE = load_template("dashboard.html")
+POST_CARD_TEMPLATE = load_template("post_card.html")
+FAILED_CARD_TEMPLATE = load_template("failed_card.html")
+EMPTY_QUEUE_HTML = """
+      <div class="empty">
+        <strong>Очередь пока пустая.</strong>
+        <p>Добавьте пост через эту панель или прямо в Telegram-боте — список общий.</p>
+      </div>
+    """
+NOTICES = {
+    "created": "<div class='notice success'>Пост добавлен в очередь.</div>",
+    "published": "<div class='notice success'>Пост отправлен сразу.</div>",
+    "deleted": "<div class='notice success'>Пост удален из очереди.</div>",
+    "requeued": "<div class='notice success'>Пост возвращен в очередь.</div>",
+    "failed_deleted": "<div class='notice success'>Неудачный пост удален.</div>",
+    "media_requeued": "<div class='notice success'>Загрузка файла запущена повторно.</div>",
+    "api_token_revoked": "<div class='notice success'>API-токен отозван.</div>",
+    "import_started": "<div class='notice success'>Импорт запущен, прогресс виден ниже.</div>",
+}
+ERRORS = {
+    "empty": "<div class='notice error'>Добавьте текст или файл.</div>",
+    "upload": "<div class='notice error'>Не удалось сохранить загруженный файл.</div>",
+    "too_large": f"<div class='notice error'>Файл больше {MAX_FILE_SIZE_MB} МБ.</div>",
+    "quota": f"<div class='notice error'>Медиафайлы в очереди превышают квоту {MAX_MEDIA_MB_PER_USER} МБ.</div>",
+    "missing": "<div class='notice error'>Пост не найден.</div>",
+    "busy": "<div class='notice error'>Пост сейчас публикуется, повторите чуть позже.</div>",
+    "publish": "<div class='notice error'>Не удалось отправить пост. Проверьте канал публикации и наличие файла.</div>",
+    "import_missing": "<div class='notice error'>Выберите ZIP-архив для импорта.</div>",
+    "import_running": "<div class='notice error'>Дождитесь завершения предыдущего импорта.</div>",
+    "import_too_large": f"<div class='notice error'>Архив больше {MAX_IMPORT_ARCHIVE_MB} МБ.</div>",
+    "import_upload": "<div class='notice error'>Не удалось сохранить архив.</div>",
+    "export_busy": "<div class='notice error'>Выгрузка уже идет. Дождитесь окончания загрузки архива и повторите.</div>",
+}
 
 
 def get_state(request):
     return request.app["state"]
 
 
-def render_panel_login_page(error_code=None):
-    error_html = ""
-    if error_code == "invalid":
-        error_html = "<div class='notice error'>Неверный логин или пароль.</div>"
-
-    return f"""<!doctype html>
-<html lang="ru">
-<head>
-  <meta charset="utf-8">
-  <meta name="viewport" content="width=device-width, initial-scale=1">
-  <title>Панель управления</title>
-  <style>
-    :root {{
-      --bg: #f5efe6;
-      --paper: #fffaf2;
-      --ink: #1f1a16;
-      --muted: #705d4d;
-      --line: #d9c7b7;
-      --accent: #b85c38;
-      --accent-dark: #8f4326;
-      --danger: #b3261e;
-      --shadow: 0 24px 70px rgba(58, 38, 24, 0.12);
-      font-family: "IBM Plex Sans", "Segoe UI", sans-serif;
-    }}
-    * {{ box-sizing: border-box; }}
-    body {{
-      margin: 0;
-      min-height: 100vh;
-      color: var(--ink);
-      background:
-        radial-gradient(circle at top left, rgba(184, 92, 56, 0.16), transparent 30%),
-        linear-gradient(180deg, #f7f1e9 0%, #efe2d4 100%);
-      display: grid;
-      place-items: center;
-      padding: 24px;
-    }}
-    .card {{
-      width: min(100%, 440px);
-      background: rgba(255, 250, 242, 0.96);
-      border: 1px solid rgba(217, 199, 183, 0.9);
-      border-radius: 28px;
-      padding: 32px;
-      box-shadow: var(--shadow);
-      backdrop-filter: blur(10px);
-    }}
-    h1 {{ margin: 0 0 10px; font-size: 32px; }}
-    p {{ margin: 0 0 20px; color: var(--muted); line-height: 1.55; }}
-    label {{ display: block; margin: 16px 0 8px; font-size: 14px; color: var(--muted); }}
-    input {{
-      width: 100%;
-      border: 1px solid var(--line);
-      border-radius: 16px;
-      padding: 14px 16px;
-      background: #fff;
-      font-size: 15px;
-    }}
-    button {{
-      width: 100%;
-      margin-top: 20px;
-      border: 0;
-      border-radius: 16px;
-      padding: 14px 18px;
-      background: var(--accent);
-      color: #fff;
-      font-size: 15px;
-      font-weight: 600;
-      cursor: pointer;
-    }}
-    button:hover {{ background: var(--accent-dark); }}
-    .notice {{
-      border-radius: 16px;
-      padding: 12px 14px;
-      margin-bottom: 18px;
-      font-size: 14px;
-    }}
-    .error {{
-      background: rgba(179, 38, 30, 0.10);
-      border: 1px solid rgba(179, 38, 30, 0.20);
-      color: var(--danger);
-    }}
-  </style>
-</head>
-<body>
-  <main class="card">
-    <h1>Панель управления</h1>
-    <p>Войдите под логином и паролем, которые бот сгенерировал лично для вас.</p>
-    {error_html}
-    <form method="post" action="{PANEL_BASE_PATH}/login">
-      <label for="login">Логин</label>
-      <input id="login" name="login" type="text" autocomplete="username" required>
-      <label for="password">Пароль</label>
-      <input id="password" name="password" type="password" autocomplete="current-password" required>
-      <button type="submit">Войти</button>
-    </form>
-  </main>
-</body>
-</html>"""
-
-
-def render_panel_dashboard(state, user_id, status_code=None, error_code=None):
-    panel_login = html.escape(state.users[user_id].get("panel_login") or "—")
-    publish_channel_ready = "Подключен" if state.users[user_id].get("publish_channel_id") else "Не подключен"
-    posts = get_user_storage_items(state, user_id)
-
-    notices = {
-        "created": "<div class='notice success'>Пост добавлен в очередь.</div>",
-        "published": "<div class='notice success'>Пост отправлен сразу.</div>",
-        "deleted": "<div class='notice success'>Пост удален из очереди.</div>",
-    }
-    errors = {
-        "empty": "<div class='notice error'>Добавьте текст или файл.</div>",
-        "upload": "<div class='notice error'>Не удалось сохранить загруженный файл.</div>",
-        "missing": "<div class='notice error'>Пост не найден.</div>",
-        "publish": "<div class='notice error'>Не удалось отправить пост. Проверьте канал публикации и наличие файла.</div>",
-    }
-    flash_html = notices.get(status_code, "") + errors.get(error_code, "")
-
-    cards = []
-    for message_key, data in posts:
-        text_preview = html.escape(data.get("text") or "Без текста").replace("\n", "<br>")
-        media_name = html.escape(data.get("original_file_name") or (Path(data["file_path"]).name if data.get("file_path") else "Нет файла"))
-        media_label = html.escape(data.get("file_type") or "text")
-        cards.append(
-            f"""
-        <article class="post-card">
-          <div class="post-head">
-            <div>
-              <strong>Пост в очереди</strong>
-              <div class="meta">Добавлен: {format_storage_time(data.get("created_at"))}</div>
-            </div>
-            <span class="badge">{media_label}</span>
-          </div>
-          <div class="post-body">{text_preview}</div>
-          <div class="meta">Файл: {media_name}</div>
-          <div class="actions">
-            <form method="post" action="{PANEL_BASE_PATH}/posts/{message_key}/publish">
-              <button class="ghost" type="submit">Отправить сразу</button>
-            </form>
-            <form method="post" action="{PANEL_BASE_PATH}/posts/{message_key}/delete">
-              <button class="danger" type="submit">Удалить</button>
-            </form>
-          </div>
-        </article>
-        """
+def build_login_pages():
+    # Страница входа не зависит от пользователя, поэтому оба варианта собираются один раз при запуске
+    pages = {}
+    for error_code, error_html in ((None, ""), ("invalid", "<div class='notice error'>Неверный логин или пароль.</div>")):
+        pages[error_code] = render_template(
+            LOGIN_TEMPLATE,
+            stylesheet_url=STATIC_URLS["login.css"],
+            error_html=error_html,
+            base_path=PANEL_BASE_PATH,
         )
+    return pages
 
-    posts_html = "\n".join(cards) if cards else """
-      <div class="empty">
-        <strong>Очередь пока пустая.</strong>
-        <p>Добавьте пост через эту панель или прямо в Telegram-боте — список общий.</p>
-      </div>
-    """
 
-    return f"""<!doctype html>
-<html lang="ru">
-<head>
-  <meta charset="utf-8">
-  <meta name="viewport" content="width=device-width, initial-scale=1">
-  <title>Панель управления</title>
-  <style>
-    :root {{
-      --bg: #f5efe6;
-      --paper: #fffaf2;
-      --ink: #1f1a16;
-      --muted: #705d4d;
-      --line: #d9c7b7;
-      --accent: #b85c38;
-      --accent-dark: #8f4326;
-      --danger: #b3261e;
-      --success: #2f7d4a;
-      --shadow: 0 24px 70px rgba(58, 38, 24, 0.12);
-      font-family: "IBM Plex Sans", "Segoe UI", sans-serif;
-    }}
-    * {{ box-sizing: border-box; }}
-    body {{
-      margin: 0;
-      color: var(--ink);
-      background:
-        radial-gradient(circle at top left, rgba(184, 92, 56, 0.12), transparent 24%),
-        linear-gradient(180deg, #f7f1e9 0%, #efe2d4 100%);
-      min-height: 100vh;
-    }}
-    .shell {{
-      width: min(1180px, calc(100% - 32px));
-      margin: 24px auto;
-      display: grid;
-      gap: 20px;
-    }}
-    .hero, .panel, .post-card, .empty {{
-      background: rgba(255, 250, 242, 0.96);
-      border: 1px solid rgba(217, 199, 183, 0.9);
-      border-radius: 28px;
-      box-shadow: var(--shadow);
-      backdrop-filter: blur(10px);
-    }}
-    .hero {{
-      padding: 28px;
-      display: grid;
-      grid-template-columns: 1.7fr 1fr;
-      gap: 18px;
-      align-items: start;
-    }}
-    .hero h1 {{ margin: 0 0 8px; font-size: 34px; }}
-    .hero p {{ margin: 0; color: var(--muted); line-height: 1.6; }}
-    .meta-grid {{
-      display: grid;
-      grid-template-columns: repeat(2, minmax(0, 1fr));
-      gap: 12px;
-    }}
-    .meta-card {{
-      background: #fff;
-      border: 1px solid var(--line);
-      border-radius: 18px;
-      padding: 14px 16px;
-    }}
-    .meta-card span {{
-      display: block;
-      color: var(--muted);
-      font-size: 13px;
-      margin-bottom: 6px;
-    }}
-    .meta-card strong {{ font-size: 16px; }}
-    .topbar {{
-      display: flex;
-      justify-content: space-between;
-      align-items: center;
-      gap: 12px;
-    }}
-    .logout {{
-      width: auto;
-      padding: 12px 16px;
-      border-radius: 14px;
-      border: 1px solid var(--line);
-      background: #fff;
-      color: var(--ink);
-      cursor: pointer;
-    }}
-    .grid {{
-      display: grid;
-      grid-template-columns: 360px 1fr;
-      gap: 20px;
-      align-items: start;
-    }}
-    .panel {{
-      padding: 24px;
-    }}
-    .panel h2, .list h2 {{
-      margin: 0 0 16px;
-      font-size: 24px;
-    }}
-    label {{
-      display: block;
-      margin: 14px 0 8px;
-      font-size: 14px;
-      color: var(--muted);
-    }}
-    textarea, input[type="file"] {{
-      width: 100%;
-      border: 1px solid var(--line);
-      border-radius: 18px;
-      padding: 14px 16px;
-      background: #fff;
-      font-size: 15px;
-    }}
-    textarea {{
-      min-height: 180px;
-      resize: vertical;
-      line-height: 1.5;
-    }}
-    .panel button, .actions button {{
-      border: 0;
-      border-radius: 16px;
-      padding: 12px 16px;
-      font-size: 14px;
-      font-weight: 600;
-      cursor: pointer;
-    }}
-    .panel button {{
-      width: 100%;
-      margin-top: 18px;
-      background: var(--accent);
-      color: #fff;
-    }}
-    .list {{
-      display: grid;
-      gap: 16px;
-    }}
-    .post-card {{
-      padding: 20px;
-    }}
-    .post-head {{
-      display: flex;
-      justify-content: space-between;
-      gap: 12px;
-      align-items: start;
-      margin-bottom: 14px;
-    }}
-    .post-body {{
-      margin-bottom: 14px;
-      line-height: 1.6;
-      word-break: break-word;
-    }}
-    .meta {{
-      color: var(--muted);
-      font-size: 13px;
-    }}
-    .badge {{
-      background: rgba(184, 92, 56, 0.12);
-      color: var(--accent-dark);
-      border-radius: 999px;
-      padding: 8px 12px;
-      font-size: 12px;
-      text-transform: uppercase;
-      letter-spacing: 0.08em;
-    }}
-    .actions {{
-      display: flex;
-      gap: 10px;
-      margin-top: 18px;
-    }}
-    .actions form {{ flex: 1; }}
-    .ghost {{
-      width: 100%;
-      background: #fff;
-      border: 1px solid var(--line);
-      color: var(--ink);
-    }}
-    .danger {{
-      width: 100%;
-      background: rgba(179, 38, 30, 0.10);
-      color: var(--danger);
-    }}
-    .notice {{
-      border-radius: 18px;
-      padding: 14px 16px;
-      font-size: 14px;
-      margin-bottom: 18px;
-    }}
-    .success {{
-      background: rgba(47, 125, 74, 0.12);
-      color: var(--success);
-      border: 1px solid rgba(47, 125, 74, 0.18);
-    }}
-    .error {{
-      background: rgba(179, 38, 30, 0.10);
-      color: var(--danger);
-      border: 1px solid rgba(179, 38, 30, 0.18);
-    }}
-    .empty {{
-      padding: 28px;
-    }}
-    .empty p {{
-      margin: 8px 0 0;
-      color: var(--muted);
-      line-height: 1.6;
-    }}
-    @media (max-width: 900px) {{
-      .hero, .grid {{
-        grid-template-columns: 1fr;
-      }}
-      .meta-grid {{
-        grid-template-columns: 1fr;
-      }}
-      .actions {{
-        flex-direction: column;
-      }}
-    }}
-  </style>
-</head>
-<body>
-  <div class="shell">
-    <section class="hero">
-      <div>
-        <div class="topbar">
-          <div>
-            <h1>Панель управления</h1>
-            <p>Все отложенные посты пользователя собраны здесь. Посты можно добавлять как через панель, так и прямо в Telegram-боте.</p>
-          </div>
-          <form method="post" action="{PANEL_BASE_PATH}/logout">
-            <button class="logout" type="submit">Выйти</button>
+LOGIN_PAGES = build_login_pages()
+
+
+def render_panel_login_page(error_code=None):
+    return LOGIN_PAGES.get(error_code, LOGIN_PAGES[None])
+
+
+def render_media_preview(message_key, data, media_status):
+    if media_status != "ready" or not data.get("file_path"):
+        return ""
+    media_url = f"{PANEL_BASE_PATH}/media/{quote(message_key)}"
+    file_type = data.get("file_type")
+    if file_type == "photo":
+        preview = f'<img src="{media_url}/thumbnail" alt="" loading="lazy">'
+    elif file_type == "video":
+        preview = f'<video src="{media_url}" controls preload="none"></video>'
+    elif file_type in ("audio", "voice"):
+        preview = f'<audio src="{media_url}" controls preload="none"></audio>'
+    else:
+        preview = f'<a href="{media_url}" target="_blank" rel="noopener">Открыть файл</a>'
+    return f'\n          <div class="preview">{preview}</div>'
+
+
+def render_post_card(state, message_key, data):
+    media_status = get_media_status(state, message_key)
+    status_html = ""
+    retry_html = ""
+    if media_status in MEDIA_STATUS_LABELS:
+        status_text = MEDIA_STATUS_LABELS[media_status]
+        if media_status == "failed":
+            status_text += f": {html.escape(data.get('media_error') or 'неизвестная ошибка')}"
+            retry_html = f"""
+            <form method="post" action="{PANEL_BASE_PATH}/posts/{message_key}/media-retry">
+              <button class="ghost" type="submit">Повторить загрузку</button>
+            </form>"""
+        elif data.get("media_attempts"):
+            status_text += f" (попытка {data['media_attempts'] + 1})"
+        status_html = f'\n          <div class="meta">{status_text}</div>'
+    return render_template(
+        POST_CARD_TEMPLATE,
+        created_at=format_storage_time(data.get("created_at")),
+        media_label=html.escape(data.get("file_type") or "text"),
+        text_preview=html.escape(data.get("text") or "Без текста").replace("\n", "<br>"),
+        preview_html=render_media_preview(message_key, data, media_status),
+        media_name=html.escape(data.get("original_file_name") or (Path(data["file_path"]).name if data.get("file_path") else "Нет файла")),
+        status_html=status_html,
+        retry_html=retry_html,
+        base_path=PANEL_BASE_PATH,
+        message_key=message_key,
+    )
+
+
+def render_failed_card(message_key, data):
+    return render_template(
+        FAILED_CARD_TEMPLATE,
+        attempts=data.get("attempts") or 0,
+        failed_at=format_storage_time(data.get("failed_at")),
+        media_label=html.escape(data.get("file_type") or "text"),
+        text_preview=html.escape(data.get("text") or "Без текста").replace("\n", "<br>"),
+        error_text=html.escape(data.get("last_error") or "Неизвестная ошибка"),
+        base_path=PANEL_BASE_PATH,
+        message_key=message_key,
+    )
+
+
+def render_pager(posts, has_previous, has_next):
+    links = []
+    if has_previous:
+        links.append(f'<a href="{PANEL_BASE_PATH}?before={quote(encode_queue_cursor(*posts[0]), safe="")}">← Предыдущие</a>')
+        links.append(f'<a href="{PANEL_BASE_PATH}">В начало</a>')
+    if has_next:
+        links.append(f'<a href="{PANEL_BASE_PATH}?after={quote(encode_queue_cursor(*posts[-1]), safe="")}">Следующие →</a>')
+    if not links:
+        return ""
+    return f'<nav class="pager">{"".join(links)}</nav>'
+
+
+def render_api_token_block(state, user_id, api_token=None):
+    token_html = ""
+    if api_token:
+        token_html = f"""
+          <div class="notice success">Сохраните токен, он показывается один раз:<code>{html.escape(api_token)}</code></div>"""
+    revoke_html = ""
+    if state.users[user_id].get("panel_api_token_hash"):
+        revoke_html = f"""
+          <form method="post" action="{PANEL_BASE_PATH}/api-token/revoke">
+            <button class="ghost" type="submit">Отозвать токен</button>
+          </form>"""
+    return f"""
+        <div class="side-block">
+          <h2>API</h2>
+          <p class="meta">Скрипты могут управлять очередью через {PANEL_BASE_PATH}/api/v1/ с заголовком Authorization: Bearer &lt;токен&gt;.</p>{token_html}
+          <form method="post" action="{PANEL_BASE_PATH}/api-token">
+            <button type="submit">Выпустить новый токен</button>
+          </form>{revoke_html}
+        </div>"""
+
+
+def render_import_job(job):
+    file_name = html.escape(job["file_name"])
+    if job["status"] == "running":
+        progress = f"обработано {job['processed']} из {job['total']}" if job["total"] else "проверка архива"
+        return f'<div class="meta">{file_name}: {progress}</div>'
+    if job["status"] == "done":
+        return f'<div class="meta">{file_name}: добавлено постов {job["created"]}</div>'
+    return f'<div class="meta">{file_name}: ошибка — {html.escape(job["error"] or "неизвестная ошибка")}</div>'
+
+
+def render_import_block(state, user_id):
+    jobs_html = "".join(
+        f"\n          {render_import_job(job)}"
+        for job in sorted(get_user_import_jobs(state, user_id), key=lambda job: job["started_at"], reverse=True)[:3]
+    )
+    return f"""
+        <div class="side-block">
+          <h2>Импорт и выгрузка</h2>
+          <p class="meta">ZIP с файлами и manifest.csv (колонки file и text) или manifest.json. Посты добавляются в порядке манифеста.</p>{jobs_html}
+          <form method="post" action="{PANEL_BASE_PATH}/imports" enctype="multipart/form-data">
+            <input name="archive" type="file" accept=".zip,application/zip" required>
+            <button type="submit">Импортировать</button>
           </form>
-        </div>
-      </div>
-      <div class="meta-grid">
-        <div class="meta-card"><span>Логин панели</span><strong>{panel_login}</strong></div>
-        <div class="meta-card"><span>Канал публикации</span><strong>{publish_channel_ready}</strong></div>
-        <div class="meta-card"><span>Постов в очереди</span><strong>{len(posts)}</strong></div>
-        <div class="meta-card"><span>Хранение медиа</span><strong>Локально на сервере</strong></div>
-      </div>
-    </section>
-    <section class="grid">
-      <aside class="panel">
-        <h2>Добавить пост</h2>
-        {flash_html}
-        <form method="post" action="{PANEL_BASE_PATH}/posts" enctype="multipart/form-data">
-          <label for="text">Текст поста</label>
-          <textarea id="text" name="text" placeholder="Напишите подпись или сам текст поста..."></textarea>
-          <label for="media">Медиафайл</label>
-          <input id="media" name="media" type="file">
-          <button type="submit">Добавить в очередь</button>
-        </form>
-      </aside>
-      <section class="list">
-        <h2>Отложенные посты</h2>
-        {posts_html}
-      </section>
-    </section>
-  </div>
-</body>
-</html>"""
+          <a class="download" href="{PANEL_BASE_PATH}/export">Скачать очередь в ZIP</a>
+        </div>"""
+
+
+def render_panel_dashboard(
+    state,
+    user_id,
+    status_code=None,
+    error_code=None,
+    dead_letters=(),
+    after=None,
+    before=None,
+    api_token=None,
+):
+    # Рендерится только одна страница очереди; стили отдаются отдельным кэшируемым файлом
+    posts, has_previous, has_next = get_user_storage_page(state, user_id, PANEL_PAGE_SIZE, after, before)
+    if not posts and (after or before):
+        # Курсор указывает за конец очереди (например, посты уже опубликованы): показываем первую страницу
+        posts, has_previous, has_next = get_user_storage_page(state, user_id, PANEL_PAGE_SIZE)
+
+    cards = [render_post_card(state, message_key, data) for message_key, data in posts]
+    failed_cards = [render_failed_card(message_key, data) for message_key, data in dead_letters]
+    return render_template(
+        DASHBOARD_TEMPLATE,
+        stylesheet_url=STATIC_URLS["dashboard.css"],
+        base_path=PANEL_BASE_PATH,
+        panel_login=html.escape(state.users[user_id].get("panel_login") or "—"),
+        publish_channel_ready="Подключен" if state.users[user_id].get("publish_channel_id") else "Не подключен",
+        queue_size=get_user_queue_size(state, user_id),
+        flash_html=NOTICES.get(status_code, "") + ERRORS.get(error_code, ""),
+        posts_html="\n".join(cards) if cards else EMPTY_QUEUE_HTML,
+        pager_html=render_pager(posts, has_previous, has_next),
+        failed_html=f"<h2>Неудачные публикации</h2>\n{''.join(failed_cards)}" if failed_cards else "",
+        api_html=render_api_token_block(state, user_id, api_token),
+        import_html=render_import_block(state, user_id),
+        # Пока идет импорт, страница сама обновляется; без изменений сервер ответит 304
+        refresh_html='\n  <meta http-equiv="refresh" content="5">' if get_active_import_job(state, user_id) else "",
+    )
 
 
 async def require_panel_user(request):
@@ -486,50 +341,64 @@ async def panel_logout(request):
     return response
 
 
+def get_dashboard_etag(state, user_id, query_string):
+    user = state.users[user_id]
+    # Версия очереди меняется при каждом изменении постов пользователя, остальное видимое на странице — здесь
+    page_state = "\0".join(
+        (user_id, str(user.get("panel_login")), str(user.get("publish_channel_id")), str(user.get("panel_api_token_hash")), query_string)
+    )
+    page_digest = hashlib.blake2s(page_state.encode(), digest_size=8).hexdigest()
+    return f"{DASHBOARD_ETAG_SEED}-{state.queue_versions.get(user_id, 0)}-{page_digest}"
+
+
 async def panel_dashboard(request):
     state = get_state(request)
     user_id = await require_panel_user(request)
+    etag = get_dashboard_etag(state, user_id, request.query_string)
+    headers = {"Cache-Control": DASHBOARD_CACHE_CONTROL, "ETag": f'W/"{etag}"'}
+    if any(tag.value in (etag, "*") for tag in request.if_none_match or ()):
+        raise web.HTTPNotModified(headers=headers)
+
+    dead_letters = await load_user_dead_letters(state, user_id)
     return web.Response(
-        text=render_panel_dashboard(state, user_id, request.query.get("status"), request.query.get("error")),
+        text=render_panel_dashboard(
+            state,
+            user_id,
+            request.query.get("status"),
+            request.query.get("error"),
+            dead_letters,
+            after=decode_queue_cursor(request.query.get("after")),
+            before=decode_queue_cursor(request.query.get("before")),
+        ),
         content_type="text/html",
+        headers=headers,
     )
 
 
+async def panel_static(request):
+    asset = STATIC_ASSETS.get(request.match_info["file_name"])
+    if asset is None:
+        raise web.HTTPNotFound()
+    body, content_type = asset
+    return web.Response(body=body, content_type=content_type, headers={"Cache-Control": STATIC_CACHE_CONTROL})
+
+
 async def panel_add_post(request):
     state = get_state(request)
     user_id = await require_panel_user(request)
-    form = await request.post()
-    text = (form.get("text") or "").strip()
-    uploaded_file = form.get("media")
+    max_size_bytes, quota_limited = get_panel_upload_limit(state, user_id)
+    try:
+        text, upload = await read_panel_post_form(state, request, max_size_bytes)
+    except UploadTooLargeError:
+        raise web.HTTPFound(f"{PANEL_BASE_PATH}?error={'quota' if quota_limited else 'too_large'}")
+    except Exception as exc:
+        logging.error(f"Ошибка сохранения загруженного файла в панели: {exc}")
+        raise web.HTTPFound(f"{PANEL_BASE_PATH}?error=upload")
 
-    has_upload = bool(uploaded_file and getattr(uploaded_file, "filename", ""))
-    if not text and not has_upload:
+    if not text and not upload:
         raise web.HTTPFound(f"{PANEL_BASE_PATH}?error=empty")
 
-    message_key = f"{user_id}:panel:{int(time.time() * 1000)}:{secrets.token_hex(4)}"
-    file_path = None
-    original_file_name = None
-    file_type = None
-
-    if has_upload:
-        try:
-            file_path, original_file_name, file_type = store_uploaded_file_locally(user_id, message_key, uploaded_file)
-        except Exception as exc:
-            logging.error(f"Ошибка сохранения загруженного файла в панели: {exc}")
-            raise web.HTTPFound(f"{PANEL_BASE_PATH}?error=upload")
-
-    state.storage[message_key] = {
-        "user_id": user_id,
-        "text": text,
-        "file_id": None,
-        "file_path": file_path,
-        "original_file_name": original_file_name,
-        "file_type": file_type,
-        "temp_msg_id": None,
-        "created_at": time.time(),
-    }
-    await save_storage(state)
-    ensure_user_publish_task(state, user_id)
+    create_panel_post(state, user_id, text, upload)
     raise web.HTTPFound(f"{PANEL_BASE_PATH}?status=created")
 
 
@@ -542,19 +411,7 @@ async def panel_publish_post(request):
         raise web.HTTPFound(f"{PANEL_BASE_PATH}?error=missing")
 
     try:
-        await send_to_channel(
-            state,
-            user_id,
-            data["text"],
-            data.get("file_id"),
-            data.get("file_type"),
-            data.get("file_path"),
-            data.get("original_file_name"),
-        )
-        await cleanup_stored_message(state, data)
-        del state.storage[message_key]
-        await save_storage(state)
-        await touch_last_published(state, user_id)
+        await publish_post_now(state, message_key)
         return web.HTTPFound(f"{PANEL_BASE_PATH}?status=published")
     except Exception as exc:
         logging.error(f"Ошибка публикации из панели: {exc}")
@@ -568,15 +425,167 @@ async def panel_delete_post(request):
     data = state.storage.get(message_key)
     if not data or data["user_id"] != user_id:
         raise web.HTTPFound(f"{PANEL_BASE_PATH}?error=missing")
+    if not await claim_storage_items(state, [message_key]):
+        raise web.HTTPFound(f"{PANEL_BASE_PATH}?error=busy")
 
     await cleanup_stored_message(state, data)
-    del state.storage[message_key]
-    await save_storage(state)
+    await remove_storage_item(state, message_key)
     raise web.HTTPFound(f"{PANEL_BASE_PATH}?status=deleted")
 
 
+async def panel_import_posts(request):
+    state = get_state(request)
+    user_id = await require_panel_user(request)
+    if get_active_import_job(state, user_id):
+        raise web.HTTPFound(f"{PANEL_BASE_PATH}?error=import_running")
+    try:
+        await receive_import_archive(state, request, user_id)
+    except UploadTooLargeError:
+        raise web.HTTPFound(f"{PANEL_BASE_PATH}?error=import_too_large")
+    except ImportValidationError:
+        raise web.HTTPFound(f"{PANEL_BASE_PATH}?error=import_missing")
+    except Exception as exc:
+        logging.error(f"Ошибка загрузки архива для импорта: {exc}")
+        raise web.HTTPFound(f"{PANEL_BASE_PATH}?error=import_upload")
+    raise web.HTTPFound(f"{PANEL_BASE_PATH}?status=import_started")
+
+
+async def panel_export_queue(request):
+    state = get_state(request)
+    user_id = await require_panel_user(request)
+    try:
+        return await stream_queue_export(state, request, user_id)
+    except ExportBusyError:
+        raise web.HTTPFound(f"{PANEL_BASE_PATH}?error=export_busy")
+
+
+async def panel_issue_api_token(request):
+    state = get_state(request)
+    user_id = await require_panel_user(request)
+    api_token = await issue_panel_api_token(state, user_id)
+    dead_letters = await load_user_dead_letters(state, user_id)
+    # Токен показывается только в ответе на этот запрос, поэтому страницу нельзя кэшировать
+    return web.Response(
+        text=render_panel_dashboard(state, user_id, dead_letters=dead_letters, api_token=api_token),
+        content_type="text/html",
+        headers={"Cache-Control": "no-store"},
+    )
+
+
+async def panel_revoke_api_token(request):
+    state = get_state(request)
+    user_id = await require_panel_user(request)
+    await revoke_panel_api_token(state, user_id)
+    raise web.HTTPFound(f"{PANEL_BASE_PATH}?status=api_token_revoked")
+
+
+def get_user_post(state, request, user_id):
+    data = state.storage.get(request.match_info["message_key"])
+    if not data or data["user_id"] != user_id:
+        raise web.HTTPNotFound()
+    return data
+
+
+def is_inline_media_type(content_type):
+    return content_type in INLINE_IMAGE_TYPES or content_type.startswith(("audio/", "video/"))
+
+
+def build_media_file_response(path, file_name):
+    # Файлы загружают пользователи: активное содержимое с домена панели открывать нельзя
+    content_type = mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+    disposition = "inline"
+    if not is_inline_media_type(content_type):
+        content_type = "application/octet-stream"
+        disposition = "attachment"
+    response = web.FileResponse(
+        path,
+        headers={
+            "Cache-Control": MEDIA_CACHE_CONTROL,
+            "Content-Disposition": f"{disposition}; filename*=UTF-8''{quote(file_name)}",
+            "X-Content-Type-Options": "nosniff",
+        },
+    )
+    response.content_type = content_type
+    return response
+
+
+async def panel_media(request):
+    # FileResponse отдает файл через sendfile и сам обрабатывает Range, ETag и If-None-Match
+    state = get_state(request)
+    user_id = await require_panel_user(request)
+    data = get_user_post(state, request, user_id)
+    path = await get_local_media_path(state, data.get("file_path"))
+    if not path:
+        raise web.HTTPNotFound()
+    return build_media_file_response(path, data.get("original_file_name") or path.name)
+
+
+async def panel_media_thumbnail(request):
+    state = get_state(request)
+    user_id = await require_panel_user(request)
+    data = get_user_post(state, request, user_id)
+    path = await get_local_thumbnail_path(state, data.get("file_path"))
+    if path:
+        return build_media_file_response(path, "thumbnail.jpg")
+    # Миниатюры нет (предобработка выключена): отдаем само фото
+    path = await get_local_media_path(state, data.get("file_path"))
+    if not path or data.get("file_type") != "photo":
+        raise web.HTTPNotFound()
+    return build_media_file_response(path, data.get("original_file_name") or path.name)
+
+
+async def panel_retry_media_download(request):
+    state = get_state(request)
+    user_id = await require_panel_user(request)
+    message_key = request.match_info["message_key"]
+    data = state.storage.get(message_key)
+    if not data or data["user_id"] != user_id or not retry_media_download(state, message_key):
+        raise web.HTTPFound(f"{PANEL_BASE_PATH}?error=missing")
+    raise web.HTTPFound(f"{PANEL_BASE_PATH}?status=media_requeued")
+
+
+async def panel_retry_failed_post(request):
+    state = get_state(request)
+    user_id = await require_panel_user(request)
+    data = await pop_dead_letter(state, user_id, request.match_info["message_key"])
+    if not data:
+        raise web.HTTPFound(f"{PANEL_BASE_PATH}?error=missing")
+
+    change_media_usage(state, user_id, -(data["file_size"] or 0))
+    add_storage_item(state, data["message_key"], {
+        "user_id": user_id,
+        "text": data["text"],
+        "file_id": data["file_id"],
+        "file_path": data["file_path"],
+        "original_file_name": data["original_file_name"],
+        "file_type": data["file_type"],
+        "temp_msg_id": None,
+        "created_at": data["created_at"] or time.time(),
+        "file_size": data["file_size"] or 0,
+        # Без ссылки на исходное сообщение его не удалить после публикации, а без хэша не сработает кэш file_id
+        "content_hash": data.get("content_hash"),
+        "source_chat_id": data.get("source_chat_id"),
+        "source_message_id": data.get("source_message_id"),
+    })
+    schedule_user_publish(state, user_id)
+    raise web.HTTPFound(f"{PANEL_BASE_PATH}?status=requeued")
+
+
+async def panel_delete_failed_post(request):
+    state = get_state(request)
+    user_id = await require_panel_user(request)
+    data = await pop_dead_letter(state, user_id, request.match_info["message_key"])
+    if not data:
+        raise web.HTTPFound(f"{PANEL_BASE_PATH}?error=missing")
+
+    await cleanup_stored_message(state, data)
+    change_media_usage(state, user_id, -(data["file_size"] or 0))
+    bump_queue_version(state, user_id)
+    raise web.HTTPFound(f"{PANEL_BASE_PATH}?status=failed_deleted")
+
+
 async def start_panel_server(state):
-    app = web.Application(client_max_size=200 * 1024 ** 2)
+    app = web.Application(client_max_size=1024 ** 2, middlewares=[compression_middleware])
     app["state"] = state
     app.add_routes(
         [
@@ -584,9 +593,20 @@ async def start_panel_server(state):
             web.get(f"{PANEL_BASE_PATH}/login", panel_login_page),
             web.post(f"{PANEL_BASE_PATH}/login", panel_login_submit),
             web.post(f"{PANEL_BASE_PATH}/logout", panel_logout),
+            web.get(f"{PANEL_BASE_PATH}/static/{{file_name}}", panel_static),
             web.post(f"{PANEL_BASE_PATH}/posts", panel_add_post),
+            web.get(f"{PANEL_BASE_PATH}/media/{{message_key}}", panel_media),
+            web.get(f"{PANEL_BASE_PATH}/media/{{message_key}}/thumbnail", panel_media_thumbnail),
             web.post(f"{PANEL_BASE_PATH}/posts/{{message_key}}/publish", panel_publish_post),
             web.post(f"{PANEL_BASE_PATH}/posts/{{message_key}}/delete", panel_delete_post),
+            web.post(f"{PANEL_BASE_PATH}/posts/{{message_key}}/media-retry", panel_retry_media_download),
+            web.post(f"{PANEL_BASE_PATH}/failed/{{message_key}}/retry", panel_retry_failed_post),
+            web.post(f"{PANEL_BASE_PATH}/failed/{{message_key}}/delete", panel_delete_failed_post),
+            web.post(f"{PANEL_BASE_PATH}/imports", panel_import_posts),
+            web.get(f"{PANEL_BASE_PATH}/export", panel_export_queue),
+            web.post(f"{PANEL_BASE_PATH}/api-token", panel_issue_api_token),
+            web.post(f"{PANEL_BASE_PATH}/api-token/revoke", panel_revoke_api_token),
+            *build_panel_api_routes(),
         ]
     )
 
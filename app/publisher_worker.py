@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import random
+import time
+
+from .config import (
+    AUTO_PUBLISH_DELAY_MAX,
+    AUTO_PUBLISH_DELAY_MIN,
+    PUBLISH_WORKERS,
+    PUBLISHER_HEARTBEAT_INTERVAL,
+    PUBLISHER_INSTANCE_ID,
+    PUBLISHER_LEASE_TTL,
+    PUBLISHER_POLL_INTERVAL,
+    PUBLISHER_PROCESSES,
+    PUBLISH_CHANNEL_RETRY_DELAY,
+    TELEGRAM_GLOBAL_RATE,
+)
+from .database import (
+    acknowledge_post,
+    delay_next_publish,
+    extend_post_leases,
+    init_db,
+    lease_due_posts,
+    load_media_file_ids,
+    move_to_dead_letters,
+    release_post_lease,
+)
+from .metrics import start_metrics_reporter, stop_metrics_reporter
+from .queue import cleanup_stored_message, send_storage_item
+from .scheduler import apply_publish_failure, classify_publish_error
+from .state import create_app_state
+
+
+async def process_leased_post(state, message_key, data):
+    try:
+        await send_storage_item(state, data)
+    except Exception as exc:
+        if apply_publish_failure(message_key, data, exc):
+            await move_to_dead_letters(state, message_key, data)
+        else:
+            await release_post_lease(state, PUBLISHER_INSTANCE_ID, message_key, data)
+            if classify_publish_error(exc) == "channel":
+                await delay_next_publish(state, data["user_id"], time.time() + PUBLISH_CHANNEL_RETRY_DELAY)
+        return
+
+    published_at = time.time()
+    next_publish_at = published_at + random.randint(AUTO_PUBLISH_DELAY_MIN, AUTO_PUBLISH_DELAY_MAX)
+    if not await acknowledge_post(state, PUBLISHER_INSTANCE_ID, message_key, data["user_id"], published_at, next_publish_at):
+        logging.warning(f"Аренда поста {message_key} потеряна до подтверждения публикации")
+        return
+    await cleanup_stored_message(state, data)
+
+
+async def run_lease_heartbeat(state, in_flight):
+    while True:
+        await asyncio.sleep(PUBLISHER_HEARTBEAT_INTERVAL)
+        try:
+            await extend_post_leases(state, PUBLISHER_INSTANCE_ID, list(in_flight), PUBLISHER_LEASE_TTL)
+        except Exception as exc:
+            logging.error(f"Не удалось продлить аренду постов: {exc}")
+
+
+async def run_publisher_loop(state):
+    in_flight = {}
+    heartbeat_task = asyncio.create_task(run_lease_heartbeat(state, in_flight))
+    try:
+        while True:
+            free_slots = PUBLISH_WORKERS - len(in_flight)
+            if not free_slots:
+                await asyncio.wait(in_flight.values(), timeout=PUBLISHER_POLL_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+                continue
+
+            leased = []
+            try:
+                leased, users = await lease_due_posts(state, PUBLISHER_INSTANCE_ID, free_slots, PUBLISHER_LEASE_TTL)
+                state.users.update(users)
+            except Exception as exc:
+                logging.error(f"Не удалось получить посты для публикации: {exc}")
+
+            for message_key, data in leased:
+                task = asyncio.create_task(process_leased_post(state, message_key, data))
+                in_flight[message_key] = task
+                task.add_done_callback(lambda _task, key=message_key: in_flight.pop(key, None))
+
+            if len(leased) < free_slots:
+                await asyncio.sleep(PUBLISHER_POLL_INTERVAL)
+    finally:
+        heartbeat_task.cancel()
+        for task in list(in_flight.values()):
+            task.cancel()
+
+
+async def run_publisher():
+    # Каждый процесс считает токены сам, поэтому получает свою долю общего лимита Telegram
+    state = create_app_state(TELEGRAM_GLOBAL_RATE / PUBLISHER_PROCESSES)
+    await init_db(state)
+    state.media_file_ids = await load_media_file_ids(state)
+    logging.info(f"Воркер публикации {PUBLISHER_INSTANCE_ID} запущен")
+    start_metrics_reporter(state)
+    try:
+        await run_publisher_loop(state)
+    finally:
+        await stop_metrics_reporter(state)
+        await state.bot.session.close()
+        await state.media_backend.close()
+        await state.pool.close()
@@ -1,12 +1,23 @@
-import asyncio
 import logging
-import random
 import time
 
+from aiogram.exceptions import TelegramBadRequest
+
 from .common import get_channel_link
-from .config import AUTO_PUBLISH_DELAY_MIN, AUTO_PUBLISH_DELAY_MAX
-from .database import save_storage, save_users
-from .media_storage import build_local_input_file, delete_local_file
+from .config import MAX_MEDIA_MB_PER_USER, PUBLISHER_INSTANCE_ID, PUBLISHER_LEASE_TTL, PUBLISHER_MODE
+from .database import claim_post_lease, release_post_lease
+from .media_storage import (
+    build_media_input_file,
+    delete_local_file,
+    forget_file_id,
+    get_cached_file_id,
+    get_message_media_payload,
+    is_blob_path,
+    release_blob,
+    remember_file_id,
+)
+from .queue_index import index_storage_item, unindex_storage_item
+from .write_behind import bump_queue_version, flush_pending_writes, mark_storage_dirty, mark_user_dirty
 
 
 async def delete_temp_draft_message(state, data):
@@ -20,22 +31,150 @@ async def delete_temp_draft_message(state, data):
         pass
 
 
+async def delete_source_message(state, data):
+    if not data.get("source_chat_id") or not data.get("source_message_id"):
+        return
+    try:
+        await state.bot.delete_message(data["source_chat_id"], data["source_message_id"])
+    except Exception:
+        pass
+
+
 async def cleanup_stored_message(state, data):
     await delete_temp_draft_message(state, data)
+    await delete_source_message(state, data)
+    file_path = data.get("file_path")
     try:
-        delete_local_file(data.get("file_path"))
+        if file_path and is_blob_path(file_path):
+            await release_blob(state, file_path)
+        else:
+            delete_local_file(file_path)
     except Exception as exc:
         logging.warning(f"Не удалось удалить локальный файл {data.get('file_path')}: {exc}")
 
 
+def change_media_usage(state, user_id, delta):
+    if delta:
+        state.media_usage[user_id] = max(0, state.media_usage.get(user_id, 0) + delta)
+
+
+def get_media_quota_remaining(state, user_id):
+    if MAX_MEDIA_MB_PER_USER <= 0:
+        return None
+    return MAX_MEDIA_MB_PER_USER * 1024 * 1024 - state.media_usage.get(user_id, 0)
+
+
+def add_storage_item(state, message_key, data):
+    state.storage[message_key] = data
+    state.new_storage_keys.add(message_key)
+    index_storage_item(state.queue_index, message_key, data)
+    change_media_usage(state, data["user_id"], data.get("file_size") or 0)
+    mark_storage_dirty(state, message_key)
+
+
+async def remove_storage_item(state, message_key):
+    data = state.storage.pop(message_key, None)
+    if data is None:
+        return
+    unindex_storage_item(state.queue_index, message_key, data)
+    change_media_usage(state, data["user_id"], -(data.get("file_size") or 0))
+    bump_queue_version(state, data["user_id"])
+    mark_storage_dirty(state, message_key)
+    # Удаление должно попасть в базу сразу, иначе после перезапуска пост уйдет повторно
+    await flush_pending_writes(state)
+
+
+async def remove_storage_items(state, message_keys):
+    removed = []
+    for message_key in message_keys:
+        data = state.storage.pop(message_key, None)
+        if data is None:
+            continue
+        unindex_storage_item(state.queue_index, message_key, data)
+        change_media_usage(state, data["user_id"], -(data.get("file_size") or 0))
+        bump_queue_version(state, data["user_id"])
+        mark_storage_dirty(state, message_key)
+        removed.append((message_key, data))
+    # Вся пачка удалений записывается в базу одной транзакцией
+    if removed:
+        await flush_pending_writes(state)
+    return removed
+
+
+async def claim_storage_items(state, message_keys):
+    # Во внешнем режиме пост может прямо сейчас публиковать воркер: удаляем только посты, чью аренду удалось забрать
+    if PUBLISHER_MODE == "embedded":
+        return list(message_keys)
+    await flush_pending_writes(state)
+    claimed = []
+    for message_key in message_keys:
+        if await claim_post_lease(state, PUBLISHER_INSTANCE_ID, message_key, PUBLISHER_LEASE_TTL):
+            claimed.append(message_key)
+    return claimed
+
+
+def move_storage_item(state, message_key, created_at):
+    # Порядок очереди задается created_at, поэтому перестановка — это смена ключа в индексе
+    data = state.storage[message_key]
+    unindex_storage_item(state.queue_index, message_key, data)
+    data["created_at"] = created_at
+    index_storage_item(state.queue_index, message_key, data)
+    mark_storage_dirty(state, message_key)
+
+
+def drop_storage_item(state, message_key, dead_lettered=False):
+    # Пост уже удален из базы другим процессом (воркером публикации): убираем только из памяти
+    data = state.storage.pop(message_key, None)
+    if data is not None:
+        unindex_storage_item(state.queue_index, message_key, data)
+        # Неудачные публикации тоже считаются в квоте, поэтому их размер не вычитается
+        if not dead_lettered:
+            change_media_usage(state, data["user_id"], -(data.get("file_size") or 0))
+        bump_queue_version(state, data["user_id"])
+
+
 def get_user_storage_items(state, user_id):
-    return sorted(
-        ((message_key, data) for message_key, data in state.storage.items() if data["user_id"] == user_id),
-        key=lambda item: ((item[1].get("created_at") or 0), item[0]),
-    )
+    return [(message_key, state.storage[message_key]) for message_key in state.queue_index.get(user_id, ())]
+
+
+def get_user_storage_page(state, user_id, limit, after=None, before=None):
+    user_index = state.queue_index.get(user_id)
+    if user_index is None:
+        return [], False, False
+    message_keys, has_previous, has_next = user_index.page(limit, after, before)
+    return [(message_key, state.storage[message_key]) for message_key in message_keys], has_previous, has_next
 
 
-async def send_to_channel(state, user_id, text, file_id=None, file_type=None, file_path=None, original_file_name=None):
+def get_user_queue_size(state, user_id):
+    return len(state.queue_index.get(user_id, ()))
+
+
+async def send_media(state, chat_id, file_type, media_source, caption):
+    if file_type == "photo":
+        return await state.bot.send_photo(chat_id, media_source, caption=caption)
+    if file_type == "video":
+        return await state.bot.send_video(chat_id, media_source, caption=caption)
+    if file_type == "audio":
+        return await state.bot.send_audio(chat_id, media_source, caption=caption)
+    if file_type == "voice":
+        return await state.bot.send_voice(chat_id, media_source, caption=caption)
+    if file_type == "document":
+        return await state.bot.send_document(chat_id, media_source, caption=caption)
+    raise ValueError(f"Unsupported file type: {file_type}")
+
+
+async def send_to_channel(
+    state,
+    user_id,
+    text,
+    file_id=None,
+    file_type=None,
+    file_path=None,
+    original_file_name=None,
+    content_hash=None,
+    source_chat_id=None,
+    source_message_id=None,
+):
     user = state.users[user_id]
     publish_channel_id = user.get("publish_channel_id")
     if not publish_channel_id:
@@ -46,22 +185,33 @@ async def send_to_channel(state, user_id, text, file_id=None, file_type=None, fi
         text = f"{text}\n\n{channel_link}"
 
     caption = text or None
-    media_source = build_local_input_file(file_path, original_file_name) or file_id
+    if file_type and source_chat_id and source_message_id:
+        try:
+            await state.bot.copy_message(publish_channel_id, source_chat_id, source_message_id, caption=caption)
+            return
+        except TelegramBadRequest as exc:
+            # Исходное сообщение удалено: публикуем по file_id, он остается действительным
+            logging.warning(f"Не удалось скопировать сообщение {source_chat_id}:{source_message_id}: {exc}")
+
     if file_type:
+        # Те же байты уже загружались в Telegram: отправляем по file_id без повторной загрузки
+        cached_file_id = get_cached_file_id(state, content_hash, file_type)
+        if cached_file_id:
+            try:
+                await send_media(state, publish_channel_id, file_type, cached_file_id, caption)
+                return
+            except TelegramBadRequest as exc:
+                logging.warning(f"Telegram отклонил сохраненный file_id для {content_hash}: {exc}")
+                await forget_file_id(state, content_hash, file_type)
+
+        media_source = build_media_input_file(state, file_path, original_file_name) or file_id
         if not media_source:
             raise FileNotFoundError(f"Media source for task is missing: {file_path}")
-        if file_type == "photo":
-            await state.bot.send_photo(publish_channel_id, media_source, caption=caption)
-        elif file_type == "video":
-            await state.bot.send_video(publish_channel_id, media_source, caption=caption)
-        elif file_type == "audio":
-            await state.bot.send_audio(publish_channel_id, media_source, caption=caption)
-        elif file_type == "voice":
-            await state.bot.send_voice(publish_channel_id, media_source, caption=caption)
-        elif file_type == "document":
-            await state.bot.send_document(publish_channel_id, media_source, caption=caption)
-        else:
-            raise ValueError(f"Unsupported file type: {file_type}")
+        message = await send_media(state, publish_channel_id, file_type, media_source, caption)
+        if content_hash and media_source is not file_id:
+            uploaded_file_id = get_message_media_payload(message)[0]
+            if uploaded_file_id:
+                await remember_file_id(state, content_hash, file_type, uploaded_file_id)
         return
 
     if text:
@@ -71,58 +221,42 @@ async def send_to_channel(state, user_id, text, file_id=None, file_type=None, fi
     raise ValueError("Nothing to publish")
 
 
-async def touch_last_published(state, user_id):
+def touch_last_published(state, user_id):
     state.users[user_id]["last_published_at"] = time.time()
-    await save_users(state)
-
-
-def ensure_user_publish_task(state, user_id):
-    event = state.user_publish_events.get(user_id)
-    if not event:
-        event = asyncio.Event()
-        state.user_publish_events[user_id] = event
+    mark_user_dirty(state, user_id, "last_published_at")
 
-    if state.users.get(user_id, {}).get("auto_publish", True):
-        event.set()
-    else:
-        event.clear()
 
-    task = state.user_active_tasks.get(user_id)
-    if not task or task.done():
-        state.user_active_tasks[user_id] = asyncio.create_task(publish_queue_for_user(state, user_id, event))
-    return event
+async def send_storage_item(state, data):
+    await send_to_channel(
+        state,
+        data["user_id"],
+        data["text"],
+        data.get("file_id"),
+        data.get("file_type"),
+        data.get("file_path"),
+        data.get("original_file_name"),
+        data.get("content_hash"),
+        data.get("source_chat_id"),
+        data.get("source_message_id"),
+    )
 
 
-async def publish_queue_for_user(state, user_id, publish_event):
-    while True:
-        await publish_event.wait()
-        tasks = [message_key for message_key, _ in get_user_storage_items(state, user_id)]
-        if not tasks:
-            state.user_active_tasks.pop(user_id, None)
-            return
+async def publish_stored_post(state, message_key):
+    data = state.storage[message_key]
+    leased = PUBLISHER_MODE != "embedded"
+    if leased:
+        # Во внешнем режиме пост может быть уже взят воркером: забираем его через ту же аренду
+        await flush_pending_writes(state)
+        if not await claim_post_lease(state, PUBLISHER_INSTANCE_ID, message_key, PUBLISHER_LEASE_TTL):
+            raise RuntimeError(f"Post {message_key} is being published by another worker")
 
-        last_published = state.users[user_id].get("last_published_at", 0)
-        current_time = time.time()
-        time_since_last = current_time - last_published
-        if time_since_last < AUTO_PUBLISH_DELAY_MIN:
-            await asyncio.sleep(AUTO_PUBLISH_DELAY_MIN - time_since_last)
+    try:
+        await send_storage_item(state, data)
+    except Exception:
+        if leased:
+            await release_post_lease(state, PUBLISHER_INSTANCE_ID, message_key)
+        raise
 
-        message_key = tasks[0]
-        data = state.storage[message_key]
-        try:
-            await send_to_channel(
-                state,
-                data["user_id"],
-                data["text"],
-                data.get("file_id"),
-                data.get("file_type"),
-                data.get("file_path"),
-                data.get("original_file_name"),
-            )
-            await cleanup_stored_message(state, data)
-            del state.storage[message_key]
-            await save_storage(state)
-            await touch_last_published(state, user_id)
-            await asyncio.sleep(random.randint(AUTO_PUBLISH_DELAY_MIN, AUTO_PUBLISH_DELAY_MAX))
-        except Exception as exc:
-            logging.error(f"Ошибка публикации: {exc}")
+    await cleanup_stored_message(state, data)
+    await remove_storage_item(state, message_key)
+    touch_last_published(state, data["user_id"])
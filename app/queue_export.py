@@ -0,0 +1,159 @@
+import asyncio
+import io
+import json
+import logging
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+from .config import DEFAULT_EXTENSIONS, EXPORT_WORKERS
+from .media_storage import UPLOAD_CHUNK_SIZE, get_local_media_path, sanitize_filename
+from .queue import get_user_storage_items
+
+EXPORT_CHUNK_SIZE = 256 * 1024
+
+
+class ExportBusyError(RuntimeError):
+    pass
+
+
+class ResponseStreamWriter(io.RawIOBase):
+    # zipfile пишет архив в рабочем потоке, а ответ отправляется в цикле событий.
+    # Поток без seek: zipfile сам переходит на дескрипторы данных после каждого файла
+    def __init__(self, response, loop):
+        super().__init__()
+        self.response = response
+        self.loop = loop
+        self.buffer = bytearray()
+        self.aborted = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= EXPORT_CHUNK_SIZE:
+            self.send_buffer()
+        return len(data)
+
+    def send_buffer(self):
+        if self.aborted:
+            raise ConnectionResetError("Export download was aborted")
+        if self.buffer:
+            chunk = bytes(self.buffer)
+            self.buffer.clear()
+            # Поток ждет отправки порции, поэтому медленный клиент не раздувает память
+            asyncio.run_coroutine_threadsafe(self.response.write(chunk), self.loop).result()
+
+
+def build_export_file_name(index, data):
+    if data.get("original_file_name"):
+        file_name = sanitize_filename(data["original_file_name"])
+    else:
+        file_name = f"{data.get('file_type') or 'file'}{DEFAULT_EXTENSIONS.get(data.get('file_type'), '')}"
+    return f"media/{index:05d}_{file_name}"
+
+
+def copy_file_into_archive(archive, local_path, archive_name):
+    try:
+        source = open(local_path, "rb")
+    except FileNotFoundError:
+        # Пост удалили во время выгрузки, и файл уже убран из хранилища
+        return False
+    with source:
+        entry_info = zipfile.ZipInfo.from_file(local_path, archive_name)
+        # Медиа уже сжаты, поэтому файлы кладутся без повторного сжатия
+        entry_info.compress_type = zipfile.ZIP_STORED
+        with archive.open(entry_info, "w") as entry:
+            while chunk := source.read(UPLOAD_CHUNK_SIZE):
+                entry.write(chunk)
+    return True
+
+
+def fetch_export_media_path(state, stream, file_path):
+    # Файл из внешнего хранилища докачивается в кэш по одному, когда до него дошла очередь
+    try:
+        return asyncio.run_coroutine_threadsafe(get_local_media_path(state, file_path), stream.loop).result()
+    except Exception as exc:
+        logging.warning(f"Не удалось получить файл {file_path} для выгрузки: {exc}")
+        return None
+
+
+def write_queue_archive(state, stream, posts):
+    manifest = []
+    with zipfile.ZipFile(stream, "w") as archive:
+        for index, (_, data) in enumerate(posts, start=1):
+            item = {"text": data.get("text") or "", "type": data.get("file_type")}
+            if data.get("file_path"):
+                local_path = fetch_export_media_path(state, stream, data["file_path"])
+                archive_name = build_export_file_name(index, data)
+                if local_path and copy_file_into_archive(archive, local_path, archive_name):
+                    item["file"] = archive_name
+                else:
+                    item["media_missing"] = True
+            elif data.get("file_type"):
+                item["media_missing"] = True
+            manifest.append(item)
+        archive.writestr(
+            "manifest.json",
+            json.dumps({"posts": manifest}, ensure_ascii=False, indent=2),
+            compress_type=zipfile.ZIP_DEFLATED,
+        )
+    stream.send_buffer()
+
+
+def get_export_executor(state):
+    # Поток выгрузки ждет медленного клиента, поэтому у выгрузок свой пул, а не общий пул to_thread
+    if state.export_executor is None:
+        state.export_executor = ThreadPoolExecutor(EXPORT_WORKERS, thread_name_prefix="queue-export")
+    return state.export_executor
+
+
+def stop_export_executor(state):
+    if state.export_executor is not None:
+        state.export_executor.shutdown(wait=False, cancel_futures=True)
+        state.export_executor = None
+
+
+async def stream_queue_export(state, request, user_id):
+    if user_id in state.active_exports:
+        raise ExportBusyError("Export is already running for this user")
+    if len(state.active_exports) >= EXPORT_WORKERS:
+        raise ExportBusyError("Too many exports are running")
+    state.active_exports.add(user_id)
+    try:
+        return await send_queue_export(state, request, user_id)
+    finally:
+        state.active_exports.discard(user_id)
+
+
+async def send_queue_export(state, request, user_id):
+    # Снимок очереди берется сразу, чтобы порядок постов в архиве не менялся по ходу выгрузки
+    posts = get_user_storage_items(state, user_id)
+    response = web.StreamResponse(
+        headers={
+            "Content-Type": "application/zip",
+            "Content-Disposition": f'attachment; filename="queue-{user_id}-{time.strftime("%Y%m%d")}.zip"',
+            "Cache-Control": "no-store",
+        }
+    )
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+
+    stream = ResponseStreamWriter(response, asyncio.get_running_loop())
+    try:
+        await asyncio.get_running_loop().run_in_executor(get_export_executor(state), write_queue_archive, state, stream, posts)
+    except ConnectionResetError:
+        logging.info(f"Выгрузка очереди пользователя {user_id} прервана клиентом")
+        return response
+    except asyncio.CancelledError:
+        stream.aborted = True
+        raise
+    except Exception as exc:
+        # Заголовки уже отправлены: остается оборвать архив, клиент получит ошибку распаковки
+        logging.error(f"Ошибка выгрузки очереди пользователя {user_id}: {exc}")
+        return response
+    await response.write_eof()
+    return response
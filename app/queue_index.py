@@ -0,0 +1,75 @@
+import bisect
+
+
+def get_storage_sort_key(message_key, data):
+    return (data.get("created_at") or 0, message_key)
+
+
+def encode_queue_cursor(message_key, data):
+    created_at, message_key = get_storage_sort_key(message_key, data)
+    return f"{float(created_at)!r}:{message_key}"
+
+
+def decode_queue_cursor(value):
+    if not value:
+        return None
+    created_at, _, message_key = value.partition(":")
+    try:
+        return float(created_at), message_key
+    except ValueError:
+        return None
+
+
+class UserQueueIndex:
+    def __init__(self):
+        self._entries = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return (message_key for _, message_key in self._entries)
+
+    def add(self, sort_key):
+        position = bisect.bisect_left(self._entries, sort_key)
+        if position < len(self._entries) and self._entries[position] == sort_key:
+            return
+        self._entries.insert(position, sort_key)
+
+    def remove(self, sort_key):
+        position = bisect.bisect_left(self._entries, sort_key)
+        if position < len(self._entries) and self._entries[position] == sort_key:
+            del self._entries[position]
+
+    def first(self):
+        return self._entries[0][1] if self._entries else None
+
+    def page(self, limit, after=None, before=None):
+        # Страница ищется бинарным поиском по ключу (created_at, message_key), без смещения от начала
+        if before is not None:
+            end = bisect.bisect_left(self._entries, before)
+            start = max(0, end - limit)
+        else:
+            start = bisect.bisect_right(self._entries, after) if after is not None else 0
+            end = start + limit
+        return [message_key for _, message_key in self._entries[start:end]], start > 0, end < len(self._entries)
+
+
+def build_queue_index(storage):
+    queue_index = {}
+    for message_key, data in storage.items():
+        queue_index.setdefault(data["user_id"], UserQueueIndex()).add(get_storage_sort_key(message_key, data))
+    return queue_index
+
+
+def index_storage_item(queue_index, message_key, data):
+    queue_index.setdefault(data["user_id"], UserQueueIndex()).add(get_storage_sort_key(message_key, data))
+
+
+def unindex_storage_item(queue_index, message_key, data):
+    user_index = queue_index.get(data["user_id"])
+    if user_index is None:
+        return
+    user_index.remove(get_storage_sort_key(message_key, data))
+    if not user_index:
+        del queue_index[data["user_id"]]
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import time
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from .config import TELEGRAM_CHAT_RATE, TELEGRAM_GLOBAL_RATE, TELEGRAM_GROUP_RATE_PER_MINUTE, TELEGRAM_RETRY_AFTER_ATTEMPTS
+
+LIMITED_METHOD_PREFIXES = ("Send", "Copy", "Forward")
+MAX_IDLE_CHAT_BUCKETS = 10_000
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now=None):
+        now = now or time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self):
+        # Токен забирается сразу (баланс может уйти в минус), ожидание растет по очереди запросов
+        self.refill()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def penalize(self, seconds):
+        self.refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def is_idle(self, now):
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+
+class TelegramRateLimiter(BaseRequestMiddleware):
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self.throttled_requests = 0
+        self.retry_after_events = 0
+        self.total_wait_time = 0.0
+
+    def get_chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= MAX_IDLE_CHAT_BUCKETS:
+                now = time.monotonic()
+                self.chat_buckets = {key: value for key, value in self.chat_buckets.items() if not value.is_idle(now)}
+            # Положительный числовой id — личный чат, остальное — группы и каналы
+            if str(chat_id).isdigit():
+                bucket = TokenBucket(TELEGRAM_CHAT_RATE, 1)
+            else:
+                rate = TELEGRAM_GROUP_RATE_PER_MINUTE / 60
+                bucket = TokenBucket(rate, TELEGRAM_GROUP_RATE_PER_MINUTE)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def wait_for_bucket(self, bucket):
+        wait_time = bucket.reserve()
+        if wait_time > 0:
+            self.throttled_requests += 1
+            self.total_wait_time += wait_time
+            await asyncio.sleep(wait_time)
+
+    async def __call__(self, make_request, bot, method):
+        if not type(method).__name__.startswith(LIMITED_METHOD_PREFIXES):
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, "chat_id", None)
+        attempt = 0
+        while True:
+            if chat_id is not None:
+                await self.wait_for_bucket(self.get_chat_bucket(chat_id))
+            await self.wait_for_bucket(self.global_bucket)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as exc:
+                self.retry_after_events += 1
+                attempt += 1
+                if attempt > TELEGRAM_RETRY_AFTER_ATTEMPTS:
+                    raise
+                logging.warning(f"Telegram просит подождать {exc.retry_after} сек. ({type(method).__name__}, чат {chat_id})")
+                bucket = self.get_chat_bucket(chat_id) if chat_id is not None else self.global_bucket
+                bucket.penalize(exc.retry_after)
+
+    def get_metrics(self):
+        self.global_bucket.refill()
+        return {
+            "global_tokens": self.global_bucket.tokens,
+            "global_wait_time": max(0.0, -self.global_bucket.tokens / self.global_bucket.rate),
+            "tracked_chats": len(self.chat_buckets),
+            "throttled_requests": self.throttled_requests,
+            "retry_after_events": self.retry_after_events,
+            "total_wait_time": self.total_wait_time,
+        }
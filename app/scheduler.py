@@ -0,0 +1,262 @@
+import asyncio
+import heapq
+import logging
+import random
+import time
+
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramEntityTooLarge,
+    TelegramForbiddenError,
+    TelegramNotFound,
+    TelegramRetryAfter,
+)
+
+from .config import (
+    AUTO_PUBLISH_DELAY_MAX,
+    AUTO_PUBLISH_DELAY_MIN,
+    PUBLISH_CHANNEL_RETRY_DELAY,
+    PUBLISH_MAX_ATTEMPTS,
+    PUBLISH_RETRY_BASE_DELAY,
+    PUBLISH_RETRY_MAX_DELAY,
+    PUBLISH_WARMUP_WINDOW,
+    PUBLISH_WORKERS,
+    PUBLISHER_MODE,
+)
+from .database import delay_next_publish, move_to_dead_letters
+from .queue import get_user_queue_size, publish_stored_post
+from .queue_index import unindex_storage_item
+from .write_behind import bump_queue_version, mark_storage_dirty, mark_user_dirty
+
+PERMANENT_PUBLISH_ERRORS = (TelegramBadRequest, TelegramNotFound, TelegramEntityTooLarge, FileNotFoundError, ValueError)
+# Ошибки канала, а не поста: отправка любого другого поста упадет так же
+CHANNEL_ERROR_MARKERS = (
+    "chat not found",
+    "not enough rights",
+    "need administrator rights",
+    "have no rights",
+    "chat_write_forbidden",
+    "channel_private",
+    "bot is not a member",
+    "bot was kicked",
+)
+# Пользователя нельзя публиковать сейчас: снимаем его с расписания, вернет его загрузчик медиа или повторная проверка канала
+PUBLISH_NOT_READY = object()
+
+
+def get_default_due_time(state, user_id):
+    # Пауза после последней публикации соблюдается, даже если next_publish_at устарел
+    user = state.users[user_id]
+    return max(time.time(), user.get("next_publish_at") or 0, (user.get("last_published_at") or 0) + AUTO_PUBLISH_DELAY_MIN)
+
+
+def remember_next_publish_at(state, user_id, due_at):
+    user = state.users[user_id]
+    if user.get("next_publish_at") != due_at:
+        user["next_publish_at"] = due_at
+        mark_user_dirty(state, user_id, "next_publish_at")
+
+
+def schedule_user_publish(state, user_id, due_at=None):
+    # Во внешнем режиме очередь разбирают воркеры publisher.py, бот только ставит посты в очередь
+    if PUBLISHER_MODE != "embedded":
+        return
+
+    # Пользователь сейчас публикуется: воркер сам перепланирует его по завершении
+    if user_id in state.publishing_users:
+        return
+
+    user = state.users.get(user_id, {})
+    if not user.get("auto_publish", True) or not user.get("publish_channel_id") or not get_user_queue_size(state, user_id):
+        state.publish_schedule.pop(user_id, None)
+        # Очередь опустела сразу после публикации: выбранная пауза должна дождаться следующего поста
+        if due_at is not None and user_id in state.users:
+            remember_next_publish_at(state, user_id, due_at)
+        return
+
+    if due_at is None:
+        due_at = state.publish_schedule.get(user_id) or get_default_due_time(state, user_id)
+    # Между публикациями в канал, включая ручные, проходит не меньше AUTO_PUBLISH_DELAY_MIN
+    due_at = max(due_at, (user.get("last_published_at") or 0) + AUTO_PUBLISH_DELAY_MIN)
+    if state.publish_schedule.get(user_id) == due_at:
+        return
+
+    state.publish_schedule[user_id] = due_at
+    remember_next_publish_at(state, user_id, due_at)
+    heapq.heappush(state.publish_heap, (due_at, user_id))
+    if state.publish_heap[0] == (due_at, user_id):
+        state.scheduler_event.set()
+
+
+async def publish_post_now(state, message_key):
+    user_id = state.storage[message_key]["user_id"]
+    await publish_stored_post(state, message_key)
+    # Ручная публикация отодвигает автоматическую, иначе та может уйти через несколько секунд
+    if PUBLISHER_MODE == "embedded":
+        schedule_user_publish(state, user_id)
+    else:
+        await delay_next_publish(state, user_id, state.users[user_id]["last_published_at"] + AUTO_PUBLISH_DELAY_MIN)
+
+
+def pop_due_user(state):
+    while state.publish_heap:
+        due_at, user_id = state.publish_heap[0]
+        if state.publish_schedule.get(user_id) != due_at:
+            # Устаревшая запись: пользователя перепланировали или сняли с расписания
+            heapq.heappop(state.publish_heap)
+            continue
+        if due_at > time.time():
+            return None, due_at - time.time()
+        heapq.heappop(state.publish_heap)
+        del state.publish_schedule[user_id]
+        return user_id, None
+    return None, None
+
+
+async def run_publish_dispatcher(state):
+    while True:
+        user_id, wait_time = pop_due_user(state)
+        if user_id:
+            state.publishing_users.add(user_id)
+            await state.publish_work_queue.put(user_id)
+            continue
+
+        state.scheduler_event.clear()
+        try:
+            await asyncio.wait_for(state.scheduler_event.wait(), wait_time)
+        except asyncio.TimeoutError:
+            pass
+
+
+def is_channel_error(exc):
+    if isinstance(exc, TelegramForbiddenError):
+        return True
+    return isinstance(exc, (TelegramBadRequest, TelegramNotFound)) and any(marker in str(exc).lower() for marker in CHANNEL_ERROR_MARKERS)
+
+
+def classify_publish_error(exc):
+    if isinstance(exc, TelegramRetryAfter):
+        return "rate_limited"
+    if is_channel_error(exc):
+        return "channel"
+    if isinstance(exc, PERMANENT_PUBLISH_ERRORS):
+        return "permanent"
+    return "retryable"
+
+
+def get_retry_delay(attempts):
+    delay = min(PUBLISH_RETRY_MAX_DELAY, PUBLISH_RETRY_BASE_DELAY * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def get_next_ready_post(state, user_id):
+    now = time.time()
+    earliest_retry_at = None
+    for message_key in state.queue_index.get(user_id, ()):
+        data = state.storage[message_key]
+        # Посты с незагруженным медиа пропускаются, загрузчик перепланирует пользователя сам
+        if (data.get("media_status") or "ready") != "ready":
+            continue
+        next_attempt_at = data.get("next_attempt_at") or 0
+        if next_attempt_at <= now:
+            return message_key, None
+        earliest_retry_at = min(earliest_retry_at or next_attempt_at, next_attempt_at)
+    return None, earliest_retry_at
+
+
+async def dead_letter_post(state, message_key, data):
+    await move_to_dead_letters(state, message_key, data)
+    if state.storage.pop(message_key, None) is not None:
+        unindex_storage_item(state.queue_index, message_key, data)
+        bump_queue_version(state, data["user_id"])
+
+
+def apply_publish_failure(message_key, data, exc):
+    error_kind = classify_publish_error(exc)
+    data["last_error"] = f"{type(exc).__name__}: {exc}"[:500]
+    if error_kind == "channel":
+        # Пост не виноват: попытки не тратятся, откладывается весь пользователь
+        logging.warning(f"Канал пользователя {data['user_id']} недоступен, публикация приостановлена: {data['last_error']}")
+        return False
+    if error_kind == "rate_limited":
+        data["next_attempt_at"] = time.time() + exc.retry_after
+    else:
+        data["attempts"] = (data.get("attempts") or 0) + 1
+        if error_kind == "permanent" or data["attempts"] >= PUBLISH_MAX_ATTEMPTS:
+            logging.error(f"Пост {message_key} перемещен в список неудачных публикаций: {data['last_error']}")
+            return True
+        data["next_attempt_at"] = time.time() + get_retry_delay(data["attempts"])
+    logging.warning(f"Ошибка публикации {message_key} ({error_kind}), повтор в {data['next_attempt_at']:.0f}: {data['last_error']}")
+    return False
+
+
+async def handle_publish_failure(state, message_key, data, exc):
+    if apply_publish_failure(message_key, data, exc):
+        await dead_letter_post(state, message_key, data)
+    else:
+        mark_storage_dirty(state, message_key)
+
+
+async def publish_next_post(state, user_id):
+    user = state.users.get(user_id, {})
+    if not user.get("auto_publish", True) or not user.get("publish_channel_id"):
+        return None
+
+    message_key, earliest_retry_at = get_next_ready_post(state, user_id)
+    if not message_key:
+        return earliest_retry_at or PUBLISH_NOT_READY
+
+    data = state.storage[message_key]
+    try:
+        await publish_stored_post(state, message_key)
+        return time.time() + random.randint(AUTO_PUBLISH_DELAY_MIN, AUTO_PUBLISH_DELAY_MAX)
+    except Exception as exc:
+        await handle_publish_failure(state, message_key, data, exc)
+        if classify_publish_error(exc) == "channel":
+            # Остальные посты не отправляем в неудачные: ждем, пока канал починят или выдадут права заново
+            asyncio.get_running_loop().call_later(PUBLISH_CHANNEL_RETRY_DELAY, schedule_user_publish, state, user_id)
+            return PUBLISH_NOT_READY
+        # Следующий пост пользователя не ждет, пока проблемный пост исчерпает попытки
+        next_message_key, earliest_retry_at = get_next_ready_post(state, user_id)
+        if next_message_key:
+            return time.time()
+        return earliest_retry_at or PUBLISH_NOT_READY
+
+
+async def run_publish_worker(state):
+    while True:
+        user_id = await state.publish_work_queue.get()
+        next_due_at = None
+        try:
+            next_due_at = await publish_next_post(state, user_id)
+        except Exception as exc:
+            logging.error(f"Ошибка воркера публикации: {exc}")
+        finally:
+            state.publishing_users.discard(user_id)
+            if next_due_at is not PUBLISH_NOT_READY:
+                schedule_user_publish(state, user_id, next_due_at)
+            state.publish_work_queue.task_done()
+
+
+def warm_up_publish_schedule(state):
+    for user_id in list(state.queue_index):
+        schedule_user_publish(state, user_id)
+
+    # После перезапуска просроченные пользователи распределяются по окну прогрева, а не публикуются разом
+    now = time.time()
+    overdue = sorted((due_at, user_id) for user_id, due_at in state.publish_schedule.items() if due_at <= now)
+    for position, (_, user_id) in enumerate(overdue):
+        schedule_user_publish(state, user_id, now + PUBLISH_WARMUP_WINDOW * position / len(overdue))
+
+
+def start_publish_scheduler(state):
+    warm_up_publish_schedule(state)
+    state.scheduler_tasks = [asyncio.create_task(run_publish_dispatcher(state))]
+    state.scheduler_tasks.extend(asyncio.create_task(run_publish_worker(state)) for _ in range(PUBLISH_WORKERS))
+
+
+async def stop_publish_scheduler(state):
+    for task in state.scheduler_tasks:
+        task.cancel()
+    await asyncio.gather(*state.scheduler_tasks, return_exceptions=True)
+    state.scheduler_tasks = []
@@ -1,30 +1,83 @@
 import asyncio
+from collections import deque
 from dataclasses import dataclass, field
 from typing import Any
 
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 
-from .config import MEDIA_ROOT, TOKEN
+from .chat_cache import ChatCache
+from .config import MEDIA_BLOB_ROOT, MEDIA_ROOT, MEDIA_TMP_ROOT, TELEGRAM_GLOBAL_RATE, TOKEN
+from .media_backends import create_media_backend
+from .rate_limit import TelegramRateLimiter
 
 
 @dataclass
 class AppState:
     bot: Bot
     dp: Dispatcher
+    rate_limiter: TelegramRateLimiter | None = None
     pool: Any = None
+    media_backend: Any = None
+    image_executor: Any = None
+    export_executor: Any = None
+    chat_cache: ChatCache = field(default_factory=ChatCache)
     users: dict = field(default_factory=dict)
     storage: dict = field(default_factory=dict)
     referrals: dict = field(default_factory=dict)
-    user_active_tasks: dict[str, asyncio.Task] = field(default_factory=dict)
-    user_publish_events: dict[str, asyncio.Event] = field(default_factory=dict)
+    media_file_ids: dict = field(default_factory=dict)
+    queue_index: dict = field(default_factory=dict)
+    queue_versions: dict[str, int] = field(default_factory=dict)
+    dirty_users: dict[str, set] = field(default_factory=dict)
+    dirty_storage: set = field(default_factory=set)
+    new_storage_keys: set = field(default_factory=set)
+    dirty_referrals: set = field(default_factory=set)
+    write_behind_event: asyncio.Event = field(default_factory=asyncio.Event)
+    write_behind_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    write_behind_task: asyncio.Task | None = None
+    metrics_task: asyncio.Task | None = None
+    write_behind_metrics: dict = field(
+        default_factory=lambda: {
+            "flushes": 0,
+            "flushed_operations": 0,
+            "failed_flushes": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+        }
+    )
+    publish_schedule: dict[str, float] = field(default_factory=dict)
+    publish_heap: list = field(default_factory=list)
+    publishing_users: set = field(default_factory=set)
+    publish_work_queue: asyncio.Queue = field(default_factory=asyncio.Queue)
+    scheduler_event: asyncio.Event = field(default_factory=asyncio.Event)
+    scheduler_tasks: list[asyncio.Task] = field(default_factory=list)
+    media_download_queues: dict[str, deque] = field(default_factory=dict)
+    media_download_order: deque = field(default_factory=deque)
+    media_download_event: asyncio.Event = field(default_factory=asyncio.Event)
+    media_downloads_active: set = field(default_factory=set)
+    media_download_tasks: list[asyncio.Task] = field(default_factory=list)
+    media_usage: dict[str, int] = field(default_factory=dict)
+    media_gc_shards: deque = field(default_factory=deque)
+    media_gc_task: asyncio.Task | None = None
+    media_migration_task: asyncio.Task | None = None
+    storage_listener_task: asyncio.Task | None = None
+    media_migration_skipped: set = field(default_factory=set)
+    media_migration_deletes: deque = field(default_factory=deque)
     admin_broadcast_state: dict = field(default_factory=dict)
     panel_credentials_state: dict = field(default_factory=dict)
     panel_sessions: dict = field(default_factory=dict)
+    panel_api_tokens: dict[str, str] = field(default_factory=dict)
+    import_jobs: dict[str, dict] = field(default_factory=dict)
+    import_tasks: set = field(default_factory=set)
+    active_exports: set = field(default_factory=set)
 
 
-def create_app_state() -> AppState:
+def create_app_state(telegram_global_rate: float = TELEGRAM_GLOBAL_RATE) -> AppState:
     MEDIA_ROOT.mkdir(parents=True, exist_ok=True)
+    MEDIA_BLOB_ROOT.mkdir(parents=True, exist_ok=True)
+    MEDIA_TMP_ROOT.mkdir(parents=True, exist_ok=True)
     bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+    rate_limiter = TelegramRateLimiter(telegram_global_rate)
+    bot.session.middleware(rate_limiter)
     dp = Dispatcher()
-    return AppState(bot=bot, dp=dp)
+    return AppState(bot=bot, dp=dp, rate_limiter=rate_limiter, media_backend=create_media_backend())
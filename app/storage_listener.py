@@ -0,0 +1,62 @@
+import asyncio
+import logging
+
+from .database import DEAD_LETTER_NOTIFY_PREFIX, listen_storage_changes, load_dead_letter_keys, load_existing_storage_keys
+from .queue import drop_storage_item
+
+STORAGE_LISTENER_PING_INTERVAL = 30
+STORAGE_LISTENER_RETRY_DELAY = 5
+
+
+def handle_storage_change(state, payload):
+    if payload.startswith(DEAD_LETTER_NOTIFY_PREFIX):
+        drop_storage_item(state, payload.removeprefix(DEAD_LETTER_NOTIFY_PREFIX), dead_lettered=True)
+    else:
+        drop_storage_item(state, payload)
+
+
+async def resync_storage(state):
+    # Уведомления, пришедшие без соединения, потеряны: сверяем очередь в памяти с базой.
+    # Еще не вставленные ботом посты в базе искать нельзя, они пропускаются
+    message_keys = [message_key for message_key in state.storage if message_key not in state.new_storage_keys]
+    existing_keys = await load_existing_storage_keys(state, message_keys)
+    missing_keys = [message_key for message_key in message_keys if message_key not in existing_keys]
+    dead_letter_keys = await load_dead_letter_keys(state, missing_keys) if missing_keys else set()
+    dropped = 0
+    for message_key in missing_keys:
+        if message_key in state.storage:
+            drop_storage_item(state, message_key, dead_lettered=message_key in dead_letter_keys)
+            dropped += 1
+    if dropped:
+        logging.info(f"После переподключения к базе убрано постов, которых уже нет в очереди: {dropped}")
+
+
+async def run_storage_listener(state):
+    while True:
+        conn = None
+        try:
+            conn = await listen_storage_changes(state, lambda payload: handle_storage_change(state, payload))
+            await resync_storage(state)
+            # Обрыв соединения без ответа сервера замечаем только по неудачному запросу
+            while True:
+                await asyncio.sleep(STORAGE_LISTENER_PING_INTERVAL)
+                await conn.execute("SELECT 1", timeout=STORAGE_LISTENER_PING_INTERVAL)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            logging.error(f"Подписка на изменения очереди прервана, переподключение: {exc}")
+        finally:
+            if conn is not None:
+                conn.terminate()
+        await asyncio.sleep(STORAGE_LISTENER_RETRY_DELAY)
+
+
+def start_storage_listener(state):
+    state.storage_listener_task = asyncio.create_task(run_storage_listener(state))
+
+
+async def stop_storage_listener(state):
+    if state.storage_listener_task:
+        state.storage_listener_task.cancel()
+        await asyncio.gather(state.storage_listener_task, return_exceptions=True)
+        state.storage_listener_task = None
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import time
+
+from .config import WRITE_BEHIND_INTERVAL_MS, WRITE_BEHIND_MAX_OPS
+from .database import USER_COLUMNS, write_changes
+
+
+def get_pending_writes_count(state):
+    return len(state.dirty_users) + len(state.dirty_storage) + len(state.dirty_referrals)
+
+
+def wake_write_behind(state):
+    if get_pending_writes_count(state) >= WRITE_BEHIND_MAX_OPS:
+        state.write_behind_event.set()
+
+
+def mark_user_dirty(state, user_id, *fields):
+    state.dirty_users.setdefault(user_id, set()).update(fields or USER_COLUMNS)
+    wake_write_behind(state)
+
+
+def bump_queue_version(state, user_id):
+    state.queue_versions[user_id] = state.queue_versions.get(user_id, 0) + 1
+
+
+def mark_storage_dirty(state, message_key):
+    data = state.storage.get(message_key)
+    if data is not None:
+        # Любое изменение поста меняет ETag панели его владельца
+        bump_queue_version(state, data["user_id"])
+    state.dirty_storage.add(message_key)
+    wake_write_behind(state)
+
+
+def mark_referral_dirty(state, referrer_id, referred_id):
+    state.dirty_referrals.add((referrer_id, referred_id))
+    wake_write_behind(state)
+
+
+def restore_pending_writes(state, dirty_users, dirty_storage, dirty_referrals):
+    for user_id, fields in dirty_users.items():
+        state.dirty_users.setdefault(user_id, set()).update(fields)
+    state.dirty_storage.update(dirty_storage)
+    state.dirty_referrals.update(dirty_referrals)
+
+
+async def flush_pending_writes(state):
+    async with state.write_behind_lock:
+        if not get_pending_writes_count(state):
+            return
+        dirty_users, state.dirty_users = state.dirty_users, {}
+        dirty_storage, state.dirty_storage = state.dirty_storage, set()
+        dirty_referrals, state.dirty_referrals = state.dirty_referrals, set()
+        operations = len(dirty_users) + len(dirty_storage) + len(dirty_referrals)
+
+        started_at = time.perf_counter()
+        try:
+            await write_changes(state, dirty_users, dirty_storage, dirty_referrals)
+        except Exception:
+            restore_pending_writes(state, dirty_users, dirty_storage, dirty_referrals)
+            state.write_behind_metrics["failed_flushes"] += 1
+            raise
+
+        # Вставленные строки дальше обновляются только через UPDATE
+        state.new_storage_keys.difference_update(dirty_storage)
+        flush_ms = (time.perf_counter() - started_at) * 1000
+        metrics = state.write_behind_metrics
+        metrics["flushes"] += 1
+        metrics["flushed_operations"] += operations
+        metrics["last_flush_ms"] = flush_ms
+        metrics["max_flush_ms"] = max(metrics["max_flush_ms"], flush_ms)
+
+
+def get_write_behind_metrics(state):
+    return {
+        **state.write_behind_metrics,
+        "queue_depth": get_pending_writes_count(state),
+    }
+
+
+async def run_write_behind(state):
+    while True:
+        try:
+            await asyncio.wait_for(state.write_behind_event.wait(), WRITE_BEHIND_INTERVAL_MS / 1000)
+        except asyncio.TimeoutError:
+            pass
+        state.write_behind_event.clear()
+        try:
+            await flush_pending_writes(state)
+        except Exception as exc:
+            logging.error(f"Ошибка записи изменений в базу данных: {exc}")
+
+
+def start_write_behind(state):
+    state.write_behind_task = asyncio.create_task(run_write_behind(state))
+
+
+async def stop_write_behind(state):
+    task = state.write_behind_task
+    if task:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        state.write_behind_task = None
+    await flush_pending_writes(state)
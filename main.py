@@ -2,10 +2,29 @@ import asyncio
 import logging
 
 from app import create_app_state
-from app.database import init_db, load_referrals, load_storage, load_users
+from app.bulk_import import stop_import_jobs
+from app.config import PUBLISHER_MODE
+from app.database import (
+    init_db,
+    load_media_file_ids,
+    load_media_usage,
+    load_referrals,
+    load_storage,
+    load_users,
+)
 from app.handlers import setup_routers
+from app.image_processing import stop_image_executor
+from app.media_downloads import start_media_downloads, stop_media_downloads
+from app.media_gc import start_media_gc, stop_media_gc
+from app.media_migration import start_media_migration, stop_media_migration
+from app.metrics import start_metrics_reporter, stop_metrics_reporter
+from app.panel_auth import build_panel_api_token_index
 from app.panel_web import start_panel_server
-from app.queue import ensure_user_publish_task
+from app.queue_export import stop_export_executor
+from app.queue_index import build_queue_index
+from app.scheduler import start_publish_scheduler, stop_publish_scheduler
+from app.storage_listener import start_storage_listener, stop_storage_listener
+from app.write_behind import start_write_behind, stop_write_behind
 
 
 logging.basicConfig(level=logging.INFO)
@@ -15,18 +34,42 @@ async def main():
     state = create_app_state()
     await init_db(state)
     state.users = await load_users(state)
+    state.panel_api_tokens = build_panel_api_token_index(state.users)
     state.storage = await load_storage(state)
+    state.queue_index = build_queue_index(state.storage)
     state.referrals = await load_referrals(state)
+    state.media_file_ids = await load_media_file_ids(state)
+    state.media_usage = await load_media_usage(state)
+
+    start_write_behind(state)
+    start_metrics_reporter(state)
+
+    start_media_downloads(state)
+    start_media_gc(state)
+    start_media_migration(state)
 
     setup_routers(state)
     panel_runner = await start_panel_server(state)
-    for user_id in {data["user_id"] for data in state.storage.values()}:
-        ensure_user_publish_task(state, user_id)
+    if PUBLISHER_MODE == "embedded":
+        start_publish_scheduler(state)
+    else:
+        start_storage_listener(state)
 
     try:
         await state.dp.start_polling(state.bot)
     finally:
         await panel_runner.cleanup()
+        await stop_import_jobs(state)
+        await stop_publish_scheduler(state)
+        await stop_media_downloads(state)
+        await stop_media_gc(state)
+        await stop_media_migration(state)
+        stop_image_executor(state)
+        stop_export_executor(state)
+        await stop_storage_listener(state)
+        await stop_metrics_reporter(state)
+        await stop_write_behind(state)
+        await state.media_backend.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,11 @@
+import asyncio
+import logging
+
+from app.publisher_worker import run_publisher
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+if __name__ == "__main__":
+    asyncio.run(run_publisher())
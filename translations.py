@@ -30,6 +30,7 @@ TRANSLATIONS = {
         "task_removed": "Удалить задачу❌",
         "task_remove_error": "Ошибка при удалении: {}",
         "task_already_removed": "Задача уже удалена или не найдена.",
+        "task_busy": "Пост сейчас публикуется, попробуй чуть позже.",
         "share_bot_info": "👥 <b>Вы пригласили:</b> {} пользователей\n\n📊 <b>Посмотреть топ 10 приглашавших:</b>",
         "ref_link": "📢 Твоя реферальная ссылка:\n{}",
         "top_referrers": "<b>🏆 Топ 10 пользователей по приглашениям:</b>\n\n{}",
@@ -86,7 +87,8 @@ TRANSLATIONS = {
         "panel_login_changed": "Логин панели обновлён.",
         "panel_password_changed": "Пароль панели обновлён.",
         "panel_change_cancelled": "Изменение данных панели отменено.",
-        "queue_full": "⚠️ Очередь переполнена! Максимум {} постов. Удалите старые задачи или дождитесь публикации."
+        "queue_full": "⚠️ Очередь переполнена! Максимум {} постов. Удалите старые задачи или дождитесь публикации.",
+        "media_quota_full": "⚠️ Медиафайлы в очереди занимают больше {} МБ. Удалите старые задачи или дождитесь публикации."
     },
     "en": {
         "select_language": "Select language:",
@@ -117,6 +119,7 @@ TRANSLATIONS = {
         "task_removed": "Remove❌",
         "task_remove_error": "Error removing task: {}",
         "task_already_removed": "Task already removed or not found.",
+        "task_busy": "The post is being published right now, please try again shortly.",
         "share_bot_info": "👥 <b>You invited:</b> {} users\n\n📊 <b>View top 10 inviters:</b>",
         "ref_link": "📢 Your referral link:\n{}",
         "top_referrers": "<b>🏆 Top 10 users by invitations:</b>\n\n{}",
@@ -173,7 +176,8 @@ TRANSLATIONS = {
         "panel_login_changed": "Panel login updated.",
         "panel_password_changed": "Panel password updated.",
         "panel_change_cancelled": "Panel credential update cancelled.",
-        "queue_full": "⚠️ Queue is full! Maximum {} posts. Remove old tasks or wait for publication."
+        "queue_full": "⚠️ Queue is full! Maximum {} posts. Remove old tasks or wait for publication.",
+        "media_quota_full": "⚠️ Media in your queue takes more than {} MB. Remove old tasks or wait for publication."
     },
     "uz": {
         "select_language": "Tilni tanlang:",
@@ -204,6 +208,7 @@ TRANSLATIONS = {
         "task_removed": "Vazifani o'chirish❌",
         "task_remove_error": "O'chirishda xato: {}",
         "task_already_removed": "Vazifa allaqachon o'chirilgan yoki topilmadi.",
+        "task_busy": "Post hozir nashr etilmoqda, birozdan keyin urinib ko'ring.",
         "share_bot_info": "👥 <b>Siz taklif qildingiz:</b> {} foydalanuvchi\n\n📊 <b>Eng yaxshi 10 taklif qiluvchilarni ko'rish:</b>",
         "ref_link": "📢 Sizning taklif havolangiz:\n{}",
         "top_referrers": "<b>🏆 Takliflar bo'yicha eng yaxshi 10 foydalanuvchi:</b>\n\n{}",
@@ -259,6 +264,7 @@ TRANSLATIONS = {
         "panel_login_taken": "Bu login band. Boshqasini tanlang.",
         "panel_login_changed": "Panel logini yangilandi.",
         "panel_password_changed": "Panel paroli yangilandi.",
-        "panel_change_cancelled": "Panel ma'lumotlarini o'zgartirish bekor qilindi."
+        "panel_change_cancelled": "Panel ma'lumotlarini o'zgartirish bekor qilindi.",
+        "media_quota_full": "⚠️ Navbatdagi media fayllar {} MB dan oshdi. Eski vazifalarni o'chiring yoki nashrni kuting."
     }
 }